@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+"""Benchmark img2img throughput for different --frame_batch sizes.
+
+Starts a local stand-in for the WebUI img2img endpoint that charges a fixed
+per-request overhead plus a per-image cost which shrinks with batch size (to
+mimic GPU batching), then sends the same frames with batch sizes 1..K and
+reports frames per second for each.
+
+    python benchmarks/bench_frame_batch.py --frames 32 --batches 1,2,4,8
+"""
+
+import argparse
+import base64
+import io
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import webuiapi  # noqa: E402
+
+
+def make_handler(overhead, per_image, batch_efficiency, size):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color="gray").save(buffer, format="PNG")
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply({"txt2img": [], "img2img": []})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            count = max(1, len(request.get("init_images", [])))
+            time.sleep(overhead + per_image * count ** batch_efficiency)
+            self._reply({"images": [encoded] * count, "parameters": {}, "info": "{}"})
+
+    return StandInHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark frames/sec against --frame_batch")
+    parser.add_argument("--frames", type=int, default=32, help="frames to send per run (default: 32)")
+    parser.add_argument("--batches", type=str, default="1,2,4,8", help="batch sizes to compare")
+    parser.add_argument("--overhead", type=float, default=0.15,
+                        help="stand-in per-request overhead in seconds (default: 0.15)")
+    parser.add_argument("--per_image", type=float, default=0.2,
+                        help="stand-in compute seconds for one image (default: 0.2)")
+    parser.add_argument("--batch_efficiency", type=float, default=0.8,
+                        help="exponent applied to batch size for compute cost (default: 0.8)")
+    parser.add_argument("--size", type=int, default=512, help="frame edge in pixels (default: 512)")
+    args = parser.parse_args()
+
+    size = (args.size, args.size)
+    handler = make_handler(args.overhead, args.per_image, args.batch_efficiency, size)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    api = webuiapi.WebUIApi(baseurl="http://127.0.0.1:{0}/sdapi/v1".format(server.server_port),
+                            image_encoding="png-fast")
+    frames = [Image.new("RGB", size, color=(i % 255, 0, 0)) for i in range(args.frames)]
+
+    print("{0:>6}{1:>10}{2:>12}".format("batch", "seconds", "frames/s"))
+    for batch in [int(b) for b in args.batches.split(",")]:
+        start = time.perf_counter()
+        for offset in range(0, len(frames), batch):
+            chunk = frames[offset:offset + batch]
+            result = api.img2img(images=chunk, batch_size=len(chunk))
+            [result.as_numpy(i) for i in range(len(chunk))]
+        elapsed = time.perf_counter() - start
+        print("{0:>6}{1:>10.2f}{2:>12.2f}".format(batch, elapsed, len(frames) / elapsed))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+"""Micro-benchmark for the payload image encodings supported by webuiapi.
+
+Reports the average time to encode one frame and the resulting base64 payload
+size for each preset in ``webuiapi.IMAGE_ENCODINGS``. Pass an image path to
+benchmark a real frame; otherwise a synthetic 1080p frame is used.
+
+    python benchmarks/bench_image_encoding.py [image] [--repeat 10]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import webuiapi  # noqa: E402
+
+
+def synthetic_frame(width=1920, height=1080):
+    """Smooth gradients with mild noise, closer to video content than pure noise."""
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    frame += rng.normal(0, 6, frame.shape)
+    return Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8))
+
+
+def run(image, encodings, repeat):
+    rows = []
+    for name in encodings:
+        webuiapi.raw_b64_img(image, name)  # warm up codec state
+        start = time.perf_counter()
+        for _ in range(repeat):
+            payload = webuiapi.raw_b64_img(image, name)
+        elapsed = (time.perf_counter() - start) / repeat
+        rows.append((name, elapsed * 1000, len(payload) / 1024))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark payload image encodings")
+    parser.add_argument("image", nargs="?", help="image to encode (default: synthetic 1080p frame)")
+    parser.add_argument("--repeat", type=int, default=10, help="encodes per policy (default: 10)")
+    parser.add_argument("--encodings", type=str, default=",".join([*webuiapi.IMAGE_ENCODINGS, "jpeg:75"]),
+                        help="comma-separated encodings to compare")
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB") if args.image else synthetic_frame()
+    print("Frame {0}x{1}, {2} runs per encoding".format(image.width, image.height, args.repeat))
+    print("{0:<16}{1:>12}{2:>14}".format("encoding", "encode ms", "payload KiB"))
+    for name, ms, kib in run(image, args.encodings.split(","), args.repeat):
+        print("{0:<16}{1:>12.1f}{2:>14.0f}".format(name, ms, kib))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Skip img2img for frames that repeat an already processed frame.
+
+Each frame gets a 64-bit difference hash and a small grayscale thumbnail.
+A new frame reuses a stored output when its hash is within a few bits of a
+stored frame's hash (a cheap vectorized prefilter over all entries) and the
+mean absolute difference of the thumbnails is at most ``threshold`` (on the
+0-255 scale). Entries are keyed by the seed the output was generated with, so
+an output is only reused for a frame that would be rendered with the same
+parameters and seed. Only the ``capacity`` most recent outputs are kept.
+
+With several requests in flight, repeated frames usually arrive before the
+first of them has been rendered. ``claim`` therefore records a frame that is
+about to be rendered, and later near-identical frames wait for its output
+instead of missing the store as well.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+HASH_DISTANCE = 6
+THUMBNAIL_SIZE = 32
+# Output of an entry whose frame is still being rendered
+_PENDING = object()
+
+
+def _grayscale(frame) -> Image.Image:
+    image = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+    return image.convert("L")
+
+
+def difference_hash(frame) -> int:
+    """64-bit dHash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour."""
+    pixels = np.asarray(_grayscale(frame).resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def thumbnail(frame) -> np.ndarray:
+    return np.asarray(_grayscale(frame).resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR),
+                      dtype=np.float32)
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class FrameDeduplicator:
+    """Thread-safe store of recent (frame signature, seed) -> output entries."""
+
+    def __init__(self, threshold: float = 2.0, capacity: int = 16):
+        self.threshold = threshold
+        self.capacity = max(1, capacity)
+        self.lookups = 0
+        self.hits = 0
+        self._entries: "OrderedDict[int, Tuple[Any, int, np.ndarray, Any]]" = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Condition()
+
+    @staticmethod
+    def signature(frame) -> Tuple[int, np.ndarray]:
+        """Hash and thumbnail of ``frame``, as taken by ``lookup`` and ``add``."""
+        return difference_hash(frame), thumbnail(frame)
+
+    def _match(self, signature, seed, pending: bool) -> Optional[int]:
+        """Key of the closest entry for a near-identical frame rendered with ``seed``."""
+        frame_hash, frame_thumbnail = signature
+        candidates = [(key, entry) for key, entry in self._entries.items()
+                      if entry[0] == seed and (pending or entry[3] is not _PENDING)]
+        if not candidates:
+            return None
+        hashes = np.array([entry[1] for _, entry in candidates], dtype=np.uint64)
+        distances = _popcount(hashes ^ np.uint64(frame_hash))
+        for position in np.argsort(distances, kind="stable"):
+            if distances[position] > HASH_DISTANCE:
+                break
+            key, (_, _, stored_thumbnail, _) = candidates[position]
+            if np.abs(stored_thumbnail - frame_thumbnail).mean() <= self.threshold:
+                return key
+        return None
+
+    def _hit(self, key) -> Any:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][3]
+
+    def _store(self, signature, seed, output) -> int:
+        frame_hash, frame_thumbnail = signature
+        key = self._next_key
+        self._next_key += 1
+        self._entries[key] = (seed, frame_hash, frame_thumbnail, output)
+        # Entries still being rendered have waiters and are kept
+        for old_key in [k for k, entry in self._entries.items() if entry[3] is not _PENDING]:
+            if len(self._entries) <= self.capacity:
+                break
+            del self._entries[old_key]
+        return key
+
+    def lookup(self, signature, seed) -> Optional[Any]:
+        """Return a stored output for a near-identical frame rendered with ``seed``."""
+        with self._lock:
+            self.lookups += 1
+            key = self._match(signature, seed, pending=False)
+            return None if key is None else self._hit(key)
+
+    def claim(self, signature, seed) -> Tuple[Optional[Any], Optional[int]]:
+        """Look up a frame about to be rendered with ``seed``, reserving it on a miss.
+
+        Returns ``(output, None)`` when a stored output can be reused, waiting
+        first if a near-identical frame is still being rendered. Otherwise
+        returns ``(None, claim)``: the caller renders the frame and passes
+        ``claim`` to ``add``, or to ``release`` if rendering failed.
+        """
+        with self._lock:
+            self.lookups += 1
+            while True:
+                key = self._match(signature, seed, pending=True)
+                if key is None:
+                    return None, self._store(signature, seed, _PENDING)
+                if self._entries[key][3] is not _PENDING:
+                    return self._hit(key), None
+                self._lock.wait()
+
+    def add(self, signature, seed, output, claim: Optional[int] = None):
+        """Remember ``output`` as the result of rendering a frame with ``seed``."""
+        with self._lock:
+            if claim is not None and claim in self._entries:
+                self._entries[claim] = self._entries[claim][:3] + (output,)
+                self._lock.notify_all()
+            else:
+                self._store(signature, seed, output)
+
+    def release(self, claim: int):
+        """Give up a ``claim`` whose frame was not rendered; waiters render their own."""
+        with self._lock:
+            self._entries.pop(claim, None)
+            self._lock.notify_all()
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"frames": self.lookups, "skipped": self.hits, "skip_ratio": round(self.skip_ratio, 4)}
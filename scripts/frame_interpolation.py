@@ -0,0 +1,125 @@
+"""Synthesize in-between frames from rendered keyframes.
+
+In stride mode only keyframes go through img2img; the frames between two
+rendered keyframes are made locally from their outputs:
+
+* ``crossfade`` blends the two outputs linearly by time, all in-between
+  frames at once.
+* ``motion_blend`` estimates per-block motion from each keyframe's source
+  frame to the in-between source frame, shifts the keyframe outputs by that
+  motion and blends them, weighting each block by time and by how well its
+  motion search matched.
+
+``is_scene_cut`` flags source frames that differ enough from the previous
+one to start a new keyframe segment.
+"""
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+import frame_dedup
+
+METHODS = ("crossfade", "motion")
+
+
+def is_scene_cut(previous, current, threshold: float) -> bool:
+    """True when the mean thumbnail difference (0-255) exceeds ``threshold``."""
+    return float(np.abs(frame_dedup.thumbnail(previous) - frame_dedup.thumbnail(current)).mean()) > threshold
+
+
+def _weights(count: int) -> np.ndarray:
+    return (np.arange(1, count + 1, dtype=np.float32) / (count + 1)).reshape(-1, 1, 1, 1)
+
+
+def crossfade(previous: np.ndarray, following: np.ndarray, count: int) -> List[np.ndarray]:
+    """``count`` frames fading evenly from ``previous`` to ``following``."""
+    t = _weights(count)
+    frames = (1 - t) * previous.astype(np.float32) + t * following.astype(np.float32)
+    return list(np.clip(frames + 0.5, 0, 255).astype(np.uint8))
+
+
+def _luma(frame, size: Tuple[int, int]) -> np.ndarray:
+    image = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+    return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def _pad(image: np.ndarray, block: int) -> np.ndarray:
+    height, width = image.shape[:2]
+    padding = [(0, -height % block), (0, -width % block)] + [(0, 0)] * (image.ndim - 2)
+    return np.pad(image, padding, mode="edge")
+
+
+def _block_sums(values: np.ndarray, block: int) -> np.ndarray:
+    height, width = values.shape
+    return values.reshape(height // block, block, width // block, block).sum(axis=(1, 3))
+
+
+def block_motion(reference: np.ndarray, target: np.ndarray, block: int = 16,
+                 radius: int = 8, step: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+    """Best shift of ``reference`` for each block of ``target``, by sum of absolute differences.
+
+    Both inputs are padded 2-D luma arrays. Returns ``(shifts, errors)``:
+    ``shifts`` has shape ``(rows, cols, 2)`` holding (dy, dx) per block and
+    ``errors`` the mean absolute difference of the chosen shift.
+    """
+    best_error = np.full(_block_sums(target, block).shape, np.inf, dtype=np.float32)
+    shifts = np.zeros(best_error.shape + (2,), dtype=np.int32)
+    offsets = range(-radius, radius + 1, step)
+    for dy in offsets:
+        for dx in offsets:
+            shifted = np.roll(reference, (dy, dx), axis=(0, 1))
+            error = _block_sums(np.abs(shifted - target), block)
+            better = error < best_error
+            best_error = np.where(better, error, best_error)
+            shifts[better] = (dy, dx)
+    return shifts, best_error / (block * block)
+
+
+def warp_blocks(image: np.ndarray, shifts: np.ndarray, block: int) -> np.ndarray:
+    """Move each block of ``image`` by its (dy, dx) from ``shifts``."""
+    warped = np.empty_like(image)
+    pixel_shifts = np.repeat(np.repeat(shifts, block, axis=0), block, axis=1)
+    for dy, dx in np.unique(shifts.reshape(-1, 2), axis=0):
+        mask = (pixel_shifts[..., 0] == dy) & (pixel_shifts[..., 1] == dx)
+        warped[mask] = np.roll(image, (dy, dx), axis=(0, 1))[mask]
+    return warped
+
+
+def motion_blend(previous: np.ndarray, following: np.ndarray, previous_source, following_source,
+                 sources: Sequence, block: int = 16, radius: int = 8, step: int = 4) -> List[np.ndarray]:
+    """Motion-compensated in-between frames, one per entry of ``sources``.
+
+    ``previous``/``following`` are the rendered keyframes, the ``*_source``
+    arguments the decoded input frames they were rendered from.
+    """
+    height, width = previous.shape[:2]
+    size = (width, height)
+    outputs = (_pad(previous, block).astype(np.float32), _pad(following, block).astype(np.float32))
+    references = (_pad(_luma(previous_source, size), block), _pad(_luma(following_source, size), block))
+    frames = []
+    for t, source in zip(_weights(len(sources)).ravel(), sources):
+        target = _pad(_luma(source, size), block)
+        warped, confidence = [], []
+        for output, reference, weight in zip(outputs, references, (1 - t, t)):
+            shifts, errors = block_motion(reference, target, block, radius, step)
+            warped.append(warp_blocks(output, shifts, block))
+            confidence.append(weight / (errors + 1.0))
+        share = confidence[1] / (confidence[0] + confidence[1])
+        share = np.repeat(np.repeat(share, block, axis=0), block, axis=1)[..., None]
+        frame = (1 - share) * warped[0] + share * warped[1]
+        frames.append(np.clip(frame[:height, :width] + 0.5, 0, 255).astype(np.uint8))
+    return frames
+
+
+def interpolate(method: str, previous: np.ndarray, following: np.ndarray,
+                previous_source, following_source, sources: Sequence) -> List[np.ndarray]:
+    """In-between frames for ``sources`` using ``method`` (one of ``METHODS``)."""
+    if not sources:
+        return []
+    if method == "crossfade":
+        return crossfade(previous, following, len(sources))
+    if method == "motion":
+        return motion_blend(previous, following, previous_source, following_source, sources)
+    raise ValueError("Unknown interpolation method {0!r}; expected one of {1}".format(method, METHODS))
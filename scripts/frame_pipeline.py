@@ -0,0 +1,120 @@
+"""Bounded, ordered processing pipeline for video2video frames.
+
+Work items flow through three stages connected by bounded queues:
+
+* a decoder thread that pulls items from the (lazily decoding) input iterator,
+* a pool of ``inflight`` workers that run ``process`` concurrently, so several
+  API hosts can be busy at once, and
+* a writer thread that calls ``write`` strictly in input order.
+
+Memory stays bounded: at most ``decode_ahead`` items wait to be processed and
+at most ``inflight`` items are being processed or waiting to be written.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(target: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put ``item`` unless ``stop`` is set while waiting for space."""
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(
+    items: Iterable[Any],
+    process: Callable[[Any], Any],
+    write: Callable[[Any, Any], None],
+    inflight: int = 1,
+    decode_ahead: int = 4,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> bool:
+    """Run ``process`` over ``items`` concurrently and ``write`` results in order.
+
+    ``should_stop`` is polled before each item is dispatched; when it returns
+    True no further items are started, already started items are still
+    written, and the function returns False. Returns True when every item was
+    written. The first exception raised by the iterator, ``process`` or
+    ``write`` stops the pipeline and is re-raised here.
+    """
+    inflight = max(1, inflight)
+    decoded: queue.Queue = queue.Queue(maxsize=max(1, decode_ahead))
+    pending: queue.Queue = queue.Queue()
+    slots = threading.Semaphore(inflight)
+    stop = threading.Event()
+    errors = []
+
+    def decode():
+        try:
+            for item in items:
+                if not _put(decoded, item, stop):
+                    return
+        except BaseException as error:
+            _put(decoded, _Failure(error), stop)
+            return
+        _put(decoded, _DONE, stop)
+
+    def write_in_order():
+        while True:
+            entry = pending.get()
+            if entry is _DONE:
+                return
+            item, future = entry
+            try:
+                result = future.result()
+                if not errors:
+                    write(item, result)
+            except BaseException as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                slots.release()
+
+    decoder = threading.Thread(target=decode, name="frame-decoder", daemon=True)
+    writer = threading.Thread(target=write_in_order, name="frame-writer", daemon=True)
+    completed = False
+    with ThreadPoolExecutor(max_workers=inflight, thread_name_prefix="frame-request") as pool:
+        decoder.start()
+        writer.start()
+        try:
+            while not stop.is_set():
+                try:
+                    item = decoded.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    completed = True
+                    break
+                if isinstance(item, _Failure):
+                    errors.append(item.error)
+                    break
+                if should_stop is not None and should_stop():
+                    break
+                slots.acquire()
+                if stop.is_set():
+                    slots.release()
+                    break
+                pending.put((item, pool.submit(process, item)))
+        finally:
+            pending.put(_DONE)
+            writer.join()
+            stop.set()
+            decoder.join()
+
+    if errors:
+        raise errors[0]
+    return completed
@@ -0,0 +1,99 @@
+"""Lazy frame sources for video2video.
+
+Every source yields ``(index, frame)`` pairs, where ``index`` is the zero-based
+frame number in the input and ``frame`` is an RGB ``numpy`` array. Sources
+only decode the requested ``[start, start + count)`` window: video sources
+seek to the nearest keyframe before ``start`` and stop once the window has
+been produced.
+"""
+
+from fractions import Fraction
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+Frame = Tuple[int, np.ndarray]
+
+
+def _in_window(index: int, start: int, count: Optional[int]) -> bool:
+    return index >= start and (count is None or index < start + count)
+
+
+def iter_video_frames(path: str, start: int = 0, count: Optional[int] = None) -> Iterator[Frame]:
+    """Decode only frames ``start``..``start + count - 1`` of a video file.
+
+    Frame indices are derived from presentation timestamps and the stream's
+    average frame rate. If the container cannot seek or the stream has no
+    usable timing information, frames are decoded from the beginning and
+    counted instead.
+    """
+    import av
+    import av.error
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        rate = stream.average_rate or stream.guessed_rate
+        time_base = stream.time_base
+        origin = stream.start_time or 0
+        timed = bool(rate) and time_base is not None
+
+        seeked = False
+        if start > 0 and timed:
+            target = origin + int(Fraction(start) / Fraction(rate) / Fraction(time_base))
+            try:
+                container.seek(target, stream=stream, backward=True, any_frame=False)
+                seeked = True
+            except av.error.FFmpegError:
+                container.seek(0)
+
+        counted = -1
+        for frame in container.decode(stream):
+            counted += 1
+            if seeked and frame.pts is not None:
+                index = round((frame.pts - origin) * time_base * rate)
+            elif seeked:
+                # Lost timing after seeking; restart and count frames instead.
+                container.seek(0)
+                yield from _count_frames(container, stream, start, count)
+                return
+            else:
+                index = counted
+            if count is not None and index >= start + count:
+                return
+            if _in_window(index, start, count):
+                yield index, frame.to_ndarray(format="rgb24")
+
+
+def _count_frames(container, stream, start, count):
+    for index, frame in window(container.decode(stream), start, count):
+        yield index, frame.to_ndarray(format="rgb24")
+
+
+def iter_image_frames(path: str, start: int = 0, count: Optional[int] = None) -> Iterator[Frame]:
+    """Yield frames of a (possibly animated) GIF, WebP, APNG or still image.
+
+    Frames are decoded one at a time and converted to RGB as they are
+    yielded, so memory use does not grow with the number of frames. Frames
+    before ``start`` are skipped with ``Image.seek`` instead of being copied.
+    """
+    from PIL import Image
+
+    with Image.open(path) as image:
+        total = getattr(image, "n_frames", 1)
+        end = total if count is None else min(total, start + count)
+        for index in range(max(0, start), end):
+            try:
+                image.seek(index)
+            except EOFError:
+                return
+            yield index, np.asarray(image.convert("RGB"))
+
+
+def window(frames, start: int = 0, count: Optional[int] = None) -> Iterator[Frame]:
+    """Number an iterable of frames and keep only the requested window."""
+    for index, frame in enumerate(frames):
+        if count is not None and index >= start + count:
+            return
+        if _in_window(index, start, count):
+            yield index, frame
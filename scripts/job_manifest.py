@@ -0,0 +1,129 @@
+"""Checkpoint manifest for resumable video2video jobs.
+
+The manifest lives in the job work directory as JSON lines: the first line
+holds the generation parameters and their hash, every following line records
+one finished frame file with its size and SHA-1. Appending a line per frame
+keeps checkpointing O(1); a line cut short by a crash is ignored on load.
+
+On restart the manifest is only trusted when the parameter hash matches, and
+each recorded frame is only reused when its file still has the recorded size
+and digest, so missing or corrupt frames are rendered again.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def params_hash(params: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_params(workdir: str, name: str = MANIFEST_NAME) -> Optional[Dict[str, Any]]:
+    """Parameters recorded by an earlier run in ``workdir``, if any."""
+    try:
+        with open(os.path.join(workdir, name)) as source:
+            return json.loads(source.readline())["params"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class JobManifest:
+    """Completed-frame checkpoint for one job and one set of parameters.
+
+    ``name`` is the manifest file name, so several workers sharing a work
+    directory can each keep their own.
+    """
+
+    def __init__(self, workdir: str, params: Dict[str, Any], name: str = MANIFEST_NAME):
+        self.workdir = workdir
+        self.path = os.path.join(workdir, name)
+        self.params = params
+        self.hash = params_hash(params)
+        self.completed: Dict[int, str] = {}
+        self._file = None
+
+    def load(self) -> int:
+        """Read an existing manifest and return how many frames can be reused.
+
+        A manifest written for different parameters is discarded.
+        """
+        self.completed = {}
+        records, valid = [], {}
+        try:
+            with open(self.path) as source:
+                lines = source.read().splitlines()
+        except OSError:
+            lines = []
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            header = {}
+        if header.get("hash") == self.hash:
+            for line in lines[1:]:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        for record in records:
+            try:
+                filename = os.path.join(self.workdir, record["file"])
+                intact = (os.path.getsize(filename) == record["size"]
+                          and file_digest(filename) == record["sha1"])
+            except (OSError, KeyError, TypeError):
+                continue
+            if intact:
+                self.completed[record["index"]] = filename
+                valid[record["index"]] = record
+            else:
+                self.completed.pop(record["index"], None)
+                valid.pop(record["index"], None)
+        self._rewrite(valid.values())
+        return len(self.completed)
+
+    def _rewrite(self, records):
+        """Start the manifest afresh with the header and ``records``."""
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as target:
+            target.write(json.dumps({"hash": self.hash, "params": self.params}, default=str) + "\n")
+            for record in records:
+                target.write(json.dumps(record) + "\n")
+        os.replace(temporary, self.path)
+
+    def is_done(self, index: int) -> bool:
+        return index in self.completed
+
+    def frame_path(self, index: int) -> str:
+        return self.completed[index]
+
+    def mark_done(self, index: int, filename: str):
+        """Record that frame ``index`` has been fully written to ``filename``."""
+        if self._file is None:
+            if not os.path.exists(self.path):
+                self._rewrite([])
+            self._file = open(self.path, "a")
+        record = {
+            "index": index,
+            "file": os.path.relpath(filename, self.workdir),
+            "size": os.path.getsize(filename),
+            "sha1": file_digest(filename),
+        }
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self.completed[index] = filename
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
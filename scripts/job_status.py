@@ -0,0 +1,182 @@
+"""Background job-state channel for the ``video_jobs`` table.
+
+Frame processing reports progress, ETA and preview URLs on every frame, and
+polls for an abort request before every batch. Doing each of those as its own
+synchronous query puts database latency on the frame critical path, so
+``JobStatusChannel`` coalesces column updates and writes them at most once per
+``flush_interval`` from a background thread, which also refreshes the job
+status every ``poll_interval``. Status changes (``error``, ``finished``, ...)
+are written immediately. A failed query drops the connection; the next attempt
+reconnects and pending values are kept until they are written.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+# Status before the first successful poll; None means the job row is missing
+_UNREAD = object()
+
+
+class JobStatusChannel:
+    """Throttled writer and cached status reader for one ``video_jobs`` row.
+
+    ``connect`` returns a new DB-API connection; ``errors`` are the exception
+    types that mean the connection or query failed. ``observer``, if given, is
+    called as ``observer(kind, started, seconds)`` after every successful
+    ``"write"`` or ``"read"`` query, with ``time.perf_counter()`` times. With
+    no ``job_id`` every call is a no-op and no connection is made.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        job_id: Optional[int],
+        flush_interval: float = 2.0,
+        poll_interval: float = 2.0,
+        errors: Tuple[Type[BaseException], ...] = (Exception,),
+        table: str = "video_jobs",
+        observer: Optional[Callable[[str, float, float], None]] = None,
+    ):
+        self.connect = connect
+        self.job_id = job_id
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.errors = errors
+        self.table = table
+        self.observer = observer
+        self.writes = 0
+        self.reads = 0
+        self._connection = None
+        self._db_lock = threading.RLock()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Any] = {}
+        self._status: Any = _UNREAD
+        self._stop = threading.Event()
+        self._thread = None
+        if self.enabled:
+            self._thread = threading.Thread(target=self._run, name="job-status", daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self) -> bool:
+        return self.job_id is not None and self.job_id > 0
+
+    def _execute(self, query: str, params, fetch: bool = False):
+        """Run one query, reconnecting first if the last one failed."""
+        with self._db_lock:
+            started = time.perf_counter()
+            try:
+                if self._connection is None:
+                    self._connection = self.connect()
+                cursor = self._connection.cursor()
+                cursor.execute(query, params)
+                row = cursor.fetchone() if fetch else None
+                if not fetch:
+                    self._connection.commit()
+                cursor.close()
+            except self.errors:
+                self._disconnect()
+                raise
+            if fetch:
+                self.reads += 1
+            else:
+                self.writes += 1
+            if self.observer is not None:
+                self.observer("read" if fetch else "write", started, time.perf_counter() - started)
+            return row
+
+    def _disconnect(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except self.errors:
+                pass
+
+    def _write(self, columns: Dict[str, Any]):
+        assignments = ", ".join("{0} = %s".format(name) for name in columns)
+        query = "UPDATE {0} SET {1} WHERE id = %s".format(self.table, assignments)
+        self._execute(query, (*columns.values(), self.job_id))
+
+    def update(self, **columns):
+        """Queue column values; later values for a column replace earlier ones."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending.update(columns)
+
+    def flush(self) -> bool:
+        """Write queued values now; returns False if the write failed."""
+        with self._db_lock:
+            with self._lock:
+                columns, self._pending = self._pending, {}
+            if not columns:
+                return True
+            try:
+                self._write(columns)
+            except self.errors as err:
+                print(f"Failed to update database: {err}")
+                with self._lock:
+                    # Keep anything queued meanwhile, it is newer
+                    self._pending = {**columns, **self._pending}
+                return False
+            return True
+
+    def poll(self):
+        """Refresh the cached job status from the database."""
+        try:
+            row = self._execute(
+                "SELECT status FROM {0} WHERE id = %s".format(self.table), (self.job_id,), fetch=True)
+        except self.errors as err:
+            print(f"Failed to get status: {err}")
+            return None if self._status is _UNREAD else self._status
+        self._status = row[0] if row else None
+        return self._status
+
+    def get_status(self):
+        """Last polled status; polls synchronously if none has been read yet.
+
+        A missing job row reads as None and is cached like any other status.
+        """
+        if not self.enabled:
+            return None
+        if self._status is _UNREAD:
+            return self.poll()
+        return self._status
+
+    def is_aborted(self) -> bool:
+        return self.get_status() == "aborted"
+
+    def set_status(self, status: str, **columns) -> bool:
+        """Write ``status`` (with any queued values) immediately."""
+        if not self.enabled:
+            return True
+        self.update(status=status, **columns)
+        for _ in range(2):
+            if self.flush():
+                self._status = status
+                return True
+        return False
+
+    def _run(self):
+        tick = max(0.05, min(self.flush_interval, self.poll_interval) / 2)
+        last_flush = last_poll = time.monotonic()
+        while not self._stop.wait(tick):
+            now = time.monotonic()
+            if now - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = now
+            if now - last_poll >= self.poll_interval:
+                self.poll()
+                last_poll = now
+
+    def close(self):
+        """Stop the background thread, write anything still queued and disconnect."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.flush()
+        with self._db_lock:
+            self._disconnect()
@@ -0,0 +1,199 @@
+"""Per-stage timeline of one video2video job.
+
+Every stage of the job (probe, decode, the phases of each img2img request,
+writes, database updates, video encoding) is recorded as a span with its
+start time, duration, thread and the frame it belongs to. ``write`` saves the
+spans in Chrome trace format (open it in chrome://tracing or Perfetto) and
+``summary`` reduces them to p50/p95 durations per stage, frames per second
+and how long the GPU sat idle, i.e. no img2img request of the job was
+waiting on a server.
+
+Request phases arrive through ``RequestMetrics`` callbacks in the thread
+that made the request; ``frame`` tells the trace which frame that thread is
+working on.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+# RequestMetrics phases and the stage each one is recorded as
+REQUEST_STAGES = {
+    "encode": "encode",
+    "serialize": "serialize",
+    "wait": "http_wait",
+    "download": "download",
+    "parse": "parse",
+    "decode": "result_decode",
+}
+# Stage during which a server's GPU is busy with one of the job's requests
+GPU_STAGE = "http_wait"
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    """Nearest-rank ``q`` quantile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+
+
+def _covered(intervals: List[List[float]]) -> float:
+    """Total length of the union of ``[start, end]`` intervals."""
+    covered, reach = 0.0, None
+    for start, end in sorted(intervals):
+        if reach is None or start > reach:
+            covered += end - start
+            reach = end
+        elif end > reach:
+            covered += end - reach
+            reach = end
+    return covered
+
+
+class JobTrace:
+    """Thread-safe span recorder for one job.
+
+    ``labels`` (e.g. the job id) are stored with the trace and the summary.
+    ``clock`` must be the clock the request timings use.
+    """
+
+    def __init__(self, labels: Optional[Dict[str, Any]] = None,
+                 clock: Callable[[], float] = time.perf_counter):
+        self.labels = dict(labels or {})
+        self.clock = clock
+        self.started = clock()
+        self.frames = 0
+        self._spans: List[Dict[str, Any]] = []
+        self._threads: Dict[int, str] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, start: float, seconds: float, frame: Optional[int] = None):
+        """Record that ``stage`` ran for ``seconds`` from ``start`` (a ``clock`` value)."""
+        thread = threading.current_thread()
+        if frame is None:
+            frame = getattr(self._local, "frame", None)
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self._spans.append({"stage": stage, "start": start, "seconds": seconds,
+                                "frame": frame, "thread": thread.ident})
+
+    @contextlib.contextmanager
+    def span(self, stage: str, frame: Optional[int] = None):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(stage, start, self.clock() - start, frame)
+
+    @contextlib.contextmanager
+    def frame(self, index: int):
+        """Attribute spans recorded by this thread to frame ``index``."""
+        previous = getattr(self._local, "frame", None)
+        self._local.frame = index
+        try:
+            yield
+        finally:
+            self._local.frame = previous
+
+    def iterate(self, stage: str, items: Iterable,
+                frame: Optional[Callable[[Any], int]] = None) -> Iterator:
+        """Yield from ``items``, recording the time taken to produce each item.
+
+        ``frame(item)`` gives the frame an item belongs to (default: ``item[0]``).
+        """
+        iterator = iter(items)
+        while True:
+            start = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, start, self.clock() - start, frame(item) if frame else item[0])
+            yield item
+
+    def frame_done(self):
+        with self._lock:
+            self.frames += 1
+
+    def record_request(self, record: Dict[str, Any]):
+        """``RequestMetrics`` callback: lay out one request's phases from its start."""
+        start = record.get("started")
+        if start is None:
+            return
+        phases = record["phases"]
+        if "total" in phases:
+            self.add(record["endpoint"], start, phases["total"])
+        for phase, seconds in phases.items():
+            stage = REQUEST_STAGES.get(phase)
+            if stage is not None:
+                self.add(stage, start, seconds)
+                start += seconds
+
+    def record_query(self, kind: str, start: float, seconds: float):
+        """``JobStatusChannel`` observer: database writes and status polls."""
+        self.add("db_update" if kind == "write" else "db_poll", start, seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = list(self._spans)
+            frames = self.frames
+        elapsed = self.clock() - self.started
+        durations: Dict[str, List[float]] = {}
+        for span in spans:
+            durations.setdefault(span["stage"], []).append(span["seconds"])
+        stages = {}
+        for stage, values in sorted(durations.items()):
+            values.sort()
+            stages[stage] = {
+                "count": len(values),
+                "total": round(sum(values), 6),
+                "p50": round(_percentile(values, 0.5), 6),
+                "p95": round(_percentile(values, 0.95), 6),
+            }
+        busy = _covered([[span["start"], span["start"] + span["seconds"]]
+                         for span in spans if span["stage"] == GPU_STAGE])
+        return {
+            **self.labels,
+            "elapsed": round(elapsed, 3),
+            "frames": frames,
+            "frames_per_second": round(frames / elapsed, 3) if elapsed > 0 else 0.0,
+            "gpu_idle": round(max(0.0, elapsed - busy), 3),
+            "gpu_idle_ratio": round(max(0.0, 1 - busy / elapsed), 4) if elapsed > 0 else 0.0,
+            "stages": stages,
+        }
+
+    def to_chrome(self) -> Dict[str, Any]:
+        """The trace as a Chrome trace event JSON object (microsecond timestamps)."""
+        with self._lock:
+            spans = list(self._spans)
+            threads = dict(self._threads)
+        process = self.labels.get("job_id") or os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": process, "tid": ident, "args": {"name": name}}
+                  for ident, name in threads.items()]
+        for span in spans:
+            event = {
+                "name": span["stage"],
+                "cat": "video2video",
+                "ph": "X",
+                "ts": round((span["start"] - self.started) * 1e6, 1),
+                "dur": round(span["seconds"] * 1e6, 1),
+                "pid": process,
+                "tid": span["thread"],
+            }
+            if span["frame"] is not None:
+                event["args"] = {"frame": span["frame"]}
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.summary()}
+
+    def write(self, path: str, summary_path: Optional[str] = None):
+        """Atomically write the Chrome trace to ``path`` and the summary to ``summary_path``."""
+        outputs = [(path, self.to_chrome())]
+        if summary_path is not None:
+            outputs.append((summary_path, self.summary()))
+        for target_path, content in outputs:
+            temporary = target_path + ".tmp"
+            with open(temporary, "w") as target:
+                json.dump(content, target)
+            os.replace(temporary, target_path)
@@ -0,0 +1,151 @@
+"""Incremental animated PNG preview for video2video.
+
+Each processed frame is downscaled, PNG-compressed once and appended to an
+open spool file as ready-made APNG frame chunks. Publishing a snapshot only
+copies the spool between a fresh header and trailer and atomically renames
+the result over the preview path, so no earlier frame is ever decoded or
+re-encoded again. The ping-pong tail (frames played back in reverse) is
+added once, when the preview is finished.
+"""
+
+import io
+import os
+import struct
+import tempfile
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def _png_parts(image: Image.Image) -> Tuple[bytes, bytes]:
+    """Encode ``image`` as PNG and return its IHDR payload and joined IDAT data."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=6)
+    data = buffer.getvalue()
+    header, idat = b"", []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        (length,) = struct.unpack(">I", data[position:position + 4])
+        kind = data[position + 4:position + 8]
+        payload = data[position + 8:position + 8 + length]
+        if kind == b"IHDR":
+            header = payload
+        elif kind == b"IDAT":
+            idat.append(payload)
+        position += 12 + length
+    return header, b"".join(idat)
+
+
+class AnimatedPreviewWriter:
+    """Append frames to an animated PNG preview and publish snapshots of it.
+
+    ``max_size`` bounds the longest edge of preview frames, ``delay_ms`` is
+    the display time of each frame and ``publish_every`` is how many appended
+    frames pass between snapshots (the first frame is always published).
+    """
+
+    def __init__(self, output_path: str, max_size: int = 256, delay_ms: int = 100,
+                 publish_every: int = 1, ping_pong: bool = True):
+        self.output_path = output_path
+        self.max_size = max_size
+        self.delay_ms = delay_ms
+        self.publish_every = max(1, publish_every)
+        self.ping_pong = ping_pong
+        self.size: Optional[Tuple[int, int]] = None
+        self._header = b""
+        self._frames: List[Tuple[int, int]] = []  # (offset, length) of each frame's image data
+        self._sequence = 0
+        self._chunk_frames = 0
+        self._spool = tempfile.TemporaryFile()
+
+    @property
+    def frame_count(self) -> int:
+        return self._chunk_frames
+
+    def _prepare(self, frame) -> Image.Image:
+        image = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+        image = image.convert("RGB")
+        if self.size is None:
+            image.thumbnail((self.max_size, self.max_size))
+            self.size = image.size
+        elif image.size != self.size:
+            image = image.resize(self.size)
+        return image
+
+    def _frame_control(self) -> bytes:
+        width, height = self.size
+        control = struct.pack(">IIIIIHHBB", self._sequence, width, height, 0, 0,
+                              self.delay_ms, 1000, 0, 0)
+        self._sequence += 1
+        return _chunk(b"fcTL", control)
+
+    def _append_chunks(self, data: bytes) -> int:
+        """Write one frame's chunks to the spool; returns the offset of ``data``."""
+        chunks = self._frame_control()
+        if self._chunk_frames == 0:
+            chunks += _chunk(b"IDAT", data)
+        else:
+            chunks += _chunk(b"fdAT", struct.pack(">I", self._sequence) + data)
+            self._sequence += 1
+        self._spool.seek(0, os.SEEK_END)
+        # The image data is followed only by the chunk's 4-byte CRC
+        offset = self._spool.tell() + len(chunks) - len(data) - 4
+        self._spool.write(chunks)
+        self._chunk_frames += 1
+        return offset
+
+    def append(self, frame) -> bool:
+        """Add a frame; returns True when a new snapshot was published."""
+        header, data = _png_parts(self._prepare(frame))
+        self._header = self._header or header
+        self._frames.append((self._append_chunks(data), len(data)))
+        if len(self._frames) == 1 or len(self._frames) % self.publish_every == 0:
+            self.publish()
+            return True
+        return False
+
+    def publish(self):
+        """Atomically replace ``output_path`` with the frames appended so far."""
+        if not self._frames:
+            return
+        # A plain open() gives the file the usual umask-based mode, so the web
+        # server serving --preview_url can read it
+        temporary = self.output_path + ".tmp"
+        try:
+            with open(temporary, "wb") as target:
+                target.write(PNG_SIGNATURE)
+                target.write(_chunk(b"IHDR", self._header))
+                target.write(_chunk(b"acTL", struct.pack(">II", self._chunk_frames, 0)))
+                self._spool.seek(0)
+                while True:
+                    block = self._spool.read(1 << 20)
+                    if not block:
+                        break
+                    target.write(block)
+                target.write(_chunk(b"IEND", b""))
+            os.replace(temporary, self.output_path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def finish(self):
+        """Add the ping-pong tail if enabled, publish the final preview and close."""
+        if self.ping_pong and len(self._frames) > 1:
+            # Reuse the already compressed image data of each frame
+            for offset, length in self._frames[-2::-1]:
+                self._spool.seek(offset)
+                self._append_chunks(self._spool.read(length))
+        self.publish()
+        self.close()
+
+    def close(self):
+        self._spool.close()
@@ -0,0 +1,168 @@
+"""Split one video2video job across several worker processes by frame range.
+
+The coordinator (``video2video.py --shards N``) works out the job's frame
+window once, starts one worker per shard with ``--shard I/N`` and the window,
+and each worker renders its slice of the window into the shared job work
+directory. Workers report progress through small JSON files next to the
+frames (``shard-I-of-N.json``), so shards on other machines sharing
+``/opt/jobs`` are tracked the same way as local ones. The coordinator sums
+those files into the job's progress and assembles the video once every shard
+has finished.
+"""
+
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+SHARD_DONE = "done"
+SHARD_RUNNING = "running"
+SHARD_ABORTED = "aborted"
+STOPPED = "stopped"
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse ``I/N`` (zero-based shard index and shard count)."""
+    index, _, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError("Expected a shard as INDEX/COUNT, got {0!r}".format(value))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard index must be in 0..{0}, got {1!r}".format(count - 1, value))
+    return index, count
+
+
+def parse_window(value: str) -> Tuple[int, int]:
+    """Parse ``START:AMOUNT`` for the whole job's frame window."""
+    start, _, amount = value.partition(":")
+    try:
+        return int(start), int(amount)
+    except ValueError:
+        raise ValueError("Expected a frame window as START:AMOUNT, got {0!r}".format(value))
+
+
+def shard_range(start: int, amount: int, index: int, count: int) -> Tuple[int, int]:
+    """``(start, amount)`` of shard ``index`` when splitting a window into ``count`` shards.
+
+    Shards are contiguous and differ in size by at most one frame; the
+    earlier shards take the remainder.
+    """
+    size, remainder = divmod(amount, count)
+    shard_start = start + index * size + min(index, remainder)
+    return shard_start, size + (1 if index < remainder else 0)
+
+
+def progress_path(workdir: str, index: int, count: int) -> str:
+    return os.path.join(workdir, "shard-{0}-of-{1}.json".format(index, count))
+
+
+def manifest_name(index: int, count: int) -> str:
+    """Resume manifest file name for one shard (see ``job_manifest``)."""
+    return "manifest-shard-{0}-of-{1}.jsonl".format(index, count)
+
+
+def read_progress(workdir: str, count: int) -> List[Optional[Dict]]:
+    """Last reported progress of every shard, None for shards that have not reported."""
+    reports = []
+    for index in range(count):
+        try:
+            with open(progress_path(workdir, index, count)) as source:
+                reports.append(json.load(source))
+        except (OSError, ValueError):
+            reports.append(None)
+    return reports
+
+
+class ShardReporter:
+    """Writes one shard's progress file, at most once per ``interval`` seconds."""
+
+    def __init__(self, workdir: str, index: int, count: int, total: int, interval: float = 1.0):
+        self.path = progress_path(workdir, index, count)
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._written = 0.0
+        self._write(SHARD_RUNNING)
+
+    def _write(self, state: str):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as target:
+            json.dump({"done": self.done, "total": self.total, "state": state,
+                       "updated": time.time()}, target)
+        os.replace(temporary, self.path)
+        self._written = time.monotonic()
+
+    def update(self, done: int):
+        self.done = done
+        if time.monotonic() - self._written >= self.interval:
+            self._write(SHARD_RUNNING)
+
+    def finish(self, state: str = SHARD_DONE):
+        self._write(state)
+
+
+def strip_options(argv: Sequence[str], names: Sequence[str]) -> List[str]:
+    """Remove ``--name value`` and ``--name=value`` occurrences of ``names`` from ``argv``."""
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        name = arg.split("=", 1)[0]
+        if name in names:
+            skip = "=" not in arg
+            continue
+        stripped.append(arg)
+    return stripped
+
+
+def shard_command(script: str, worker_args: Sequence[str], index: int, count: int,
+                  window: Tuple[int, int], host: Optional[str] = None,
+                  launcher: str = "ssh {host}") -> List[str]:
+    """Command line that runs shard ``index``, locally or on ``host`` via ``launcher``."""
+    args = [*worker_args, "--shard", "{0}/{1}".format(index, count),
+            "--shard_window", "{0}:{1}".format(*window)]
+    if host is None:
+        return [sys.executable, script, *args]
+    # The remote shell parses the command again, so pass it as one quoted string
+    return [*shlex.split(launcher.format(host=host)), shlex.join(["python3", script, *args])]
+
+
+def summarize(reports: Sequence[Optional[Dict]], totals: Sequence[int]) -> Tuple[int, int]:
+    """Frames done and frames in total across shards."""
+    done = sum(report["done"] for report in reports if report)
+    return done, sum(totals)
+
+
+def supervise(processes: Sequence[subprocess.Popen], poll: Callable[[], None],
+              should_stop: Callable[[], bool], interval: float = 2.0) -> Union[int, str, None]:
+    """Wait for every shard process, calling ``poll`` every ``interval`` seconds.
+
+    Returns None when all shards exited successfully, otherwise the failing
+    exit code, or ``STOPPED`` when ``should_stop`` asked to stop. Remaining
+    shards are terminated on failure or stop.
+    """
+    result = None
+    while True:
+        codes = [process.poll() for process in processes]
+        poll()
+        failed = [code for code in codes if code not in (None, 0)]
+        if failed:
+            result = failed[0]
+        elif should_stop():
+            result = STOPPED
+        elif all(code == 0 for code in codes):
+            return None
+        if result is not None:
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+            for process in processes:
+                process.wait()
+            return result
+        time.sleep(interval)
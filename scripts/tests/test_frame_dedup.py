@@ -0,0 +1,74 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import frame_dedup  # noqa: E402
+
+
+def gradient(offset=0, noise=0.0):
+    x = np.linspace(0, 200, 64, dtype=np.float32)
+    frame = np.stack([x[None, :] + x[:, None] * 0.2] * 3, axis=-1) + offset
+    if noise:
+        frame += np.random.default_rng(0).normal(0, noise, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def test_near_identical_frame_reuses_output_for_same_seed():
+    dedup = frame_dedup.FrameDeduplicator(threshold=2.0)
+    dedup.add(dedup.signature(gradient()), 7, "output")
+
+    assert dedup.lookup(dedup.signature(gradient(noise=1.0)), 7) == "output"
+    assert dedup.lookup(dedup.signature(gradient()), 8) is None
+    assert dedup.stats() == {"frames": 2, "skipped": 1, "skip_ratio": 0.5}
+
+
+def test_changed_frame_is_not_reused():
+    dedup = frame_dedup.FrameDeduplicator(threshold=2.0)
+    dedup.add(dedup.signature(gradient()), 7, "output")
+
+    assert dedup.lookup(dedup.signature(gradient(offset=20)), 7) is None
+    assert dedup.lookup(dedup.signature(gradient()[:, ::-1]), 7) is None
+
+
+def test_only_recent_outputs_are_kept():
+    dedup = frame_dedup.FrameDeduplicator(capacity=2)
+    frames = [gradient(offset=40 * n) for n in range(3)]
+    for n, frame in enumerate(frames):
+        dedup.add(dedup.signature(frame), 1, n)
+
+    assert dedup.lookup(dedup.signature(frames[0]), 1) is None
+    assert dedup.lookup(dedup.signature(frames[2]), 1) == 2
+
+
+def test_difference_hash_is_64_bit_and_stable():
+    frame = gradient()
+    assert frame_dedup.difference_hash(frame) == frame_dedup.difference_hash(frame.copy())
+    assert 0 <= frame_dedup.difference_hash(frame) < 2 ** 64
+
+
+def test_claimed_frame_is_waited_for_or_handed_back():
+    import threading
+
+    dedup = frame_dedup.FrameDeduplicator()
+    signature = dedup.signature(gradient())
+    output, claim = dedup.claim(signature, 7)
+    assert output is None and claim is not None
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(dedup.claim(dedup.signature(gradient(noise=1.0)), 7)))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+    dedup.add(signature, 7, "output", claim)
+    waiter.join(5)
+    assert results == [("output", None)]
+
+    # A released claim lets the next frame render it itself
+    _, claim = dedup.claim(dedup.signature(gradient(offset=60)), 7)
+    dedup.release(claim)
+    output, claim = dedup.claim(dedup.signature(gradient(offset=60)), 7)
+    assert output is None and claim is not None
@@ -0,0 +1,56 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import frame_interpolation  # noqa: E402
+
+
+def square_at(x, size=64, value=200):
+    frame = np.zeros((size, size, 3), dtype=np.uint8)
+    frame[16:32, x:x + 16] = value
+    return frame
+
+
+def test_crossfade_steps_evenly_between_keyframes():
+    previous = np.zeros((4, 4, 3), dtype=np.uint8)
+    following = np.full((4, 4, 3), 120, dtype=np.uint8)
+
+    frames = frame_interpolation.crossfade(previous, following, 3)
+
+    assert [int(frame[0, 0, 0]) for frame in frames] == [30, 60, 90]
+
+
+def test_block_motion_finds_shift():
+    reference = square_at(16)[..., 0].astype(np.float32)
+    target = square_at(24)[..., 0].astype(np.float32)
+
+    shifts, errors = frame_interpolation.block_motion(reference, target, block=16, radius=8, step=4)
+
+    assert tuple(shifts[1, 2]) == (0, 8)
+    assert errors[1, 2] == 0
+
+
+def test_motion_blend_follows_moving_object():
+    # Keyframe outputs are the sources in another colour channel
+    previous_source, following_source = square_at(8), square_at(40)
+    previous = np.roll(previous_source, 1, axis=2)
+    following = np.roll(following_source, 1, axis=2)
+
+    (middle,) = frame_interpolation.motion_blend(
+        previous, following, previous_source, following_source, [square_at(24)], block=8)
+
+    assert middle[24, 28, 1] > 150  # square moved to the middle
+    assert middle[24, 12, 1] < 50 and middle[24, 44, 1] < 50  # not ghosted at either end
+
+
+def test_scene_cut_and_unknown_method():
+    dark, bright = np.zeros((64, 64, 3), np.uint8), np.full((64, 64, 3), 255, np.uint8)
+    assert frame_interpolation.is_scene_cut(dark, bright, 20)
+    assert not frame_interpolation.is_scene_cut(square_at(8), square_at(8), 20)
+    with pytest.raises(ValueError):
+        frame_interpolation.interpolate("optical", None, None, None, None, [1])
@@ -0,0 +1,73 @@
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import frame_pipeline  # noqa: E402
+
+
+def test_results_are_written_in_input_order_with_overlap():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def process(item):
+        with lock:
+            active.append(item)
+            peak.append(len(active))
+        time.sleep(random.uniform(0.001, 0.02))
+        with lock:
+            active.remove(item)
+        return item * 10
+
+    written = []
+    completed = frame_pipeline.run_pipeline(
+        range(40), process, lambda item, result: written.append((item, result)), inflight=4
+    )
+
+    assert completed is True
+    assert written == [(i, i * 10) for i in range(40)]
+    assert 1 < max(peak) <= 4
+
+
+def test_should_stop_finishes_started_items_and_reports_abort():
+    checks = []
+
+    def should_stop():
+        checks.append(1)
+        return len(checks) > 5
+
+    written = []
+    completed = frame_pipeline.run_pipeline(
+        range(100), lambda item: item, lambda item, result: written.append(item), inflight=2, should_stop=should_stop
+    )
+
+    assert completed is False
+    assert written == list(range(5))
+
+
+@pytest.mark.parametrize("stage", ["items", "process", "write"])
+def test_errors_in_any_stage_are_raised(stage):
+    def items():
+        for i in range(20):
+            if stage == "items" and i == 7:
+                raise ValueError("decode failed")
+            yield i
+
+    def process(item):
+        if stage == "process" and item == 7:
+            raise ValueError("request failed")
+        return item
+
+    def write(item, result):
+        if stage == "write" and item == 7:
+            raise ValueError("write failed")
+
+    with pytest.raises(ValueError):
+        frame_pipeline.run_pipeline(items(), process, write, inflight=3)
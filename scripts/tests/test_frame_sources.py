@@ -0,0 +1,104 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import frame_sources  # noqa: E402
+
+
+def write_numbered_video(path, frames=60, fps=10, gop=12):
+    """Encode a video whose frame N has every pixel set to 4 * N."""
+    av = pytest.importorskip("av")
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("mpeg4", rate=fps)
+        stream.width, stream.height = 32, 32
+        stream.pix_fmt = "yuv420p"
+        stream.codec_context.gop_size = gop
+        stream.bit_rate = 20_000_000
+        for n in range(frames):
+            image = np.full((32, 32, 3), 4 * n, dtype=np.uint8)
+            frame = av.VideoFrame.from_ndarray(image, format="rgb24")
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode())
+
+
+def looks_like_frame(frame, n):
+    # mpeg4 is lossy, so allow a little drift around the encoded value
+    return abs(frame.mean() - 4 * n) < 2
+
+
+def test_video_window_seeks_and_stops_early(tmp_path):
+    path = tmp_path / "numbered.mp4"
+    write_numbered_video(path)
+
+    frames = list(frame_sources.iter_video_frames(str(path), start=30, count=5))
+
+    assert [index for index, _ in frames] == [30, 31, 32, 33, 34]
+    assert all(looks_like_frame(frame, index) for index, frame in frames)
+    assert frames[0][1].shape == (32, 32, 3)
+
+
+def test_video_window_without_limits_reads_everything(tmp_path):
+    path = tmp_path / "numbered.mp4"
+    write_numbered_video(path, frames=15)
+
+    indices = [index for index, _ in frame_sources.iter_video_frames(str(path))]
+
+    assert indices == list(range(15))
+
+
+def test_counting_fallback_decodes_only_up_to_the_window(tmp_path):
+    import av
+
+    path = tmp_path / "numbered.mp4"
+    write_numbered_video(path, frames=15)
+
+    with av.open(str(path)) as container:
+        frames = list(frame_sources._count_frames(container, container.streams.video[0], 3, 2))
+
+    assert [index for index, _ in frames] == [3, 4]
+    assert all(looks_like_frame(frame, index) for index, frame in frames)
+
+
+def test_window_numbers_and_limits_any_iterable():
+    consumed = []
+
+    def frames():
+        for n in range(100):
+            consumed.append(n)
+            yield n
+
+    assert list(frame_sources.window(frames(), start=3, count=2)) == [(3, 3), (4, 4)]
+    assert consumed == [0, 1, 2, 3, 4, 5]
+
+
+def write_numbered_gif(path, frames=20):
+    from PIL import Image
+
+    images = [Image.new("RGB", (16, 16), color=(4 * n, 0, 0)) for n in range(frames)]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=40, loop=0)
+
+
+def test_image_window_yields_rgb_frames_lazily(tmp_path):
+    path = tmp_path / "numbered.gif"
+    write_numbered_gif(path)
+
+    frames = frame_sources.iter_image_frames(str(path), start=5, count=3)
+    index, frame = next(frames)
+
+    assert index == 5
+    assert frame.shape == (16, 16, 3)
+    assert frame[0, 0, 0] == 20
+    assert [index for index, _ in frames] == [6, 7]
+
+
+def test_image_window_clamps_to_available_frames(tmp_path):
+    path = tmp_path / "numbered.gif"
+    write_numbered_gif(path, frames=4)
+
+    assert [index for index, _ in frame_sources.iter_image_frames(str(path), start=2)] == [2, 3]
+    assert list(frame_sources.iter_image_frames(str(path), start=10, count=5)) == []
@@ -0,0 +1,61 @@
+import sys
+from pathlib import Path
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import job_manifest  # noqa: E402
+
+PARAMS = {"prompt": "a cat", "seed": 42, "steps": 20}
+
+
+def write_frames(workdir, manifest, indices):
+    for index in indices:
+        filename = workdir / "frame-{0:04d}.png".format(index)
+        filename.write_bytes(b"frame %d" % index)
+        manifest.mark_done(index, str(filename))
+
+
+def test_resume_reuses_recorded_frames(tmp_path):
+    manifest = job_manifest.JobManifest(str(tmp_path), PARAMS)
+    assert manifest.load() == 0
+    write_frames(tmp_path, manifest, [1, 2, 3])
+    manifest.close()
+
+    resumed = job_manifest.JobManifest(str(tmp_path), dict(PARAMS))
+
+    assert resumed.load() == 3
+    assert resumed.is_done(2) and not resumed.is_done(4)
+    assert resumed.frame_path(3) == str(tmp_path / "frame-0003.png")
+    assert job_manifest.read_params(str(tmp_path)) == PARAMS
+
+
+def test_missing_corrupt_and_truncated_entries_are_redone(tmp_path):
+    manifest = job_manifest.JobManifest(str(tmp_path), PARAMS)
+    manifest.load()
+    write_frames(tmp_path, manifest, [1, 2, 3])
+    manifest.close()
+    (tmp_path / "frame-0001.png").unlink()
+    (tmp_path / "frame-0002.png").write_bytes(b"frame X")
+    with open(tmp_path / job_manifest.MANIFEST_NAME, "a") as target:
+        target.write('{"index": 4, "fi')
+
+    resumed = job_manifest.JobManifest(str(tmp_path), PARAMS)
+
+    assert resumed.load() == 1
+    assert sorted(resumed.completed) == [3]
+    write_frames(tmp_path, resumed, [1])
+    resumed.close()
+    assert job_manifest.JobManifest(str(tmp_path), PARAMS).load() == 2
+
+
+def test_changed_parameters_discard_the_checkpoint(tmp_path):
+    manifest = job_manifest.JobManifest(str(tmp_path), PARAMS)
+    manifest.load()
+    write_frames(tmp_path, manifest, [1, 2])
+    manifest.close()
+
+    changed = job_manifest.JobManifest(str(tmp_path), {**PARAMS, "prompt": "a dog"})
+
+    assert changed.load() == 0
+    assert job_manifest.read_params(str(tmp_path))["prompt"] == "a dog"
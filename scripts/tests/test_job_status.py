@@ -0,0 +1,164 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import job_status  # noqa: E402
+
+
+class FakeDBError(Exception):
+    pass
+
+
+class FakeDatabase:
+    """Records executed queries; ``fail`` makes the next N queries raise."""
+
+    def __init__(self, status="processing"):
+        self.status = status
+        self.queries = []
+        self.connects = 0
+        self.fail = 0
+
+    def connect(self):
+        self.connects += 1
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+
+    def execute(self, query, params):
+        if self.database.fail:
+            self.database.fail -= 1
+            raise FakeDBError("gone away")
+        self.database.queries.append((query, params))
+
+    def fetchone(self):
+        # A status of None stands for a missing job row
+        return None if self.database.status is None else (self.database.status,)
+
+    def close(self):
+        pass
+
+
+def make_channel(database, **kwargs):
+    kwargs.setdefault("flush_interval", 60)
+    kwargs.setdefault("poll_interval", 60)
+    return job_status.JobStatusChannel(database.connect, 7, errors=(FakeDBError,), **kwargs)
+
+
+def test_updates_are_coalesced_into_one_write():
+    database = FakeDatabase()
+    channel = make_channel(database)
+
+    for progress in range(50):
+        channel.update(progress=progress, estimated_time_Left=100 - progress)
+    channel.update(preview_img="a.png")
+    channel.close()
+
+    assert database.queries == [
+        ("UPDATE video_jobs SET progress = %s, estimated_time_Left = %s, preview_img = %s WHERE id = %s",
+         (49, 51, "a.png", 7)),
+    ]
+
+
+def test_background_thread_flushes_and_polls_abort():
+    database = FakeDatabase()
+    channel = make_channel(database, flush_interval=0.05, poll_interval=0.05)
+    channel.update(progress=10)
+    assert not channel.is_aborted()
+
+    database.status = "aborted"
+    deadline = time.time() + 2
+    while not channel.is_aborted() and time.time() < deadline:
+        time.sleep(0.02)
+
+    assert channel.is_aborted()
+    assert any(params == (10, 7) for _, params in database.queries)
+    channel.close()
+
+
+def test_failed_write_reconnects_and_keeps_pending_values():
+    database = FakeDatabase()
+    channel = make_channel(database)
+    channel.update(progress=10)
+    database.fail = 1
+
+    assert channel.flush() is False
+    channel.update(progress=20, estimated_time_Left=5)
+    assert channel.flush() is True
+
+    assert database.connects == 2
+    assert database.queries[-1][1] == (20, 5, 7)
+    channel.close()
+
+
+def test_set_status_writes_immediately_with_retry():
+    database = FakeDatabase()
+    channel = make_channel(database)
+    database.fail = 1
+
+    assert channel.set_status("finished", progress=100)
+    assert database.queries == [
+        ("UPDATE video_jobs SET status = %s, progress = %s WHERE id = %s", ("finished", 100, 7)),
+    ]
+    channel.close()
+
+
+def test_missing_job_row_is_polled_once():
+    database = FakeDatabase(status=None)
+    channel = make_channel(database)
+
+    for _ in range(10):
+        assert not channel.is_aborted()
+    assert channel.get_status() is None
+
+    assert len(database.queries) == 1
+    channel.close()
+
+
+@pytest.mark.parametrize("job_id", [None, 0])
+def test_without_job_nothing_touches_the_database(job_id):
+    database = FakeDatabase()
+    channel = job_status.JobStatusChannel(database.connect, job_id)
+
+    channel.update(progress=1)
+    assert channel.set_status("error")
+    assert not channel.is_aborted()
+    channel.close()
+
+    assert database.connects == 0
+
+
+def test_observer_sees_every_successful_query():
+    database = FakeDatabase()
+    seen = []
+    channel = make_channel(database, observer=lambda kind, started, seconds: seen.append((kind, seconds >= 0)))
+    channel.update(progress=10)
+    database.fail = 1
+
+    assert channel.flush() is False
+    assert channel.flush() is True
+    channel.poll()
+    channel.close()
+
+    assert seen == [("write", True), ("read", True)]
@@ -0,0 +1,111 @@
+import json
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import job_trace  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_request_phases_are_laid_out_in_order_for_the_current_frame(clock):
+    trace = job_trace.JobTrace(clock=clock)
+
+    with trace.frame(7):
+        trace.record_request({"endpoint": "img2img", "started": 101.0,
+                              "phases": {"encode": 0.1, "serialize": 0.05, "wait": 2.0, "total": 2.5}})
+    trace.record_request({"endpoint": "img2img", "started": None, "phases": {"decode": 1.0}})
+
+    events = [event for event in trace.to_chrome()["traceEvents"] if event["ph"] == "X"]
+    assert [(event["name"], event["ts"], event["dur"]) for event in events] == [
+        ("img2img", 1e6, 2.5e6),
+        ("encode", 1e6, 0.1e6),
+        ("serialize", 1.1e6, 0.05e6),
+        ("http_wait", 1.15e6, 2e6),
+    ]
+    assert all(event["args"] == {"frame": 7} for event in events)
+
+
+def test_frames_are_attributed_per_thread(clock):
+    trace = job_trace.JobTrace(clock=clock)
+    seen = []
+
+    def worker():
+        trace.add("encode", 100.0, 1.0)
+        seen.append(True)
+
+    with trace.frame(3):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        trace.add("write", 100.0, 1.0)
+
+    frames = {event["name"]: event.get("args") for event in trace.to_chrome()["traceEvents"] if event["ph"] == "X"}
+    assert seen and frames == {"encode": None, "write": {"frame": 3}}
+
+
+def test_iterate_times_each_item(clock):
+    trace = job_trace.JobTrace(clock=clock)
+
+    def frames():
+        for index in range(3):
+            clock.now += 0.5
+            yield index, "frame"
+
+    assert list(trace.iterate("decode", frames(), frame=lambda item: item[0] + 1)) == [
+        (0, "frame"), (1, "frame"), (2, "frame")]
+    decode = trace.summary()["stages"]["decode"]
+    assert decode == {"count": 3, "total": 1.5, "p50": 0.5, "p95": 0.5}
+    assert [event["args"]["frame"] for event in trace.to_chrome()["traceEvents"] if event["ph"] == "X"] == [1, 2, 3]
+
+
+def test_summary_percentiles_throughput_and_gpu_idle(clock):
+    trace = job_trace.JobTrace(labels={"job_id": 5}, clock=clock)
+    for seconds in range(1, 21):
+        trace.add("write", 100.0, seconds / 100)
+    # Overlapping waits count once
+    trace.add("http_wait", 101.0, 4.0)
+    trace.add("http_wait", 103.0, 4.0)
+    for _ in range(5):
+        trace.frame_done()
+    clock.now = 110.0
+
+    summary = trace.summary()
+
+    assert summary["job_id"] == 5
+    assert summary["frames"] == 5 and summary["frames_per_second"] == 0.5
+    assert summary["stages"]["write"]["p50"] == 0.1 and summary["stages"]["write"]["p95"] == 0.19
+    assert summary["gpu_idle"] == 4.0 and summary["gpu_idle_ratio"] == 0.4
+
+
+def test_write_saves_trace_and_summary(tmp_path, clock):
+    trace = job_trace.JobTrace(labels={"job_id": 5}, clock=clock)
+    with trace.span("probe"):
+        clock.now += 1
+    trace.record_query("write", 100.5, 0.25)
+
+    trace.write(str(tmp_path / "5.trace.json"), str(tmp_path / "5.trace-summary.json"))
+
+    chrome = json.loads((tmp_path / "5.trace.json").read_text())
+    names = [event["name"] for event in chrome["traceEvents"]]
+    assert "thread_name" in names and "probe" in names and "db_update" in names
+    assert all(event["pid"] == 5 for event in chrome["traceEvents"])
+    summary = json.loads((tmp_path / "5.trace-summary.json").read_text())
+    assert summary["stages"]["probe"]["total"] == 1.0
+    assert chrome["otherData"] == summary
@@ -0,0 +1,76 @@
+import os
+import stat
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import preview_writer  # noqa: E402
+
+
+def numbered_frame(n, size=(64, 48)):
+    return np.full((size[1], size[0], 3), 10 * n, dtype=np.uint8)
+
+
+def read_frames(path):
+    with Image.open(path) as image:
+        frames = []
+        for index in range(image.n_frames):
+            image.seek(index)
+            frames.append(np.asarray(image.convert("RGB")))
+        return frames
+
+
+def test_snapshots_are_downscaled_and_published_at_cadence(tmp_path):
+    path = tmp_path / "preview.png"
+    writer = preview_writer.AnimatedPreviewWriter(str(path), max_size=32, publish_every=3)
+
+    published = [writer.append(numbered_frame(n)) for n in range(5)]
+
+    assert published == [True, False, True, False, False]
+    frames = read_frames(path)
+    assert len(frames) == 3
+    assert frames[0].shape == (24, 32, 3)
+    assert [frame[0, 0, 0] for frame in frames] == [0, 10, 20]
+    assert list(tmp_path.iterdir()) == [path]
+    writer.close()
+
+
+def test_finish_adds_ping_pong_tail(tmp_path):
+    path = tmp_path / "preview.png"
+    writer = preview_writer.AnimatedPreviewWriter(str(path), max_size=64, publish_every=100)
+    for n in range(4):
+        writer.append(numbered_frame(n))
+
+    writer.finish()
+
+    assert [frame[0, 0, 0] for frame in read_frames(path)] == [0, 10, 20, 30, 20, 10, 0]
+
+
+def test_finish_without_ping_pong_keeps_forward_frames(tmp_path):
+    path = tmp_path / "preview.png"
+    writer = preview_writer.AnimatedPreviewWriter(str(path), ping_pong=False)
+    writer.append(Image.new("RGBA", (16, 16), color=(50, 0, 0, 255)))
+    writer.append(Image.new("RGBA", (16, 16), color=(60, 0, 0, 255)))
+
+    writer.finish()
+
+    assert [frame[0, 0, 0] for frame in read_frames(path)] == [50, 60]
+
+
+def test_published_preview_is_readable_by_others(tmp_path):
+    path = tmp_path / "preview.png"
+    umask = os.umask(0o022)
+    try:
+        writer = preview_writer.AnimatedPreviewWriter(str(path))
+        writer.append(numbered_frame(1))
+        writer.finish()
+    finally:
+        os.umask(umask)
+
+    assert stat.S_IMODE(path.stat().st_mode) == 0o644
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,77 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import sharding  # noqa: E402
+
+
+def test_shard_ranges_cover_the_window_contiguously():
+    ranges = [sharding.shard_range(5, 10, index, 3) for index in range(3)]
+
+    assert ranges == [(5, 4), (9, 3), (12, 3)]
+    assert sharding.shard_range(0, 2, 2, 3) == (2, 0)
+
+
+def test_parse_shard_and_window():
+    assert sharding.parse_shard("1/4") == (1, 4)
+    assert sharding.parse_window("30:120") == (30, 120)
+    for bad in ("4/4", "x/2", "1"):
+        with pytest.raises(ValueError):
+            sharding.parse_shard(bad)
+
+
+def test_reporter_progress_is_read_back(tmp_path):
+    reporter = sharding.ShardReporter(str(tmp_path), 1, 2, total=10, interval=0)
+    reporter.update(4)
+
+    reports = sharding.read_progress(str(tmp_path), 2)
+    assert reports[0] is None
+    assert (reports[1]["done"], reports[1]["state"]) == (4, sharding.SHARD_RUNNING)
+
+    reporter.finish()
+    assert sharding.read_progress(str(tmp_path), 2)[1]["state"] == sharding.SHARD_DONE
+    assert sharding.summarize(sharding.read_progress(str(tmp_path), 2), [6, 10]) == (4, 16)
+
+
+def test_shard_commands_strip_coordinator_options():
+    args = sharding.strip_options(
+        ["in.mp4", "--shards", "3", "--shard_hosts=a,b", "--prompt", "a cat"], ["--shards", "--shard_hosts"])
+    assert args == ["in.mp4", "--prompt", "a cat"]
+
+    local = sharding.shard_command("/opt/v2v.py", args, 0, 3, (0, 90))
+    assert local[1:] == ["/opt/v2v.py", "in.mp4", "--prompt", "a cat",
+                         "--shard", "0/3", "--shard_window", "0:90"]
+
+    remote = sharding.shard_command("/opt/v2v.py", args, 2, 3, (0, 90), host="gpu2")
+    assert remote[:2] == ["ssh", "gpu2"]
+    assert remote[2] == "python3 /opt/v2v.py in.mp4 --prompt 'a cat' --shard 2/3 --shard_window 0:90"
+
+
+def test_supervise_stops_remaining_shards_on_failure():
+    failing = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+    slow = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    polls = []
+
+    result = sharding.supervise([failing, slow], lambda: polls.append(1), lambda: False, interval=0.05)
+
+    assert result == 3
+    assert slow.returncode is not None
+    assert polls
+
+
+def test_supervise_returns_none_when_all_shards_succeed():
+    processes = [subprocess.Popen([sys.executable, "-c", "pass"]) for _ in range(2)]
+
+    assert sharding.supervise(processes, lambda: None, lambda: False, interval=0.05) is None
+
+
+def test_supervise_terminates_shards_when_stopped():
+    slow = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+
+    assert sharding.supervise([slow], lambda: None, lambda: True, interval=0.05) == sharding.STOPPED
+    assert slow.returncode is not None
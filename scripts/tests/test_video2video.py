@@ -0,0 +1,193 @@
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+pytest.importorskip("ffmpeg")
+
+import frame_pipeline  # noqa: E402
+import sharding  # noqa: E402
+import video2video  # noqa: E402
+
+
+class FakeResult:
+    def __init__(self, images):
+        self.encoded_images = images
+
+    def as_numpy(self, index):
+        return self.encoded_images[index]
+
+
+class FakeApi:
+    """Renders a frame as its negative and records the requests it got."""
+
+    def __init__(self):
+        self.baseurls = ["http://host-a/sdapi/v1"]
+        self.metrics = None
+        self.requests = []
+        # Seconds each request takes, in the order they arrive
+        self.delays = []
+
+    def img2img(self, images, seed, **kwargs):
+        frames = [np.asarray(image) for image in images]
+        self.requests.append({"seed": seed, "values": [int(frame[0, 0, 0]) for frame in frames]})
+        if self.delays:
+            time.sleep(self.delays.pop(0))
+        return FakeResult([255 - frame for frame in frames])
+
+
+def make_processor(*argv):
+    args = video2video.parser.parse_args(["input.mp4", "--seed", "100", *argv])
+    return video2video.VideoProcessor(args, api=FakeApi())
+
+
+def solid(value):
+    return np.full((16, 16, 3), value, dtype=np.uint8)
+
+
+def run_frames(processor, frames, frame_batch=1, inflight=2):
+    """Run ``(index, frame)`` pairs through the processor, returning what it writes."""
+    written = []
+    processor.writeFrame = lambda counter, frame, started: written.append((counter, frame))
+    processor.last_write_time = time.time()
+    frame_pipeline.run_pipeline(processor.frameBatches(frames, frame_batch), processor.processBatch,
+                                processor.writeBatch, inflight=inflight)
+    return written
+
+
+def test_stride_renders_both_sides_of_a_scene_cut():
+    processor = make_processor("--stride", "4")
+    # Counters 1-6 are one shot, 7-12 another
+    frames = [(index, solid(10 + index if index < 6 else 200 + index)) for index in range(12)]
+
+    keyframes = [counter for counter, _ in processor.keyframes(frames)]
+
+    assert keyframes == [1, 5, 6, 7, 11, 12]
+    # Nothing is synthesized across the cut
+    assert [counter for counter, _ in processor.inbetweens[7]] == []
+    assert [counter for counter, _ in processor.inbetweens[11]] == [8, 9, 10]
+
+
+def test_stride_with_frame_batch_writes_every_frame_in_order():
+    processor = make_processor("--stride", "3", "--frame_batch", "2")
+    frames = [(index, solid(8 * index)) for index in range(14)]
+    # The first request finishes after the second
+    processor.api.delays = [0.2]
+
+    written = run_frames(processor, frames, frame_batch=2)
+
+    assert [counter for counter, _ in written] == list(range(1, 15))
+    keyframes = {1, 4, 7, 10, 13, 14}
+    for counter, frame in written:
+        if counter in keyframes:
+            assert int(frame[0, 0, 0]) == 255 - 8 * (counter - 1)
+    # Keyframes only were sent, two per request
+    sent = [value for request in processor.api.requests for value in request["values"]]
+    assert sorted(sent) == [8 * (counter - 1) for counter in sorted(keyframes)]
+    assert all(len(request["values"]) == 2 for request in processor.api.requests)
+
+
+def test_dedup_looks_up_frames_under_the_seed_they_would_be_rendered_with():
+    processor = make_processor("--dedup", "--frame_batch", "2")
+    a, b, c = solid(40), solid(120), solid(200)
+    batches = [[a, b], [a, b], [a, c], [a, c]]
+    frames = [(index, frame) for index, frame in enumerate(frame for batch in batches for frame in batch)]
+
+    written = run_frames(processor, frames, frame_batch=2, inflight=1)
+
+    # Once a is reused, b and c would be request item 0, rendered with the
+    # seed itself: b was only rendered as item 1 so it is sent again, c is
+    # found under the seed it was sent with
+    assert [request["values"] for request in processor.api.requests] == [[40, 120], [120], [200]]
+    assert [int(frame[0, 0, 0]) for _, frame in written] == [215, 135, 215, 135, 215, 55, 215, 55]
+    assert processor.dedup.stats()["skipped"] == 4
+
+
+def test_dedup_waits_for_repeated_frames_already_in_flight():
+    processor = make_processor("--dedup")
+    processor.api.delays = [0.05] * 12
+    frames = [(index, solid(100)) for index in range(12)]
+
+    written = run_frames(processor, frames, inflight=3)
+
+    assert len(processor.api.requests) == 1
+    assert [counter for counter, _ in written] == list(range(1, 13))
+    assert processor.dedup.stats()["skipped"] == 11
+
+
+def test_resume_sends_only_pending_frames_and_keeps_order(tmp_path):
+    pytest.importorskip("imageio")
+    import job_manifest
+    from PIL import Image
+
+    processor = make_processor("--frame_batch", "3")
+    processor.manifest = job_manifest.JobManifest(str(tmp_path), {"seed": 100})
+    # An earlier run rendered frames 2, 3 and 6
+    for counter in (2, 3, 6):
+        path = str(tmp_path / "frame-{0:04d}.png".format(counter))
+        Image.fromarray(solid(7)).save(path)
+        processor.manifest.mark_done(counter, path)
+    frames = [(index, solid(8 * index)) for index in range(8)]
+
+    written = run_frames(processor, frames, frame_batch=3)
+
+    assert [request["values"] for request in processor.api.requests] == [[0], [24, 32], [48, 56]]
+    assert [counter for counter, _ in written] == list(range(1, 9))
+    assert [int(frame[0, 0, 0]) for _, frame in written] == [255, 7, 7, 231, 223, 7, 207, 199]
+
+
+
+class FakeShard:
+    """Stands in for a shard process that renders its range at once."""
+
+    def __init__(self, command, workdir):
+        index, count = sharding.parse_shard(command[command.index("--shard") + 1])
+        window = sharding.parse_window(command[command.index("--shard_window") + 1])
+        self.total = sharding.shard_range(*window, index, count)[1]
+        reporter = sharding.ShardReporter(workdir, index, count, self.total)
+        reporter.done = self.total
+        reporter.finish()
+
+    def poll(self):
+        return 0
+
+    def wait(self):
+        return 0
+
+
+def coordinate(tmp_path, monkeypatch, startFrame, frameAmount, *argv):
+    """Run the shard coordinator; returns the shards started and the frames encoded."""
+    shards, encoded = [], []
+    monkeypatch.setattr(sys, "argv", ["video2video.py", "input.mp4", *argv])
+    monkeypatch.setattr(video2video.subprocess, "Popen",
+                        lambda command: shards.append(FakeShard(command, str(tmp_path))) or shards[-1])
+    processor = make_processor(*argv)
+    processor.workdir = str(tmp_path)
+    processor.encodeFrames = lambda start, amount, *_: encoded.append((start, amount))
+    processor.coordinateShards(startFrame, frameAmount, 24)
+    return shards, encoded
+
+
+def test_empty_frame_window_starts_no_shards(tmp_path, monkeypatch):
+    processor = make_processor("--shards", "3")
+    assert processor.frameWindow(24, 0) == (0, 0)
+
+    with pytest.raises(SystemExit) as stop:
+        coordinate(tmp_path, monkeypatch, 0, 0, "--shards", "3")
+    assert stop.value.code == 1
+    assert not list(tmp_path.iterdir())
+
+
+def test_fewer_frames_than_shards_uses_one_shard_per_frame(tmp_path, monkeypatch):
+    processor = make_processor("--shards", "4", "--limit_frames_start", "10")
+    assert processor.frameWindow(2, 1) == (10, 2)
+
+    shards, encoded = coordinate(tmp_path, monkeypatch, 10, 2, "--shards", "4")
+
+    assert [shard.total for shard in shards] == [1, 1]
+    assert encoded == [(10, 2)]
@@ -0,0 +1,143 @@
+import io
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import video2video_daemon  # noqa: E402
+
+
+def fake_job(argv, prepared):
+    command = argv[0]
+    if command == "echo":
+        print(" ".join(argv[1:]), "prepared={0}".format(prepared))
+        return 0
+    if command == "exit":
+        sys.exit(int(argv[1]))
+    if command == "fail":
+        raise RuntimeError("job failed")
+    if command == "log":
+        # Append start/end markers so overlapping jobs can be detected
+        with open(argv[1], "a") as log:
+            log.write("start\n")
+        time.sleep(float(argv[2]))
+        with open(argv[1], "a") as log:
+            log.write("end\n")
+        return 0
+    raise AssertionError(command)
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    servers = []
+
+    def start(concurrency=1, prepare=None):
+        path = str(tmp_path / "daemon-{0}.sock".format(len(servers)))
+        server = video2video_daemon.JobServer(path, fake_job, concurrency=concurrency, prepare=prepare)
+        server.listen()
+        thread = threading.Thread(target=server.serve, kwargs={"poll_interval": 0.05}, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        return server
+
+    yield start
+    for server, thread in servers:
+        server.stop()
+        thread.join(10)
+
+
+def run(server, *argv):
+    output = io.BytesIO()
+    code = video2video_daemon.submit(server.socket_path, list(argv), output)
+    return code, output.getvalue().decode()
+
+
+def test_job_output_and_exit_code_reach_the_client(start_server):
+    server = start_server(prepare=lambda argv: len(argv))
+
+    assert run(server, "echo", "hello", "world") == (0, "hello world prepared=3\n")
+    assert run(server, "exit", "3")[0] == 3
+    code, output = run(server, "fail")
+    assert code == 1
+    assert "RuntimeError: job failed" in output
+    assert server.completed == 3
+
+
+def test_prepare_errors_are_left_to_the_job(start_server):
+    def prepare(argv):
+        raise SystemExit(2)
+
+    server = start_server(prepare=prepare)
+
+    assert run(server, "echo", "ok") == (0, "ok prepared=None\n")
+
+
+def test_concurrency_limit_queues_jobs(start_server, tmp_path):
+    log = tmp_path / "jobs.log"
+    server = start_server(concurrency=1)
+
+    threads = [threading.Thread(target=run, args=(server, "log", str(log), "0.3")) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert log.read_text().split() == ["start", "end"] * 3
+
+
+def test_jobs_run_side_by_side_up_to_the_limit(start_server, tmp_path):
+    log = tmp_path / "jobs.log"
+    server = start_server(concurrency=2)
+
+    threads = [threading.Thread(target=run, args=(server, "log", str(log), "0.5")) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert log.read_text().split()[:2] == ["start", "start"]
+
+
+def test_killing_the_client_stops_the_job(start_server, tmp_path):
+    log = tmp_path / "jobs.log"
+    server = start_server()
+
+    # A separate process, so no forked job holds a copy of the client's socket
+    client = subprocess.Popen([sys.executable, video2video_daemon.__file__, "submit",
+                               "--socket", server.socket_path, "--", "log", str(log), "5"])
+    deadline = time.time() + 5
+    while not log.exists() and time.time() < deadline:
+        time.sleep(0.05)
+    client.kill()
+    client.wait()
+
+    deadline = time.time() + 3
+    while server.running and time.time() < deadline:
+        time.sleep(0.05)
+    assert not server.running
+    assert log.read_text().split() == ["start"]
+
+
+def test_invalid_request_is_rejected(start_server):
+    server = start_server()
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(server.socket_path)
+    conn.sendall(b'{"argv": "not a list"}\n')
+    reply = b""
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        reply += chunk
+    conn.close()
+
+    assert reply.startswith(b"Invalid job request")
+    assert reply.endswith(video2video_daemon.EXIT_MARKER + b"2\n")
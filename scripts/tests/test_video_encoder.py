@@ -0,0 +1,235 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# Make the scripts directory importable
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+ffmpeg = pytest.importorskip("ffmpeg")
+
+import video_encoder  # noqa: E402
+
+# Stand-in for ffmpeg: copies stdin to the .mp4 output file and writes the
+# arguments it got next to it.
+FAKE_FFMPEG = """
+import sys
+outfile = next(arg for arg in sys.argv if arg.endswith(".mp4"))
+with open(outfile, "wb") as target:
+    target.write(sys.stdin.buffer.read())
+with open(outfile + ".args", "w") as target:
+    target.write(" ".join(sys.argv[1:]))
+sys.exit(1 if "fail" in outfile else 0)
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path):
+    script = tmp_path / "fake_ffmpeg.py"
+    script.write_text(FAKE_FFMPEG)
+    return [sys.executable, str(script)]
+
+
+def test_frames_are_piped_as_raw_rgb(tmp_path, fake_ffmpeg):
+    outfile = tmp_path / "out.mp4"
+    encoder = video_encoder.StreamingEncoder(str(outfile), 12, cmd=fake_ffmpeg)
+
+    encoder.write(np.full((4, 6, 3), 1, dtype=np.uint8))
+    encoder.write(np.full((8, 12, 3), 2, dtype=np.uint8))  # resized to the first frame
+    encoder.close()
+
+    data = outfile.read_bytes()
+    assert len(data) == 2 * 4 * 6 * 3
+    assert set(data[:72]) == {1} and set(data[72:]) == {2}
+    args = (tmp_path / "out.mp4.args").read_text()
+    assert "-f rawvideo" in args and "-s 6x4" in args and "-framerate 12" in args
+    assert "deflicker" in args and "-preset slower" in args
+
+
+def test_failed_encode_raises(tmp_path, fake_ffmpeg):
+    encoder = video_encoder.StreamingEncoder(str(tmp_path / "fail.mp4"), 12, cmd=fake_ffmpeg)
+    encoder.write(np.zeros((2, 2, 3), dtype=np.uint8))
+
+    with pytest.raises(ffmpeg.Error):
+        encoder.close()
+
+
+def test_close_without_frames_does_nothing(tmp_path, fake_ffmpeg):
+    encoder = video_encoder.StreamingEncoder(str(tmp_path / "out.mp4"), 12, cmd=fake_ffmpeg)
+    encoder.close()
+    assert not (tmp_path / "out.mp4").exists()
+
+
+def test_source_audio_is_muxed_in_the_same_invocation(tmp_path, fake_ffmpeg):
+    outfile = tmp_path / "out.mp4"
+    audio = video_encoder.audio_input("source.mov", offset=2.5)
+    encoder = video_encoder.StreamingEncoder(str(outfile), 12, audio=audio, cmd=fake_ffmpeg)
+
+    encoder.write(np.zeros((2, 2, 3), dtype=np.uint8))
+    encoder.close()
+
+    args = (tmp_path / "out.mp4.args").read_text()
+    assert "-ss 2.5 -i source.mov" in args
+    assert "-map 1:a?" in args and "-acodec aac" in args and "-shortest" in args
+
+
+# Stand-in for ffmpeg that works out how long its output would be: the piped
+# video lasts frames / framerate, the audio source file holds its length in
+# seconds. -shortest ends the output with the shorter stream, unless the
+# audio is padded with apad, which makes it endless.
+FAKE_DURATION_FFMPEG = """
+import sys
+args = sys.argv[1:]
+def option(name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+width, height = map(int, option("-s").split("x"))
+video = len(sys.stdin.buffer.read()) / (width * height * 3) / float(option("-framerate"))
+audio = float(open(args[args.index("-i", args.index("-i") + 1) + 1]).read()) - float(option("-ss", 0))
+if "apad" in option("-af", ""):
+    audio = float("inf")
+duration = min(video, audio) if "-shortest" in args else max(video, audio)
+open(args[-2], "w").write(str(duration))
+"""
+
+
+def test_short_source_audio_keeps_every_frame(tmp_path):
+    script = tmp_path / "fake_duration_ffmpeg.py"
+    script.write_text(FAKE_DURATION_FFMPEG)
+    source = tmp_path / "source.txt"
+    source.write_text("3.0")
+    outfile = tmp_path / "out.mp4"
+    # Starting 2.5s in leaves half a second of audio for a one second clip
+    audio = video_encoder.audio_input(str(source), offset=2.5)
+    encoder = video_encoder.StreamingEncoder(str(outfile), 12, audio=audio, cmd=[sys.executable, str(script)])
+
+    for _ in range(12):
+        encoder.write(np.zeros((2, 2, 3), dtype=np.uint8))
+    encoder.close()
+
+    assert float(outfile.read_text()) == pytest.approx(1.0)
+
+
+def test_mux_audio_copies_the_video_stream():
+    args = video_encoder.mux_audio("video.mp4", video_encoder.audio_input("source.mov"), "out.mp4").get_args()
+
+    assert args[:4] == ["-i", "video.mp4", "-i", "source.mov"]
+    assert "-vcodec" in args and args[args.index("-vcodec") + 1] == "copy"
+    assert ["-map", "0:v", "-map", "1:a?"] == args[4:8]
+
+
+def test_frame_sequence_starts_at_first_rendered_frame():
+    stream = video_encoder.frame_sequence("/opt/jobs/7", 31, 24)
+    args = video_encoder.encode_output(stream, "out.mp4", 24).get_args()
+
+    assert args[:8] == ["-framerate", "24", "-start_number", "31", "-i", "/opt/jobs/7/frame-%04d.png",
+                        "-filter_complex", args[7]]
+
+
+# Stand-in for ffmpeg runs without piped input: the output holds the
+# arguments, or for a concat run the list of joined files.
+FAKE_SEGMENT_FFMPEG = """
+import sys
+args = sys.argv[1:]
+outfile = next(arg for arg in args if arg.endswith(".mp4"))
+with open(outfile, "w") as target:
+    if "concat" in args:
+        target.write(open(args[args.index("-i") + 1]).read())
+    else:
+        target.write(" ".join(args))
+"""
+
+
+@pytest.fixture
+def fake_segment_ffmpeg(tmp_path):
+    script = tmp_path / "fake_segment_ffmpeg.py"
+    script.write_text(FAKE_SEGMENT_FFMPEG)
+    return [sys.executable, str(script)]
+
+
+def test_segment_plan_decodes_the_deflicker_window_past_each_chunk():
+    plan = video_encoder.segment_plan(1, 201, 4)
+
+    assert plan == [(1, 51, 9), (52, 50, 9), (102, 50, 9), (152, 50, 0)]
+    assert sum(length for _, length, _ in plan) == 201
+    # The tail never runs past the last frame
+    assert video_encoder.segment_plan(1, 104, 2) == [(1, 52, 9), (53, 52, 0)]
+    # Short videos are not split into tiny chunks
+    assert video_encoder.segment_plan(1, 60, 8) == [(1, 60, 0)]
+
+
+def deflicker(frames):
+    """Run ``frames`` through libavfilter's deflicker as encode_output configures it."""
+    av = pytest.importorskip("av")
+    from fractions import Fraction
+
+    graph = av.filter.Graph()
+    height, width = frames[0].shape[:2]
+    source = graph.add_buffer(width=width, height=height, format="rgb24", time_base=Fraction(1, 24))
+    flt = graph.add("deflicker", "mode=pm:size={0}".format(video_encoder.DEFLICKER_SIZE))
+    sink = graph.add("buffersink")
+    source.link_to(flt)
+    flt.link_to(sink)
+    graph.configure()
+    output = []
+
+    def drain():
+        while True:
+            try:
+                output.append(sink.pull().to_ndarray())
+            except (av.BlockingIOError, av.EOFError):
+                return
+
+    for pts, array in enumerate(frames):
+        frame = av.VideoFrame.from_ndarray(array, format="rgb24")
+        frame.pts = pts
+        source.push(frame)
+        drain()
+    source.push(None)
+    drain()
+    return output
+
+
+def test_segmented_deflicker_matches_a_single_pass():
+    rng = np.random.default_rng(0)
+    frames = [np.clip(rng.integers(40, 200) + rng.integers(0, 20, (8, 8, 3)), 0, 255).astype(np.uint8)
+              for _ in range(120)]
+    single = deflicker(frames)
+
+    segmented = []
+    for first, length, tail in video_encoder.segment_plan(0, len(frames), 2):
+        # segment_output trims the input to length + tail and keeps length frames
+        segmented += deflicker(frames[first:first + length + tail])[:length]
+
+    assert len(segmented) == len(single)
+    assert [i for i, (a, b) in enumerate(zip(segmented, single)) if not np.array_equal(a, b)] == []
+
+
+def test_segments_are_encoded_and_joined_in_order(tmp_path, fake_segment_ffmpeg):
+    outfile = tmp_path / "out.mp4"
+
+    used = video_encoder.encode_segments(str(tmp_path), 1, 150, str(outfile), 24,
+                                         profile="fast", segments=3, cmd=fake_segment_ffmpeg)
+
+    assert used == 3
+    assert outfile.read_text().split() == ["file", "'segment-000.mp4'", "file", "'segment-001.mp4'",
+                                           "file", "'segment-002.mp4'"]
+    # Chunks and the list are cleaned up after joining
+    assert not list(tmp_path.glob("segment*"))
+
+
+def test_segment_output_decodes_the_tail_but_encodes_the_chunk():
+    args = " ".join(video_encoder.segment_output("/w", 41, 50, 9, "seg.mp4", 24, "balanced", 2).get_args())
+
+    assert "-start_number 41" in args
+    assert "[0]trim=end_frame=59[s0];[s0]deflicker=mode=pm:size=10" in args
+    assert "-vframes 50" in args and "-threads 2" in args and "-preset medium" in args
+
+
+def test_encode_profiles():
+    args = video_encoder.encode_output(video_encoder.frame_sequence("/w", 1, 24), "out.mp4", 24,
+                                       profile="fast").get_args()
+
+    assert args[args.index("-preset") + 1] == "veryfast"
+    with pytest.raises(ValueError):
+        video_encoder.encode_output(video_encoder.frame_sequence("/w", 1, 24), "out.mp4", 24, profile="x")
@@ -1,5 +1,11 @@
+import asyncio
 import base64
+import json as json_module
 import sys
+import threading
+import time
+from collections import deque
+from datetime import timedelta
 from io import BytesIO
 from pathlib import Path
 from typing import List
@@ -84,3 +90,682 @@ def test_custom_get_can_skip_api_prefix(dummy_session):
 
     assert session.get_calls[-2].endswith("/sdapi/v1/controlnet/version")
     assert session.get_calls[-1].endswith("/controlnet/version")
+
+
+def test_async_calls_share_one_pooled_session(dummy_session):
+    pytest.importorskip("aiohttp")
+    from aiohttp import web
+
+    image = make_base64_image()
+    connections = set()
+
+    async def img2img(request):
+        connections.add(request.transport.get_extra_info("peername"))
+        return web.json_response({"images": [image], "parameters": {}, "info": "{}"})
+
+    async def progress(request):
+        return web.json_response({"progress": 0.0})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/sdapi/v1/img2img", img2img)
+        app.router.add_get("/sdapi/v1/progress", progress)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        api = webuiapi.WebUIApi(
+            baseurl=f"http://127.0.0.1:{port}/sdapi/v1", async_limit_per_host=4
+        )
+        async with api:
+            session = await api._get_async_session()
+            results = await asyncio.gather(
+                *[api.img2img(images=[], use_async=True) for _ in range(32)]
+            )
+            assert await api.get_progress_async() == {"progress": 0.0}
+            assert await api._get_async_session() is session
+        assert session.closed
+        await runner.cleanup()
+        return results
+
+    results = asyncio.run(run())
+
+    assert len(results) == 32
+    assert results[0].image.size == (1, 1)
+    assert 0 < len(connections) <= 4
+
+
+def test_async_session_from_another_loop_is_closed(dummy_session):
+    pytest.importorskip("aiohttp")
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1")
+
+    # A finished asyncio.run: the old session is closed by the next loop
+    first = asyncio.run(api._get_async_session())
+    second = asyncio.run(api._get_async_session())
+    assert first.closed and second is not first
+
+    loop = asyncio.new_event_loop()
+
+    def run_loop():
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        return thread
+
+    thread = run_loop()
+    third = asyncio.run_coroutine_threadsafe(api._get_async_session(), loop).result(5)
+    assert second.closed
+
+    # An idle loop can't close its session, so switching away from it is refused
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    with pytest.raises(RuntimeError):
+        asyncio.run(api._get_async_session())
+    assert not third.closed
+
+    # A loop still running in another thread closes its own session
+    thread = run_loop()
+    asyncio.run(api._get_async_session())
+    wait_until(lambda: third.closed)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+    asyncio.run(api.aclose())
+
+
+def test_least_loaded_balancer_prefers_idle_and_fast_hosts():
+    balancer = webuiapi.LeastLoadedBalancer(["http://a/sdapi/v1", "http://b/sdapi/v1"])
+
+    first = balancer.acquire()
+    second = balancer.acquire()
+    assert {first, second} == {"http://a/sdapi/v1", "http://b/sdapi/v1"}
+
+    balancer.release("http://a/sdapi/v1/img2img", latency=5.0)
+    balancer.release("http://b/sdapi/v1/img2img", latency=0.5)
+
+    assert balancer.acquire() == "http://b/sdapi/v1"
+    # b now has one request in flight, so the idle host wins despite latency
+    assert balancer.acquire() == "http://a/sdapi/v1"
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_least_loaded_balancer_ejects_and_probes_failed_hosts():
+    now = [0.0]
+    probes = []
+    healthy = {"http://a/sdapi/v1": False}
+
+    def probe(baseurl):
+        probes.append(baseurl)
+        return healthy.get(baseurl, True)
+
+    balancer = webuiapi.LeastLoadedBalancer(
+        ["http://a/sdapi/v1", "http://b/sdapi/v1"],
+        probe=probe,
+        max_failures=2,
+        probe_interval=10.0,
+        clock=lambda: now[0],
+    )
+    for _ in range(2):
+        balancer.acquire()
+        balancer.release("http://a/sdapi/v1/img2img", ok=False)
+    assert balancer.is_ejected("http://a/sdapi/v1")
+
+    for _ in range(3):
+        assert balancer.acquire() == "http://b/sdapi/v1"
+        balancer.release("http://b/sdapi/v1/img2img", latency=1.0)
+    assert probes == []
+
+    now[0] = 11.0
+    assert balancer.acquire() == "http://b/sdapi/v1"
+    assert wait_until(lambda: not balancer.stats["http://a/sdapi/v1"].probing)
+    assert probes == ["http://a/sdapi/v1"]
+    assert balancer.is_ejected("http://a/sdapi/v1")
+    balancer.release("http://b/sdapi/v1/img2img", latency=1.0)
+
+    now[0] = 22.0
+    healthy["http://a/sdapi/v1"] = True
+    # The probe runs in the background; the host is re-admitted once it passes
+    assert balancer.acquire() == "http://b/sdapi/v1"
+    assert wait_until(lambda: not balancer.is_ejected("http://a/sdapi/v1"))
+    assert balancer.acquire() == "http://a/sdapi/v1"
+
+
+def test_least_loaded_balancer_does_not_wait_for_probes():
+    release_probe = threading.Event()
+    balancer = webuiapi.LeastLoadedBalancer(
+        ["http://a/sdapi/v1", "http://b/sdapi/v1"],
+        probe=lambda baseurl: release_probe.wait(5),
+        max_failures=1,
+        probe_interval=0.0,
+    )
+    balancer.acquire()
+    balancer.release("http://a/sdapi/v1/img2img", ok=False)
+
+    started = time.monotonic()
+    for _ in range(4):
+        assert balancer.acquire() == "http://b/sdapi/v1"
+        balancer.release("http://b/sdapi/v1/img2img", latency=0.1)
+    assert time.monotonic() - started < 1.0
+    # Only one probe is started while one is already running
+    assert balancer.stats["http://a/sdapi/v1"].probing
+
+    release_probe.set()
+    assert wait_until(lambda: not balancer.is_ejected("http://a/sdapi/v1"))
+
+
+def test_webuiapi_selects_balancer_by_name(dummy_session):
+    api = webuiapi.WebUIApi(
+        baseurl=["http://host-a/sdapi/v1", "http://host-b/sdapi/v1"],
+        balancer="least_loaded",
+    )
+    session = dummy_session[0]
+
+    api.txt2img(prompt="hello")
+    api.txt2img(prompt="world")
+
+    assert isinstance(api.balancer, webuiapi.LeastLoadedBalancer)
+    assert all(stats.outstanding == 0 for stats in api.balancer.stats.values())
+    assert len(session.post_calls) == 2
+    assert all(stats.latency is not None for stats in api.balancer.stats.values())
+
+    with pytest.raises(ValueError):
+        webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1", balancer="random")
+
+
+@pytest.mark.parametrize("encoding", ["png", "png-fast", "png-raw", "webp-lossless"])
+def test_lossless_image_encodings_round_trip(encoding):
+    image = Image.new("RGB", (8, 8), color=(10, 200, 30))
+
+    data = webuiapi.b64_img(image, encoding)
+    header, _, body = data.partition(",")
+    decoded = Image.open(BytesIO(base64.b64decode(body))).convert("RGB")
+
+    assert header == f"data:{webuiapi.get_image_encoding(encoding).mime_type};base64"
+    assert decoded.tobytes() == image.tobytes()
+
+
+def test_encoding_policy_applies_to_init_images_and_controlnet(dummy_session):
+    api = webuiapi.WebUIApi(
+        baseurl="http://host-a/sdapi/v1",
+        image_encoding="png-fast",
+        controlnet_encoding="jpeg:80",
+    )
+    session = dummy_session[0]
+    image = Image.new("RGBA", (4, 4), color="blue")
+    unit = webuiapi.ControlNetUnit(input_image=image, module="canny")
+
+    api.img2img(images=[image], controlnet_units=[unit])
+
+    payload = session.post_calls[-1][1]
+    assert payload["init_images"][0].startswith("data:image/png;base64,")
+    hint = base64.b64decode(payload["alwayson_scripts"]["ControlNet"]["args"][0]["input_image"])
+    assert Image.open(BytesIO(hint)).format == "JPEG"
+    assert webuiapi.get_image_encoding("jpeg:80").quality == 80
+
+
+def test_img2img_encodes_shared_loopback_frame_once(dummy_session, monkeypatch):
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1")
+    session = dummy_session[0]
+    frame = Image.new("RGB", (4, 4), color="green")
+    units = [webuiapi.ControlNetUnit(input_image=frame, module=m) for m in ("hed", "depth", "none")]
+
+    encoded = []
+    original = webuiapi.raw_b64_img
+
+    def counting_raw_b64_img(image, encoding=None):
+        encoded.append(image)
+        return original(image, encoding)
+
+    monkeypatch.setattr(webuiapi, "raw_b64_img", counting_raw_b64_img)
+    defaults = {}
+    api.img2img(images=[frame], controlnet_units=units, alwayson_scripts=defaults)
+
+    payload = session.post_calls[-1][1]
+    args = payload["alwayson_scripts"]["ControlNet"]["args"]
+    assert len(encoded) == 1
+    assert {unit["input_image"] for unit in args} == {payload["init_images"][0].split(",", 1)[1]}
+    assert defaults == {}
+
+
+def test_img2img_refuses_to_batch_units_that_follow_the_init_image(dummy_session):
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1")
+    session = dummy_session[0]
+    frames = [Image.new("RGB", (4, 4), color=color) for color in ("red", "blue")]
+    loopback = webuiapi.ControlNetUnit(module="hed", loopback=True)
+    shared = webuiapi.ControlNetUnit(input_image=frames[0], module="depth")
+
+    with pytest.raises(ValueError):
+        api.img2img(images=frames, batch_size=2, controlnet_units=[loopback])
+    # One frame per request, or units with their own input, are fine
+    api.img2img(images=frames[:1], controlnet_units=[loopback])
+    api.img2img(images=frames, batch_size=2, controlnet_units=[shared])
+    assert len(session.post_calls) == 2
+
+
+@pytest.mark.parametrize(
+    "mode, expected",
+    [
+        (webuiapi.RESIZE_JUST_RESIZE, (512, 512)),
+        (webuiapi.RESIZE_CROP, (910, 512)),
+        (webuiapi.RESIZE_FILL, (512, 288)),
+    ],
+)
+def test_pre_resize_matches_webui_resize_modes(mode, expected):
+    assert webuiapi.pre_resize_size((1920, 1080), 512, 512, mode) == expected
+    small = Image.new("RGB", (64, 36))
+    assert webuiapi.pre_resize(small, 512, 512, mode) is small
+
+
+def test_pre_resize_applies_to_init_images_and_controlnet_inputs(dummy_session):
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1", pre_resize=True)
+    session = dummy_session[0]
+    frame = Image.new("RGB", (1920, 1080), color="green")
+    units = [
+        webuiapi.ControlNetUnit(input_image=frame, module="hed", resize_mode="Crop and Resize"),
+        webuiapi.ControlNetUnit(input_image=frame, module="depth", resize_mode="Crop and Resize"),
+    ]
+
+    api.img2img(images=[frame], controlnet_units=units, width=512, height=512)
+
+    payload = session.post_calls[-1][1]
+    init = Image.open(BytesIO(base64.b64decode(payload["init_images"][0].split(",", 1)[1])))
+    hints = [Image.open(BytesIO(base64.b64decode(unit["input_image"])))
+             for unit in payload["alwayson_scripts"]["ControlNet"]["args"]]
+    assert init.size == (512, 512)
+    assert [hint.size for hint in hints] == [(910, 512), (910, 512)]
+    assert api.pre_resize_stats == {
+        "requests": 1,
+        "images": 1,
+        "pixel_bytes_before": 2 * 1920 * 1080 * 3,
+        "pixel_bytes_after": (512 * 512 + 910 * 512) * 3,
+        # What was actually uploaded: the init image plus one hint per unit
+        "encoded_bytes": len(payload["init_images"][0].split(",", 1)[1])
+        + sum(len(unit["input_image"]) for unit in payload["alwayson_scripts"]["ControlNet"]["args"]),
+    }
+
+
+def test_result_decodes_lazily_and_saves_original_bytes(dummy_session, tmp_path):
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1")
+
+    result = api.txt2img(prompt="hello")
+
+    assert result._images is None
+    assert result.as_numpy().shape == (1, 1, 3)
+    assert result._images is None
+
+    target = tmp_path / "frame.png"
+    result.save_to(target)
+    assert target.read_bytes() == base64.b64decode(result.encoded_images[0])
+    assert result.image.size == (1, 1)
+
+
+def test_discovery_endpoints_are_cached_until_invalidated(dummy_session):
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1")
+    session = dummy_session[0]
+    scripts_calls = len([u for u in session.get_calls if u.endswith("/scripts")])
+
+    api.get_scripts()
+    api.get_sd_models()
+    api.get_sd_models()
+    api.get_options()
+    api.get_options()
+    assert len([u for u in session.get_calls if u.endswith("/scripts")]) == scripts_calls
+    assert len([u for u in session.get_calls if u.endswith("/sd-models")]) == 1
+    assert len([u for u in session.get_calls if u.endswith("/options")]) == 1
+
+    api.set_options({"sd_model_checkpoint": "x"})
+    api.get_options()
+    assert len([u for u in session.get_calls if u.endswith("/options")]) == 2
+
+    api.refresh_checkpoints()
+    api.get_sd_models()
+    assert len([u for u in session.get_calls if u.endswith("/sd-models")]) == 2
+
+    api.get_progress()
+    api.get_progress()
+    assert len([u for u in session.get_calls if u.endswith("/progress")]) == 2
+
+
+def test_metadata_cache_single_flight_for_threads_and_coroutines():
+    cache = webuiapi.MetadataCache({"sd-models": 60})
+    release = threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        release.wait(1)
+        return ["model"]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("sd-models", loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert loads == [1]
+    assert results == [["model"]] * 8
+
+    async_loads = []
+
+    async def async_loader():
+        async_loads.append(1)
+        await asyncio.sleep(0.01)
+        return {"sampler": "Euler a"}
+
+    async def run():
+        return await asyncio.gather(*[cache.aget("samplers", async_loader) for _ in range(8)])
+
+    cache.ttls["samplers"] = 60
+    assert asyncio.run(run()) == [{"sampler": "Euler a"}] * 8
+    assert async_loads == [1]
+
+
+def test_metadata_timeout_bounds_gets_and_host_models_are_cached(monkeypatch):
+    timeouts = []
+
+    class TimedSession(DummySession):
+        def get(self, url, timeout=None):
+            timeouts.append(timeout)
+            if url.endswith("/options"):
+                return DummyResponse(url, {"sd_model_checkpoint": "base.ckpt"})
+            return super().get(url)
+
+    sessions = []
+
+    def session_factory():
+        sessions.append(TimedSession({"images": []}))
+        return sessions[-1]
+
+    monkeypatch.setattr(webuiapi.requests, "Session", session_factory)
+    api = webuiapi.WebUIApi(baseurl=["http://host-a/sdapi/v1", "http://host-b/sdapi/v1"], metadata_timeout=3.0)
+
+    expected = {"http://host-a/sdapi/v1": "base.ckpt", "http://host-b/sdapi/v1": "base.ckpt"}
+    assert api.util_get_cached_host_models() == expected
+    assert api.util_get_cached_host_models() == expected
+    api.util_switch_model("base.ckpt")
+    # The ControlNet check plus one round of host model lookups
+    assert timeouts == [3.0] * 3
+
+
+def test_requests_prefer_hosts_with_requested_model(monkeypatch):
+    loaded = {"http://host-a": "base.ckpt", "http://host-b": "anime.ckpt"}
+    switched = threading.Event()
+
+    class ModelSession(DummySession):
+        def get(self, url):
+            self.get_calls.append(url)
+            host = url.split("/sdapi")[0]
+            if url.endswith("/options"):
+                return DummyResponse(url, {"sd_model_checkpoint": loaded[host]})
+            if url.endswith("/sd-models"):
+                return DummyResponse(url, [{"title": "base.ckpt"}, {"title": "anime.ckpt"}])
+            return super().get(url)
+
+        def post(self, url, json=None):
+            if url.endswith("/options"):
+                switched.wait(1)
+                loaded[url.split("/sdapi")[0]] = json["sd_model_checkpoint"]
+            return super().post(url, json)
+
+    sessions = []
+
+    def session_factory():
+        sessions.append(ModelSession({"images": []}))
+        return sessions[-1]
+
+    monkeypatch.setattr(webuiapi.requests, "Session", session_factory)
+    api = webuiapi.WebUIApi(baseurl=["http://host-a/sdapi/v1", "http://host-b/sdapi/v1"])
+
+    api.util_set_model("anime.ckpt")
+    for _ in range(3):
+        api.txt2img(prompt="hello")
+
+    generate_calls = [u for u, _ in sessions[0].post_calls if u.endswith("/txt2img")]
+    assert all(u.startswith("http://host-b") for u in generate_calls)
+
+    switched.set()
+    api.util_wait_for_model()
+    assert api.host_models == {"http://host-a/sdapi/v1": "anime.ckpt", "http://host-b/sdapi/v1": "anime.ckpt"}
+    api.txt2img(prompt="hello")
+    api.txt2img(prompt="hello")
+    generate_calls = [u for u, _ in sessions[0].post_calls if u.endswith("/txt2img")]
+    assert {u.split("/sdapi")[0] for u in generate_calls[-2:]} == {"http://host-a", "http://host-b"}
+
+
+def test_batched_img2img_keeps_frame_order(dummy_session):
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1")
+    session = dummy_session[0]
+    colors = ["red", "green", "blue"]
+    frames = [Image.new("RGB", (2, 2), color=c) for c in colors]
+    session.payload = {
+        "images": [webuiapi.raw_b64_img(f) for f in frames] + [make_base64_image()],
+        "parameters": {},
+        "info": "{}",
+    }
+
+    result = api.img2img(images=frames, batch_size=len(frames))
+
+    payload = session.post_calls[-1][1]
+    assert payload["batch_size"] == 3
+    assert len(payload["init_images"]) == 3
+    decoded = [tuple(result.as_numpy(i)[0, 0]) for i in range(len(frames))]
+    assert decoded == [(255, 0, 0), (0, 128, 0), (0, 0, 255)]
+
+
+class FlakySession(DummySession):
+    """Session whose responses per host come from a list of status codes."""
+
+    def __init__(self, payload, statuses, delays=None):
+        super().__init__(payload)
+        self.statuses = statuses
+        self.delays = delays or {}
+
+    def post(self, url, json=None):
+        host = url.split("/sdapi")[0]
+        response = super().post(url, json)
+        time.sleep(self.delays.get(host, 0))
+        codes = self.statuses.get(host)
+        if codes:
+            response.status_code = codes.pop(0)
+        return response
+
+
+def flaky_api(monkeypatch, statuses, delays=None, **kwargs):
+    payload = {"images": [make_base64_image()], "parameters": {}, "info": "{}"}
+    session = FlakySession(payload, statuses, delays)
+    monkeypatch.setattr(webuiapi.requests, "Session", lambda: session)
+    api = webuiapi.WebUIApi(baseurl=["http://host-a/sdapi/v1", "http://host-b/sdapi/v1"], **kwargs)
+    return api, session
+
+
+def test_transient_errors_are_retried_on_another_host(monkeypatch):
+    api, session = flaky_api(
+        monkeypatch,
+        {"http://host-a": [503, 503]},
+        retry_policy=webuiapi.RetryPolicy(backoff_base=0),
+    )
+
+    result = api.img2img(images=[])
+
+    hosts = [url.split("/sdapi")[0] for url, _ in session.post_calls]
+    assert hosts == ["http://host-a", "http://host-b"]
+    assert result.image.size == (1, 1)
+
+
+def test_client_errors_are_not_retried(monkeypatch):
+    api, session = flaky_api(
+        monkeypatch,
+        {"http://host-a": [422]},
+        retry_policy=webuiapi.RetryPolicy(backoff_base=0),
+    )
+
+    with pytest.raises(RuntimeError):
+        api.img2img(images=[])
+    assert len(session.post_calls) == 1
+
+
+def test_circuit_breaker_skips_failing_host(monkeypatch):
+    api, session = flaky_api(
+        monkeypatch,
+        {"http://host-a": [500] * 10},
+        retry_policy=webuiapi.RetryPolicy(backoff_base=0),
+        circuit_breaker=webuiapi.CircuitBreaker(failure_threshold=2, reset_timeout=60),
+    )
+
+    for _ in range(4):
+        api.img2img(images=[])
+
+    hosts = [url.split("/sdapi")[0] for url, _ in session.post_calls]
+    assert hosts.count("http://host-a") == 2
+    assert api.circuit_breaker.is_open("http://host-a/sdapi/v1")
+
+
+def test_slow_requests_are_hedged_to_another_host(monkeypatch):
+    api, session = flaky_api(
+        monkeypatch,
+        {},
+        delays={"http://host-a": 0.5},
+        retry_policy=webuiapi.RetryPolicy(hedge=True, hedge_min_samples=5),
+    )
+    api._latencies["/sdapi/v1/img2img"] = deque([0.01] * 10)
+
+    start = time.monotonic()
+    api.img2img(images=[])
+
+    assert time.monotonic() - start < 0.4
+    hosts = [url.split("/sdapi")[0] for url, _ in session.post_calls]
+    assert hosts[:2] == ["http://host-a", "http://host-b"]
+
+
+def test_hedged_requests_do_not_queue_behind_other_callers(monkeypatch):
+    api, session = flaky_api(
+        monkeypatch,
+        {},
+        delays={"http://host-a": 0.1, "http://host-b": 0.1},
+        retry_policy=webuiapi.RetryPolicy(hedge=True, hedge_min_samples=5),
+    )
+    api._latencies["/sdapi/v1/img2img"] = deque([0.3] * 10)
+
+    # Far more callers than hosts; each request takes a third of the hedge delay
+    callers = [threading.Thread(target=lambda: api.img2img(images=[])) for _ in range(16)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+
+    assert len(session.post_calls) == 16
+
+
+def test_async_requests_retry_transient_errors(dummy_session):
+    pytest.importorskip("aiohttp")
+    from aiohttp import web
+
+    image = make_base64_image()
+    statuses = [502]
+
+    async def img2img(request):
+        if statuses:
+            return web.Response(status=statuses.pop(0), text="bad gateway")
+        return web.json_response({"images": [image], "parameters": {}, "info": "{}"})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/sdapi/v1/img2img", img2img)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        api = webuiapi.WebUIApi(
+            baseurl=f"http://127.0.0.1:{port}/sdapi/v1",
+            retry_policy=webuiapi.RetryPolicy(backoff_base=0),
+        )
+        async with api:
+            result = await api.img2img(images=[], use_async=True)
+        await runner.cleanup()
+        return result
+
+    assert asyncio.run(run()).image.size == (1, 1)
+    assert statuses == []
+
+
+class JsonBodySession(DummySession):
+    """Accepts the pre-serialized body that is sent when metrics are enabled."""
+
+    def post(self, url, json=None, data=None, headers=None):
+        response = super().post(url, json if data is None else json_module.loads(data))
+        response.elapsed = timedelta(milliseconds=5)
+        return response
+
+
+def test_metrics_record_request_phases(monkeypatch, tmp_path):
+    payload = {"images": [make_base64_image()], "parameters": {}, "info": "{}"}
+    session = JsonBodySession(payload)
+    monkeypatch.setattr(webuiapi.requests, "Session", lambda: session)
+    metrics = webuiapi.RequestMetrics(labels={"job_id": 7})
+    records = []
+    metrics.add_callback(records.append)
+    api = webuiapi.WebUIApi(baseurl="http://host-a/sdapi/v1", metrics=metrics)
+
+    result = api.img2img(images=[Image.new("RGB", (4, 4))])
+    result.as_numpy()
+
+    assert session.post_calls[-1][1]["init_images"]
+    request, decode = records
+    assert request["job_id"] == 7
+    assert request["endpoint"] == "img2img"
+    assert request["host"] == "http://host-a/sdapi/v1"
+    assert set(request["phases"]) == {"encode", "serialize", "wait", "download", "parse", "total"}
+    assert set(decode["phases"]) == {"decode"}
+    assert request["started"] + request["phases"]["total"] <= decode["started"]
+
+    prom_path = tmp_path / "metrics.prom"
+    metrics.write(str(prom_path))
+    text = prom_path.read_text()
+    assert 'webuiapi_request_phase_seconds_count{job_id="7",phase="encode",endpoint="img2img"' in text
+
+    snapshot = metrics.snapshot()
+    assert {series["phase"] for series in snapshot["series"]} >= {"wait", "decode"}
+
+
+def test_hedged_requests_record_only_the_winning_attempt(monkeypatch):
+    class SlowJsonSession(JsonBodySession):
+        def post(self, url, json=None, data=None, headers=None):
+            host = url.split("/sdapi")[0]
+            time.sleep({"http://host-a": 0.3, "http://host-b": 0.4}[host])
+            response = super().post(url, json, data, headers)
+            response.elapsed = timedelta(0)
+            if host == "http://host-a":
+                response.status_code = 503
+            return response
+
+    session = SlowJsonSession({"images": [make_base64_image()], "parameters": {}, "info": "{}"})
+    monkeypatch.setattr(webuiapi.requests, "Session", lambda: session)
+    metrics = webuiapi.RequestMetrics()
+    records = []
+    metrics.add_callback(records.append)
+    api = webuiapi.WebUIApi(
+        baseurl=["http://host-a/sdapi/v1", "http://host-b/sdapi/v1"],
+        metrics=metrics,
+        retry_policy=webuiapi.RetryPolicy(max_attempts=1, hedge=True, hedge_min_samples=5),
+    )
+    api._latencies["/sdapi/v1/img2img"] = deque([0.01] * 10)
+
+    api.img2img(images=[])
+
+    # The failed primary ran alongside the hedge; its phases are not added in
+    (request,) = records
+    assert request["host"] == "http://host-b/sdapi/v1"
+    phases = request["phases"]
+    assert phases["wait"] + phases["download"] <= phases["total"]
+    assert 0.35 < phases["download"] < 0.6
@@ -8,6 +8,8 @@ reads when probing input files.
 """
 
 import argparse
+import contextlib
+import copy
 import json
 import math
 import os
@@ -18,21 +20,42 @@ import time
 import warnings
 from datetime import datetime
 
-import ffmpeg
-import imageio.v2 as imageio
-import imageio.v3 as iio
-import mysql.connector
-import numpy as np
-from apng import APNG
-from moviepy.editor import AudioFileClip, VideoFileClip
-from PIL import Image, ImageSequence
-from progressbar import AdaptiveETA, Bar, FormatLabel, Percentage, ProgressBar
-
+from PIL import Image
+
+import frame_dedup
+import frame_interpolation
+import frame_pipeline
+import frame_sources
+import job_manifest
+import job_status
+import job_trace
+import preview_writer
+import sharding
+import video_encoder
 import webuiapi
 
 warnings.filterwarnings("ignore")
 
 # Constants
+# Coordinator-only arguments, and the ones it replaces, left out of shard commands
+COORDINATOR_OPTIONS = (
+    "--shards", "--shard_hosts", "--shard_launcher", "--seed",
+    "--limit_frames_amount", "--limit_frames_start",
+)
+# Arguments that change rendered frames; a resumed job must match all of them
+RESUME_PARAMS = (
+    "path", "prompt", "negative_prompt", "seed", "steps", "cfg_scale", "sampler",
+    "denoising_strength", "width", "height", "restore_faces", "tiling", "model",
+    "unit1_params", "unit2_params", "unit3_params", "frame_batch",
+    "stride", "stride_method", "scene_threshold", "pre_resize", "image_encoding",
+    "controlnet_encoding", "dedup", "dedup_threshold",
+)
+# Arguments createApi builds the API client from; jobs that agree on all of
+# them can share one client
+API_OPTIONS = (
+    "api_host", "api_hosts", "api_port", "api_balancer", "api_retries", "api_hedge",
+    "sampler", "steps", "image_encoding", "controlnet_encoding", "pre_resize",
+)
 DB_CONFIG = {
     "user": "laravel",
     "password": "zxcvfdsA",
@@ -49,48 +72,147 @@ options = {
     "finalDir": "/opt/processed/"
 }
 
-WIDGETS = [
-    FormatLabel(''),
-    ' ',
-    Percentage(),
-    ' ',
-    Bar(),
-    AdaptiveETA()
-]
 
-starttime = time.time()
-audioFile = None
+def progressWidgets():
+    """Widgets of the console progress bar; the first one is the status label."""
+    from progressbar import AdaptiveETA, Bar, FormatLabel, Percentage
+    return [
+        FormatLabel(''),
+        ' ',
+        Percentage(),
+        ' ',
+        Bar(),
+        AdaptiveETA()
+    ]
+
+
+def importJobModules():
+    """Import the modules jobs only load when they first use them.
+
+    mysql, imageio and progressbar are imported where they are used, so the
+    frame handling can be imported (e.g. by the tests) without them; a
+    long-running worker imports them once up front instead.
+    """
+    import imageio.v3  # noqa: F401
+    import mysql.connector  # noqa: F401
+    import progressbar  # noqa: F401
+
+
+def createApi(args, metadata_timeout=None):
+    """WebUIApi client configured by the API_OPTIONS arguments.
+
+    ``metadata_timeout`` bounds its GET requests, including the ControlNet
+    check made here.
+    """
+    api_port = args.api_port or options.get("api_port")
+    cli_hosts = (
+        [h.strip() for h in args.api_hosts.split(",") if h.strip()]
+        if getattr(args, "api_hosts", None)
+        else None
+    )
+    api_host = args.api_host if getattr(args, "api_host", None) else None
+    api_hosts = cli_hosts if cli_hosts else api_host or options.get("api_host")
+
+    # create API client with custom host, port
+    return webuiapi.WebUIApi(
+        host=api_hosts,
+        port=api_port,
+        sampler=args.sampler,
+        steps=args.steps,
+        balancer=args.api_balancer,
+        image_encoding=args.image_encoding,
+        controlnet_encoding=args.controlnet_encoding,
+        retry_policy=webuiapi.RetryPolicy(
+            max_attempts=args.api_retries, hedge=args.api_hedge
+        ),
+        pre_resize=args.pre_resize,
+        metadata_timeout=metadata_timeout,
+    )
+
 
 class VideoProcessor:
     """Process videos frame-by-frame through Stable Diffusion."""
 
-    def __init__(self, args):
+    def __init__(self, args, api=None):
         self.args = args
-        self.frames = []
-        self.animated_frames = []
+        self.starttime = time.time()
+        self.workdir = '/opt/jobs/{0}'.format(self.args.jobid)
+        self.previewWriter = None
+        self.encoder = None
+        self.manifest = None
+        self.shardReporter = None
+        # Stride mode: source frames waiting for their next keyframe, and the
+        # last written keyframe as (source, output)
+        self.inbetweens = {}
+        self.lastKeyframe = None
+        self.dedup = None
+        if self.args.dedup:
+            self.dedup = frame_dedup.FrameDeduplicator(threshold=self.args.dedup_threshold)
         self.controlnetUnits = []
         self.isAnimated = None
 
-        api_port = self.args.api_port or options.get("api_port")
-        cli_hosts = (
-            [h.strip() for h in self.args.api_hosts.split(",") if h.strip()]
-            if getattr(self.args, "api_hosts", None)
-            else None
-        )
-        api_host = self.args.api_host if getattr(self.args, "api_host", None) else None
-        api_hosts = cli_hosts if cli_hosts else api_host or options.get("api_host")
-
-        # create API client with custom host, port
-        self.api = webuiapi.WebUIApi(
-            host=api_hosts,
-            port=api_port,
-            sampler=self.args.sampler,
-            steps=self.args.steps,
+        # Per-stage timeline of the job, written next to the work directory
+        self.trace = None
+        if self.args.trace:
+            self.trace = job_trace.JobTrace(labels={"job_id": self.args.jobid})
+
+        # Per-request phase timings (encode, wait, decode, ...) labelled with the job
+        self.metrics = None
+        if self.args.metrics_file or self.trace is not None:
+            self.metrics = webuiapi.RequestMetrics(labels={"job_id": self.args.jobid})
+            self.metrics.add_callback(lambda record: self.debugPrint(
+                "Request timings: {0}".format(record)))
+            if self.trace is not None:
+                self.metrics.add_callback(self.trace.record_request)
+
+        # A long-running worker (video2video_daemon.py) passes in a client it
+        # already constructed for the same API options
+        if api is None:
+            api = createApi(self.args)
+        self.api = api
+        self.api.metrics = self.metrics
+        # Progress, ETA and preview updates are coalesced and written in the
+        # background; the abort check reads the status polled there. Without
+        # a job id the channel does nothing and the database is never used.
+        connect, errors = None, (Exception,)
+        if self.args.jobid is not None and self.args.jobid > 0:
+            import mysql.connector
+            connect = lambda: mysql.connector.connect(**DB_CONFIG)
+            errors = (mysql.connector.Error,)
+        self.jobStatus = job_status.JobStatusChannel(
+            connect,
+            self.args.jobid,
+            flush_interval=self.args.status_interval,
+            poll_interval=self.args.status_interval,
+            errors=errors,
+            observer=self.trace.record_query if self.trace is not None else None,
         )
-        self.cnx = mysql.connector.connect(**DB_CONFIG)
 
     def __del__(self):
-        self.cnx.close()
+        self.jobStatus.close()
+
+    def traceSpan(self, stage, frame=None):
+        """Record the enclosed block as ``stage`` in the job trace, if tracing."""
+        if self.trace is None:
+            return contextlib.nullcontext()
+        return self.trace.span(stage, frame)
+
+    def traceFrame(self, counter):
+        """Attribute API request phases of the enclosed block to frame ``counter``."""
+        if self.trace is None:
+            return contextlib.nullcontext()
+        return self.trace.frame(counter)
+
+    def writeTrace(self):
+        if self.trace is None:
+            return
+        base = self.workdir
+        if self.args.shard is not None:
+            base = "{0}.shard-{1}-of-{2}".format(base, *self.args.shard)
+        self.trace.write(base + ".trace.json", base + ".trace-summary.json")
+        summary = self.trace.summary()
+        print("Trace written to {0}.trace.json: {1} frames at {2} frames/s, GPU idle {3:.1%}".format(
+            base, summary["frames"], summary["frames_per_second"], summary["gpu_idle_ratio"]))
 
     def debugPrint(self, object):
         if self.args.debug == True:
@@ -101,122 +223,63 @@ class VideoProcessor:
           self.debugPrint(args)
         return args
 
-    def add_image_to_gif(self, image_file, output_path):
-        new_frame = Image.open(image_file)
-        self.frames.append(new_frame)
-        self.frames[0].save(output_path, format='webp',
-                append_images=self.frames[1:],
-                save_all=True,
-                duration=0.1, loop=0)
-
-    def extractAudio(self, path):
-        clip = VideoFileClip(path)
-        if clip.audio is not None:
-            audioBasename = os.path.basename(self.args.outfile)
-            self.audioFile = "/opt/jobs/{0}/{1}".format(self.args.jobid, os.path.splitext(audioBasename)[0]+'.mp3')       
-            clip.audio.write_audiofile(self.audioFile, verbose=False, logger=None)
-        else:
-            self.audioFile = None
+    def sourceAudio(self, offset=0):
+        """Audio stream of the input file from ``offset`` seconds, or None for image input."""
+        if self.isGif() is True:
+            return None
+        return video_encoder.audio_input(self.args.path, offset)
 
     def attachAudio(self, path):
-        if self.audioFile is None:
-            print("No audio file present")
-            return
-
         if os.path.isfile(path) is not True:
             print('Error,' + path +' not found. attachment dropped')
             exit(0)
 
-        if os.path.isfile(self.audioFile) is not True:
-            print("Error:" + self.audioFile + " not found, audiofile attachment dropped")
-            exit(0)
-
-        videoclip = VideoFileClip(path)
-        print("\nMaking {0}/{1} \n".format(self.audioFile, path))
-        audioclip = AudioFileClip(self.audioFile)
-        new_audioclip = audioclip.subclip(0, videoclip.duration)  # Make the audio match the duration of the video
-        new_videoclip = videoclip.set_audio(new_audioclip)
+        audio = self.sourceAudio()
+        if audio is None:
+            print("No audio file present")
+            return
 
-        new_videoclip.write_videofile(path+".tmp.mp4", verbose=False, logger=None)
+        # Copy the video stream as-is and add the source audio, cut to the
+        # video's length
+        print("\nMaking {0}/{1} \n".format(self.args.path, path))
+        with self.traceSpan("audio_mux"):
+            video_encoder.mux_audio(path, audio, path+".tmp.mp4").run(quiet=True)
 
         # Replace the original video file with the new one
-        os.remove(path)
-        os.remove(self.audioFile)
-        os.rename(path+".tmp.mp4", path)
+        os.replace(path+".tmp.mp4", path)
         self.debugPrint("Audio file attached to "+path)
-        endtime = round(time.time() - starttime, 0)
+        endtime = round(time.time() - self.starttime, 0)
         print("\nTotal time taken: {0} seconds".format(endtime))
 
 
-    def make_ping_pong_gif(self, image_file, output_path):
-        self.debugPrint("Appending "+image_file+" to "+output_path)
-        
-        image = imageio.imread(image_file)
-
-        if image.ndim == 2:
-            image = np.stack((image,) * 3, axis=-1)
-        elif image.shape[2] == 4:
-            image = image[:, :, :3]
-
-        self.animated_frames.append(image_file)
-        self.debugPrint("Frame amount {0} / {1}".format(len(self.animated_frames), int(self.args.limit_frames_amount)))
-
-        if (len(self.animated_frames) == int(self.args.limit_frames_amount)):
-            self.animated_frames += self.animated_frames[-2::-1]
-            
-        self.debugPrint("Writing {0} frames to {1}".format(len(self.animated_frames), output_path))
-        APNG.from_files(self.animated_frames, delay=100).save(output_path)
-
-#      
-    def update_db(self, query, params):
-        try:
-            cursor = self.cnx.cursor()
-            cursor.execute(query, params)
-            self.cnx.commit()
-            cursor.close()
-        except mysql.connector.Error as err:
-            print(f"Failed to update database: {err}")
-            self.update_status('error')
-            sys.exit(1)
     def get_status(self):
-        if self.args.jobid is not None and self.args.jobid > 0:
-            try:
-                cursor = self.cnx.cursor()
-                query = "SELECT status FROM video_jobs WHERE id = %s"
-                cursor.execute(query, (self.args.jobid,))
-                statusEntry = cursor.fetchone()
-
-                cursor.close()
-                if statusEntry is not None and statusEntry:
-                    return statusEntry[0]
-                else:
-                    return True
-            except mysql.connector.Error as err:
-                print(f"Failed to get status: {err}")
-                self.update_status('error')
-                sys.exit(1)
-            
+        return self.jobStatus.get_status()
+
     def update_status(self, status):
+        if self.args.shard is not None:
+            # The shard coordinator owns the job's status
+            return
         if status == "finished":
-            query = "UPDATE video_jobs SET status=%s, progress=100 WHERE id = %s"
+            self.jobStatus.set_status(status, progress=100)
         else:
-            query = "UPDATE video_jobs SET status=%s WHERE id = %s"
-        self.update_db(query, (status, self.args.jobid))
+            self.jobStatus.set_status(status)
 
     def update_preview_img(self, url):
-        endtime = round(time.time() - starttime, 0)
-        query = "UPDATE video_jobs SET job_time = %s, preview_img = %s WHERE id = %s"
-        self.update_db(query, (int(endtime), url, self.args.jobid))
+        endtime = round(time.time() - self.starttime, 0)
+        self.jobStatus.update(job_time=int(endtime), preview_img=url)
     def update_preview_animation(self, url):
-        endtime = round(time.time() - starttime, 0)
-        query = "UPDATE video_jobs SET job_time = %s, preview_animation = %s WHERE id = %s"
-        self.update_db(query, (int(endtime), url, self.args.jobid))
+        endtime = round(time.time() - self.starttime, 0)
+        self.jobStatus.update(job_time=int(endtime), preview_animation=url)
 
     def update_progress(self, progress, remaining):
-        endtime = time.time() - starttime
-        print("Updating time: {0} progress: {1} time_left: {2}".format(int(endtime), int(progress), int(remaining)))
-        query = "UPDATE video_jobs SET job_time = %s, progress = %s, estimated_time_Left = %s WHERE id = %s"
-        self.update_db(query, (int(endtime), int(progress), int(remaining), self.args.jobid))
+        if self.args.shard is not None:
+            # Shards report to their progress file; the coordinator sums them
+            if self.shardReporter is not None:
+                self.shardReporter.update(self.processed_frames)
+            return
+        endtime = time.time() - self.starttime
+        self.debugPrint("Updating time: {0} progress: {1} time_left: {2}".format(int(endtime), int(progress), int(remaining)))
+        self.jobStatus.update(job_time=int(endtime), progress=int(progress), estimated_time_Left=int(remaining))
 
     def limit(self, f):
         nr = int(f)
@@ -237,11 +300,27 @@ class VideoProcessor:
         self.controlnetUnits.append(unit)
 
     def controlnetLoopback(self, image):
-
-        if len(self.controlnetUnits) > 0:
-            for i, unit in enumerate(self.controlnetUnits):
-                if unit is not None and unit.loopback is True:             
-                    self.controlnetUnits[i].input_image = image;
+        """Return the ControlNet units for one request, with loopback inputs set.
+
+        Loopback units are copied rather than modified in place because
+        several requests can be in flight at once.
+        """
+        units = []
+        for unit in self.controlnetUnits:
+            if unit is not None and unit.loopback is True:
+                unit = copy.copy(unit)
+                unit.input_image = image
+            units.append(unit)
+        return units
+
+    def frameBatch(self):
+        """Frames per img2img request: --frame_batch, or 1 when a ControlNet unit follows each frame."""
+        frame_batch = max(1, self.args.frame_batch)
+        if frame_batch > 1 and any(unit.loopback or unit.uses_init_image for unit in self.controlnetUnits):
+            print("Warning: loopback ControlNet units and units without an input image need one frame "
+                  "per request; ignoring --frame_batch {0}".format(frame_batch))
+            return 1
+        return frame_batch
 
     def initControlnetUnits(self):
         self.controlnetUnits = []
@@ -256,6 +335,7 @@ class VideoProcessor:
 
     def _probe_metadata(self, path):
         """Read FPS and duration once, falling back to resized proxy if needed."""
+        import imageio.v3 as iio
 
         metadata = iio.immeta(path, plugin="pyav")
         fps = self.args.fps or metadata.get("fps")
@@ -300,12 +380,23 @@ class VideoProcessor:
         return self.args.path.lower().endswith('.gif') or self.args.path.lower().endswith('.webp') or self.args.path.lower().endswith('.png') or  self.args.path.lower().endswith('.jpg')
       
     def processFrame(self, frame):
-        
-        pil_img = Image.fromarray(frame)
-        w, h = pil_img.size
-        self.debugPrint("Converting from {0}x{1} image to {2}x{3}".format(w,h,self.args.width,self.args.height))
-        self.controlnetLoopback(pil_img)
-        imgargs = self.logArgs(images=[pil_img],
+        return self.processFrames([frame])[0]
+
+    def processFrames(self, frames):
+        """Run one or more consecutive frames through img2img in a single request.
+
+        With several frames they are sent as a batch of init images and the
+        results are split back out in input order; WebUI gives batch item i
+        the seed ``seed + i``. ControlNet would guide every batch item with the
+        first frame's hint, so frames are only batched when no unit follows
+        the frame (see ``frameBatch``).
+        """
+        pil_imgs = [Image.fromarray(frame) for frame in frames]
+        w, h = pil_imgs[0].size
+        self.debugPrint("Converting {0} frame(s) from {1}x{2} image to {3}x{4}".format(len(pil_imgs),w,h,self.args.width,self.args.height))
+        controlnetUnits = self.controlnetLoopback(pil_imgs[0])
+        imgargs = self.logArgs(images=pil_imgs,
+                batch_size=len(pil_imgs),
                 prompt=self.args.prompt,
                 negative_prompt=self.args.negative_prompt,   
                 denoising_strength=self.args.denoising_strength,
@@ -317,27 +408,272 @@ class VideoProcessor:
                 height=self.args.height,
                 tiling=self.args.tiling,
                 restore_faces=self.args.restore_faces,
-                controlnet_units=self.controlnetUnits)
+                controlnet_units=controlnetUnits)
         
 
         result = self.api.img2img(**imgargs);
+
+        # Decode straight to arrays; no PIL copy is kept on the result. Any
+        # ControlNet detect maps come after the generated images.
+        if len(result.encoded_images) < len(frames):
+            raise RuntimeError("Expected {0} images, got {1}".format(len(frames), len(result.encoded_images)))
+        return [result.as_numpy(i) for i in range(len(frames))]
+
+    def isResumed(self, counter):
+        return self.manifest is not None and self.manifest.is_done(counter)
+
+    def processBatch(self, batch):
+        """Run a list of ``(counter, frame)`` tuples through img2img.
+
+        Frames finished by an interrupted run are read back from the work
+        directory instead.
+        """
+        with self.traceFrame(batch[0][0]):
+            if self.isResumed(batch[0][0]):
+                import imageio.v3 as iio
+                with self.traceSpan("read"):
+                    return [iio.imread(self.manifest.frame_path(counter)) for counter, _ in batch]
+            if self.dedup is None:
+                return self.processFrames([frame for _, frame in batch])
+
+            # Only the frames not found are sent, and request item n is
+            # rendered with seed + n, so each frame is looked up and stored
+            # under the seed of the request item it would become
+            signatures = [self.dedup.signature(frame) for _, frame in batch]
+            outputs, pending = [], []
+            for i, signature in enumerate(signatures):
+                output, claim = self.dedup.claim(signature, self.args.seed + len(pending))
+                outputs.append(output)
+                if claim is not None:
+                    pending.append((i, claim))
+            if pending:
+                try:
+                    processed = self.processFrames([batch[i][1] for i, _ in pending])
+                except BaseException:
+                    for _, claim in pending:
+                        self.dedup.release(claim)
+                    raise
+                for position, ((i, claim), output) in enumerate(zip(pending, processed)):
+                    self.dedup.add(signatures[i], self.args.seed + position, output, claim)
+                    outputs[i] = output
+            return outputs
+
+    def keyframes(self, framelist):
+        """Yield the ``(counter, frame)`` pairs to render.
+
+        With --stride N only every Nth frame, the frames around a scene cut
+        and the last frame are yielded; the frames between two keyframes are
+        kept in ``self.inbetweens`` under the later keyframe's counter.
+        """
+        stride = max(1, self.args.stride)
+        pending = []
+        since = stride
+        previous = None
+        for index, frame in framelist:
+            counter = index + 1
+            if stride == 1:
+                yield counter, frame
+                continue
+            cut = (previous is not None and self.args.scene_threshold > 0
+                   and frame_interpolation.is_scene_cut(previous, frame, self.args.scene_threshold))
+            previous = frame
+            if cut and pending:
+                # Render both sides of the cut so nothing is blended across it
+                last_counter, last_frame = pending.pop()
+                self.inbetweens[last_counter] = pending
+                pending = []
+                yield last_counter, last_frame
+            if cut or since >= stride:
+                self.inbetweens[counter] = pending
+                pending = []
+                since = 0
+                yield counter, frame
+            else:
+                pending.append((counter, frame))
+            since += 1
+        if pending:
+            last_counter, last_frame = pending.pop()
+            self.inbetweens[last_counter] = pending
+            yield last_counter, last_frame
+
+    def frameBatches(self, framelist, frame_batch):
+        """Group the keyframes of ``framelist`` into lists of up to ``frame_batch`` ``(counter, frame)`` pairs."""
+        batch = []
+        for counter, frame in self.keyframes(framelist):
+            # Resumed frames are batched apart from frames still to render
+            if batch and self.isResumed(batch[-1][0]) != self.isResumed(counter):
+                yield batch
+                batch = []
+
+            ## Run the frames through stable diffusion, frame_batch at a time
+            batch.append((counter, frame))
+            if len(batch) >= frame_batch:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def writeBatch(self, batch, processedFrames):
+        """Write processed frames in order; called from the pipeline's writer thread."""
+        segments = [(self.inbetweens.pop(counter, []), counter, source, processedFrame)
+                    for (counter, source), processedFrame in zip(batch, processedFrames)]
+        # Time per frame is measured between writes so the ETA reflects
+        # pipeline throughput rather than the latency of a single request.
+        now = time.time()
+        per_frame = (now - self.last_write_time) / sum(len(between) + 1 for between, *_ in segments)
+        self.last_write_time = now
+        for between, counter, source, processedFrame in segments:
+            if between:
+                previous_source, previous = self.lastKeyframe
+                synthesized = frame_interpolation.interpolate(
+                    self.args.stride_method, previous, processedFrame,
+                    previous_source, source, [frame for _, frame in between])
+                for (between_counter, _), frame in zip(between, synthesized):
+                    self.writeFrame(between_counter, frame, time.time() - per_frame)
+            self.writeFrame(counter, processedFrame, time.time() - per_frame)
+            self.lastKeyframe = (source, processedFrame)
+
+    def isAborted(self):
+        return self.jobStatus.is_aborted()
+
+    def writeFrame(self, counter, processedFrame, frame_start_time):
+        import imageio.v3 as iio
+
+        if (self.preview_img_url is not False and self.previewWritten is False):
+            print("Writing {0}".format(self.preview_img_fullpath))
+
+            with self.traceSpan("write", counter):
+                iio.imwrite(self.preview_img_fullpath, processedFrame)
+            self.update_preview_img(self.preview_img_url)
+            self.previewWritten = True
         
-        # If image_data is already a PIL Image object, you can convert it to a numpy array
-        return np.array(result.image)
+        if self.args.limit_frames_amount == 0:
+            if self.encoder is not None:
+                with self.traceSpan("video_encode", counter):
+                    self.encoder.write(processedFrame)
+            if self.isResumed(counter):
+                pass
+            elif self.encoder is None or self.args.keep_frames or self.manifest is not None:
+                sequence = "{:04d}".format(int(counter))
+                framefile = "{0}/frame-{1}.png".format(self.workdir,sequence)
+                with self.traceSpan("write", counter):
+                    iio.imwrite(framefile, processedFrame)
+                    if self.manifest is not None:
+                        self.manifest.mark_done(counter, framefile)
+                        
+        self.updateProgress(self.frameAmount, frame_start_time, self.N, self.pbar, 1)
+        if self.trace is not None:
+            self.trace.frame_done()
+        if self.previewWriter is not None:
+            with self.traceSpan("preview", counter):
+                published = self.previewWriter.append(processedFrame)
+            if published and self.args.jobid:
+                animated_url_timestamped = '{0}?{1}'.format(self.animated_preview_img_url, counter)
+                self.update_preview_animation(animated_url_timestamped)
     
-    def getFrames(self):
-        if self.isGif() is True:
-            gif = Image.open(self.args.path)
-            if self.isAnimatedGif() is True:
-                # Treat the GIF as a video file
-                frames = [frame.copy() for frame in ImageSequence.Iterator(gif)]
-            else:
-                # Treat the GIF as a single-frame video
-                frames = [gif]
+    def manifestName(self):
+        """Resume manifest file name; every shard of a job keeps its own."""
+        if self.args.shard is not None:
+            return sharding.manifest_name(*self.args.shard)
+        if self.args.shards > 1:
+            # A coordinator reuses the seed recorded by its first shard
+            return sharding.manifest_name(0, self.args.shards)
+        return job_manifest.MANIFEST_NAME
+
+    def frameWindow(self, fps, duration):
+        """``(startFrame, frameAmount)`` of the frames this run renders."""
+        if self.args.shard is not None:
+            return sharding.shard_range(*self.args.shard_window, *self.args.shard)
+
+        frameAmount = math.ceil(fps*duration)
+        startFrame = 0
+        
+        if self.args.limit_frames_amount > 0:
+            frameAmount = self.args.limit_frames_amount
+            self.debugPrint('Limiting amount of frames to {0}'.format(frameAmount))
+        if self.args.limit_frames_start > 0:
+            startFrame = self.args.limit_frames_start    
+            self.debugPrint('Starting from frame #{0}'.format(startFrame))
+ 
+        if self.args.preview_url is not None and frameAmount > (options.get('preview_frame_count')+options.get('preview_start_frame')):
+            frameAmount = options.get('preview_frame_count')
+            startFrame = options.get('preview_start_frame')
+        return startFrame, frameAmount
+
+    def coordinateShards(self, startFrame, frameAmount, fps):
+        """Render the frame window as --shards worker processes, then encode their frames."""
+        count = min(self.args.shards, int(frameAmount))
+        if count < 1:
+            # An empty window (e.g. a start past the end of the video) leaves nothing to shard
+            print("No frames to render from frame {0}, not starting shards".format(int(startFrame)))
+            self.update_status('error')
+            self.jobStatus.close()
+            sys.exit(1)
+        window = (int(startFrame), int(frameAmount))
+        hosts = [h.strip() for h in self.args.shard_hosts.split(",") if h.strip()] if self.args.shard_hosts else []
+        # Every shard must render with the same seed
+        workerArgs = sharding.strip_options(sys.argv[1:], COORDINATOR_OPTIONS) + ["--seed", str(self.args.seed)]
+        totals = [sharding.shard_range(*window, index, count)[1] for index in range(count)]
+        os.makedirs(self.workdir, exist_ok=True)
+        processes = []
+        for index in range(count):
+            command = sharding.shard_command(
+                os.path.abspath(__file__), workerArgs, index, count, window,
+                host=hosts[index % len(hosts)] if hosts else None,
+                launcher=self.args.shard_launcher)
+            self.debugPrint("Starting shard {0}/{1}: {2}".format(index, count, command))
+            processes.append(subprocess.Popen(command))
+        print("Rendering {0} frames in {1} shards".format(int(frameAmount), count))
+
+        begun = time.time()
+
+        def poll():
+            done, total = sharding.summarize(sharding.read_progress(self.workdir, count), totals)
+            remaining = (total - done) * (time.time() - begun) / done if done else 0
+            self.update_progress(math.floor(done / total * 100) if total else 0, remaining)
+
+        failed = sharding.supervise(processes, poll, self.isAborted, interval=self.args.status_interval)
+        if failed == sharding.STOPPED:
+            print("Job has been aborted.")
+            sys.exit(0)
+        reports = sharding.read_progress(self.workdir, count)
+        if failed is not None or any(report is None or report["state"] != sharding.SHARD_DONE for report in reports):
+            print("Shard failed (exit code {0}), not assembling the video".format(failed))
+            self.update_status('error')
+            self.jobStatus.close()
+            sys.exit(1)
+
+        print("All shards finished, encoding "+self.args.outfile)
+        with self.traceSpan("video_encode"):
+            self.encodeFrames(startFrame, frameAmount, fps, self.sourceAudio(int(startFrame) / fps))
+        endtime = round(time.time() - self.starttime, 0)
+        print("\nTotal time taken: {0} seconds".format(endtime))
+        self.update_status('finished' if os.path.isfile(self.args.outfile) else 'error')
+        self.jobStatus.close()
+        self.writeTrace()
+
+    def encodeFrames(self, startFrame, frameAmount, fps, audio):
+        """Encode the frame PNGs in the work directory to --outfile."""
+        if self.args.encode_mode == 'segmented':
+            segments = video_encoder.encode_segments(
+                self.workdir, int(startFrame) + 1, int(frameAmount), self.args.outfile, fps, audio,
+                profile=self.args.encode_profile, segments=self.args.encode_segments)
+            self.debugPrint("Encoded {0} segment(s) in parallel".format(segments))
         else:
-            # The input is not a GIF, so treat it as a video file
-            frames = iio.imiter(self.args.path, plugin="pyav")
-        return frames
+            video_encoder.encode_output(
+                video_encoder.frame_sequence(self.workdir, int(startFrame) + 1, fps),
+                self.args.outfile, fps, audio, self.args.encode_profile).run()
+
+    def getFrames(self, startFrame=0, frameAmount=None):
+        """Yield (index, frame) pairs for frames startFrame..startFrame+frameAmount-1 only."""
+        if self.isGif() is True:
+            # Animated GIF/WebP frames are decoded one at a time, a still
+            # image is treated as a single-frame video.
+            return frame_sources.iter_image_frames(self.args.path, int(startFrame), frameAmount)
+        # The input is not a GIF, so treat it as a video file. Only the
+        # requested window is decoded, starting from the nearest keyframe.
+        return frame_sources.iter_video_frames(self.args.path, int(startFrame), frameAmount)
     
     def updateProgress(self, frameAmount, frame_start_time, N, pbar, processed_frames=0):
             
@@ -361,7 +697,8 @@ class VideoProcessor:
             estimated_remaining_time = remaining_frames * avg_time_per_frame
 
 
-            WIDGETS[0] = FormatLabel(
+            from progressbar import FormatLabel
+            self.widgets[0] = FormatLabel(
                 "Processing frame {0}/{1}. Estimated time remaining: {2} seconds".format(
                     self.processed_frames, int(frameAmount), int(estimated_remaining_time)
                 )
@@ -438,29 +775,37 @@ class VideoProcessor:
             self.api.util_wait_for_ready()
 
         if self.args.attachaudio:
-            self.extractAudio(self.args.path);
             self.attachAudio(self.args.outfile);
+            self.writeTrace()
             sys.exit(0)
                 
         if self.args.model:
-            model = self.args.model
-            currentModel = self.api.util_get_current_model()
-            if currentModel != model:
-                print("Changing model from "+currentModel+ " to "+ model)
-                self.api.util_set_model(model)
+            # Hosts that already have the checkpoint start rendering right
+            # away; the rest switch in the background and join when ready.
+            print("Using model "+self.args.model)
+            self.api.util_set_model(self.args.model)
 
         path = self.args.path
 
+        workdir = self.workdir
         if self.args.seed:
             seed = self.args.seed
+        elif self.args.resume and job_manifest.read_params(workdir, self.manifestName()):
+            # Keep the random seed of the interrupted run so its frames match
+            self.args.seed = job_manifest.read_params(workdir, self.manifestName()).get('seed')
         else:
             self.args.seed = random.randint(1, 2147483647)
 
-        fps, duration, path = self._probe_metadata(path)
+        if self.args.shard is not None:
+            # The coordinator already worked out the frame window
+            fps = duration = None
+        else:
+            with self.traceSpan("probe"):
+                fps, duration, path = self._probe_metadata(path)
         preview_img_fullpath = False
         preview_img_url = False
         animated_preview_img_url = False
-        if (self.args.preview_img or self.args.preview_animation):
+        if (self.args.preview_img or self.args.preview_animation) and self.args.shard is None:
 
             if (len(self.args.preview_animation) > 0):
                 animated_preview_img_basename = os.path.basename(self.args.preview_animation);                
@@ -479,90 +824,94 @@ class VideoProcessor:
                 print("Using "+animated_preview_img_fullpath+" for animated path")
                 
 
-        if fps is None or duration is None:
+        if (fps is None or duration is None) and self.args.shard is None:
             print("Unable to extract FPS and duration from the video file.")
             if self.args.jobid is not None:
                 self.update_status('error')
                 sys.exit(1)
-       
-        frameAmount = math.ceil(fps*duration)
-        startFrame = 0
-        
-        if self.args.limit_frames_amount > 0:
-            frameAmount = self.args.limit_frames_amount
-            self.debugPrint('Limiting amount of frames to {0}'.format(frameAmount))
-        if self.args.limit_frames_start > 0:
-            startFrame = self.args.limit_frames_start    
-            self.debugPrint('Starting from frame #{0}'.format(startFrame))
- 
-        if self.args.preview_url is not None and frameAmount > (options.get('preview_frame_count')+options.get('preview_start_frame')):
-            frameAmount = options.get('preview_frame_count')
-            startFrame = options.get('preview_start_frame')
 
-        framelist = self.getFrames()
+        startFrame, frameAmount = self.frameWindow(fps, duration)
+        if self.args.shards > 1:
+            self.coordinateShards(startFrame, frameAmount, fps)
+            return
+
+        framelist = self.getFrames(startFrame, int(frameAmount))
+        if self.trace is not None:
+            framelist = self.trace.iterate("decode", framelist, frame=lambda item: item[0] + 1)
         self.frame_times = []  # List to store time taken to process each frame
         self.processed_frames = 0 
-        N = 100
-        previewWritten = False
-        pbar = ProgressBar(widgets=WIDGETS, maxval=N).start()
-        self.updateProgress(frameAmount, starttime, N, pbar, 0)
+        self.N = N = 100
+        self.frameAmount = frameAmount
+        self.preview_img_fullpath = preview_img_fullpath
+        self.preview_img_url = preview_img_url
+        self.animated_preview_img_url = animated_preview_img_url
+        self.previewWritten = False
+        if animated_preview_img_url is not False:
+            self.previewWriter = preview_writer.AnimatedPreviewWriter(
+                self.args.preview_animation,
+                max_size=self.args.preview_max_size,
+                publish_every=self.args.preview_publish_every)
+        from progressbar import ProgressBar
+        self.widgets = progressWidgets()
+        self.pbar = pbar = ProgressBar(widgets=self.widgets, maxval=N).start()
+        self.updateProgress(frameAmount, self.starttime, N, pbar, 0)
         # Init controlnet units if any configured
         self.initControlnetUnits() 
         self.debugPrint("Starting from frame {0} with {1} frames".format(startFrame, frameAmount))
-        workdir = '/opt/jobs/{0}'.format(self.args.jobid)
-        try:
-            os.mkdir(workdir)
-        except OSError as error:
-            print("Error!"+error.strerror)
-           
+        os.makedirs(workdir, exist_ok=True)
         print("Using {0} as work directory".format(workdir))
-        counter = 0
-        animated_img_file_paths = []
-
-        for idx, frame in enumerate(framelist):
-            frame_start_time = time.time() 
-            status = self.get_status()
-        
-            if status == "aborted":
-                print("Job has been aborted.")
-                sys.exit(0)
-
-
-            if (counter < int(startFrame) or counter >= int(frameAmount+startFrame)):
-                counter += 1
-                continue
-            
-            counter += 1
-
-            ## Run the frame through stable diffusion
-            processedFrame = self.processFrame(frame)
+        if self.args.shard is not None:
+            self.shardReporter = sharding.ShardReporter(workdir, *self.args.shard, total=int(frameAmount))
+        if self.args.resume and self.args.limit_frames_amount == 0:
+            params = {name: getattr(self.args, name) for name in RESUME_PARAMS}
+            self.manifest = job_manifest.JobManifest(workdir, params, self.manifestName())
+            resumed = self.manifest.load()
+            if resumed:
+                print("Resuming: {0} frame(s) already rendered".format(resumed))
+        frame_batch = self.frameBatch()
+        # Source audio is muxed into the same ffmpeg run that encodes the video
+        audio = self.sourceAudio(int(startFrame) / fps) if fps else None
+        if self.args.limit_frames_amount == 0 and self.args.encode_mode == 'stream' and self.args.shard is None:
+            # Frames are piped into ffmpeg as they are written, so encoding
+            # overlaps with generation
+            self.encoder = video_encoder.StreamingEncoder(self.args.outfile, fps, audio=audio,
+                                                          profile=self.args.encode_profile)
+
+        # Decode, API requests and writing overlap; by default one request is
+        # kept in flight per API host.
+        inflight = self.args.inflight or len(self.api.baseurls)
+        self.debugPrint("Keeping {0} request(s) in flight".format(inflight))
+        self.last_write_time = time.time()
+        completed = frame_pipeline.run_pipeline(
+            self.frameBatches(framelist, frame_batch), self.processBatch, self.writeBatch,
+            inflight=inflight, should_stop=self.isAborted)
+        if self.manifest is not None:
+            self.manifest.close()
+        if not completed:
+            if self.previewWriter is not None:
+                self.previewWriter.close()
+            if self.encoder is not None:
+                self.encoder.abort()
+            if self.shardReporter is not None:
+                self.shardReporter.finish(sharding.SHARD_ABORTED)
+            self.writeTrace()
+            print("Job has been aborted.")
+            sys.exit(0)
 
-            if (preview_img_url is not False and previewWritten is False):
-                print("Writing {0}".format(preview_img_fullpath))
+        if self.shardReporter is not None:
+            # The coordinator assembles the video once every shard is done
+            self.shardReporter.finish()
+            self.jobStatus.close()
+            self.writeTrace()
+            print("Shard {0}/{1} finished {2} frames".format(*self.args.shard, int(frameAmount)))
+            return
 
-                iio.imwrite(preview_img_fullpath, processedFrame)
-                self.update_preview_img(preview_img_url)
-                previewWritten = True
-            
-            if self.args.limit_frames_amount == 0:
-                sequence = "{:04d}".format(int(counter))
-                framefile = "{0}/frame-{1}.png".format(workdir,sequence)
-                iio.imwrite(framefile, processedFrame)
-
-            ## Write the frame to final file
-                            
-            self.updateProgress(frameAmount, frame_start_time, N, pbar, 1)
-            if animated_preview_img_url is not False:
-                animated_img_seq_file = '{0}_{1}.png'.format(
-                os.path.splitext(self.args.preview_animation)[0], datetime.timestamp(datetime.now()))
-                animated_img_file_paths.append(animated_img_seq_file)
-                self.debugPrint("Writing frame to "+animated_img_seq_file)
-
-                iio.imwrite(animated_img_seq_file, processedFrame)
-                self.make_ping_pong_gif(animated_img_seq_file, self.args.preview_animation)
-                if self.args.jobid:
-                    animated_url_timestamped = '{0}?{1}'.format(animated_preview_img_url, counter)
-                    self.update_preview_animation(animated_url_timestamped)
+        if self.previewWriter is not None:
+            # Append the reversed frames once and publish the final animation
+            self.previewWriter.finish()
+            if self.args.jobid:
+                self.update_preview_animation('{0}?{1}'.format(
+                    animated_preview_img_url, datetime.timestamp(datetime.now())))
 
         if preview_img_url is not False and self.args.jobid is not None:
             preview_url_timestamped = "{0}?{1}".format(preview_img_url, datetime.timestamp(datetime.now()))
@@ -572,18 +921,34 @@ class VideoProcessor:
 
 
         if self.args.limit_frames_amount > 0:
-            for filename in self.animated_frames:
-                if os.path.isfile(filename) is True:
-                    os.remove(filename)
             statustext = 'preview'
         else:
-            ffmpeg.input("{0}/frame-%04d.png".format(workdir), pattern_type='glob', framerate=self.args.fps).filter('deflicker', mode='pm', size=10).filter('scale', size='hd1080', force_original_aspect_ratio='increase').output(self.args.outfile, crf=20, fps=self.args.fps, video_bitrate=2500, preset='slower', movflags='faststart', pix_fmt='yuv420p').run(overwrite_output=True)
-            self.extractAudio(self.args.path)
-            self.attachAudio(self.args.outfile)
+            with self.traceSpan("video_encode"):
+                if self.encoder is not None:
+                    self.encoder.close()
+                else:
+                    self.encodeFrames(startFrame, frameAmount, fps, audio)
+            endtime = round(time.time() - self.starttime, 0)
+            print("\nTotal time taken: {0} seconds".format(endtime))
             if os.path.isfile(self.args.outfile) is True:
                 statustext = 'finished'
 
         self.update_status(statustext)
+        self.jobStatus.close()
+        if self.args.pre_resize and self.api.pre_resize_stats["images"]:
+            stats = self.api.pre_resize_stats
+            saved = (stats["pixel_bytes_before"] - stats["pixel_bytes_after"]) / stats["images"]
+            uploaded = stats["encoded_bytes"] / stats["images"]
+            print("Pre-resize cut {0:.0f} KiB of raw pixels per frame; uploaded {1:.0f} KiB of encoded images per frame".format(
+                saved / 1024, uploaded / 1024))
+        if self.dedup is not None:
+            stats = self.dedup.stats()
+            print("Deduplicated {0}/{1} frames ({2:.1%} of img2img calls skipped)".format(
+                stats["skipped"], stats["frames"], stats["skip_ratio"]))
+        self.writeTrace()
+        if self.args.metrics_file:
+            self.metrics.write(self.args.metrics_file)
+            print("Request metrics written to "+self.args.metrics_file)
 
 
 # Parse arguments
@@ -604,16 +969,55 @@ parser.add_argument('--api_host', type=str,
                     help='Stable Diffusion API host (overrides default setting)')
 parser.add_argument('--api_hosts', type=str,
                     help='Comma-separated Stable Diffusion API hosts to load balance requests')
+parser.add_argument('--api_balancer', type=str, default='round_robin',
+                    choices=sorted(webuiapi.BALANCERS),
+                    help='How to pick between --api_hosts: round_robin or least_loaded (default: round_robin)')
+parser.add_argument('--api_retries', type=int, default=3,
+                    help='Attempts per img2img request before giving up; retries go to another host when possible (default: 3)')
+parser.add_argument('--api_hedge', action="store_true",
+                    help='Resend requests slower than the recent p95 latency to another host and use the first result')
 parser.add_argument('--api_port', type=str, default=options.get("api_port"),
                     help='Stable Diffusion API port (default: 7860)')
+parser.add_argument('--image_encoding', type=str, default='png-fast',
+                    help='Encoding for init images sent to the API: png, png-fast, png-raw, webp-lossless or jpeg[:quality] (default: png-fast)')
+parser.add_argument('--pre_resize', action="store_true",
+                    help='downscale frames and ControlNet inputs to --width/--height locally before encoding them')
+parser.add_argument('--controlnet_encoding', type=str,
+                    help='Encoding for ControlNet inputs, e.g. jpeg:85 (default: same as --image_encoding)')
 parser.add_argument('--outfile', default='out.mp4', type=str,
                     help='filename for the generated file')
+parser.add_argument('--encode_mode', type=str, default='stream', choices=['stream', 'png', 'segmented'],
+                    help='stream: pipe frames into ffmpeg while processing; png: write frame PNGs and encode them afterwards; '
+                         'segmented: write frame PNGs and encode chunks of them in parallel (default: stream)')
+parser.add_argument('--encode_profile', type=str, default=video_encoder.DEFAULT_PROFILE,
+                    choices=sorted(video_encoder.PROFILES),
+                    help='x264 speed/quality trade-off: fast, balanced or archival (default: {0})'.format(video_encoder.DEFAULT_PROFILE))
+parser.add_argument('--encode_segments', type=int, default=0,
+                    help='ffmpeg processes for --encode_mode segmented (default: one per CPU)')
+parser.add_argument('--shards', type=int, default=1,
+                    help='split the job into N frame ranges rendered by separate worker processes, then encode once (default: 1)')
+parser.add_argument('--shard_hosts', type=str,
+                    help='comma-separated machines sharing /opt/jobs to run --shards workers on (default: run them locally)')
+parser.add_argument('--shard_launcher', type=str, default='ssh {host}',
+                    help='command prefix used to start a shard on one of --shard_hosts (default: "ssh {host}")')
+parser.add_argument('--shard', type=sharding.parse_shard,
+                    help=argparse.SUPPRESS)
+parser.add_argument('--shard_window', type=sharding.parse_window,
+                    help=argparse.SUPPRESS)
+parser.add_argument('--resume', action="store_true",
+                    help='keep a frame checkpoint in the work directory and only render frames missing from an earlier run of this job')
+parser.add_argument('--keep_frames', action="store_true",
+                    help='also write frame PNGs to the work directory when streaming')
 parser.add_argument('--preview_url', type=str,
                     help='Set preview url')
 parser.add_argument('--preview_img', type=str,
                     help='Set preview image url')
 parser.add_argument('--preview_animation', type=str,
                     help='Set animation image url')
+parser.add_argument('--preview_max_size', type=int, default=256,
+                    help='longest edge in pixels of animated preview frames (default: 256)')
+parser.add_argument('--preview_publish_every', type=int, default=4,
+                    help='publish the animated preview every N frames (default: 4)')
 parser.add_argument('--sampler', type=str, default='Euler a',help='which sampler to use (default: Euler a)')
 parser.add_argument('--denoising_strength', type=float, default=0.75,
                     help='how severely to rewrite the video frame (0: return the same frame, 1: return a wholly new '
@@ -642,6 +1046,20 @@ parser.add_argument('--fps', type=int,
 parser.add_argument('--duration', type=int,
                     help='Set duration for the video')
 parser.add_argument('--limit_frames_amount', type=int, default=0, help='Set limit for the frames to process')
+parser.add_argument('--frame_batch', type=int, default=1,
+                    help='Send this many consecutive frames per img2img request (default: 1). Batched frames get seeds seed, seed+1, ...')
+parser.add_argument('--inflight', type=int, default=0,
+                    help='Number of img2img requests to keep in flight (default: one per API host)')
+parser.add_argument('--dedup', action="store_true",
+                    help='reuse the output of a recent near-identical frame instead of calling img2img')
+parser.add_argument('--dedup_threshold', type=float, default=2.0,
+                    help='max mean pixel difference (0-255) for --dedup to treat frames as identical (default: 2.0)')
+parser.add_argument('--stride', type=int, default=1,
+                    help='only render every Nth frame through img2img and synthesize the frames in between (default: 1, render all)')
+parser.add_argument('--stride_method', type=str, default='crossfade', choices=frame_interpolation.METHODS,
+                    help='how --stride synthesizes in-between frames: crossfade or motion (block motion compensated blend)')
+parser.add_argument('--scene_threshold', type=float, default=30.0,
+                    help='with --stride, also render frames whose mean difference (0-255) from the previous frame exceeds this; 0 disables (default: 30)')
 parser.add_argument('--limit_frames_start', type=int, default=0, help='Set start frame to start processing')
 parser.add_argument('--interrupt',  action="store_true",
                     help='Interrupt whatever process is running currently')
@@ -657,10 +1075,19 @@ parser.add_argument('--progress', action="store_true",
                     help='Get info about progrress')
 parser.add_argument('--attachaudio', action="store_true",
                     help='Attach audio from source to target, and exit')
+parser.add_argument('--metrics_file', type=str,
+                    help='Record per-request timings and write them here at the end of the job (.prom for Prometheus text, otherwise JSON)')
+parser.add_argument('--trace', action="store_true",
+                    help='record a per-stage timeline of the job and write it next to the work directory as a Chrome trace '
+                         '(<workdir>.trace.json) with a p50/p95 summary per stage (<workdir>.trace-summary.json)')
+parser.add_argument('--status_interval', type=float, default=2.0,
+                    help='seconds between job progress writes and abort checks (default: 2)')
 parser.add_argument('--debug', action="store_true",
                     help='Print debug info')
-args = parser.parse_args()
 
-# Create a VideoProcessor instance and call the main function
-processor = VideoProcessor(args)
-processor.main()
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # Create a VideoProcessor instance and call the main function
+    processor = VideoProcessor(args)
+    processor.main()
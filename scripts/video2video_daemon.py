@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+"""Long-running video2video worker that takes jobs over a local socket.
+
+Starting ``video2video.py`` per job re-imports PIL/numpy/PyAV/mysql and
+builds a new ``WebUIApi`` (a network round trip to check for ControlNet)
+before the first frame is sent, which dominates short preview jobs. The
+daemon does that once::
+
+    video2video_daemon.py serve --concurrency 2
+
+and jobs are submitted with the usual video2video arguments::
+
+    video2video_daemon.py submit -- input.mp4 --jobid=42 --prompt="..."
+
+The submit client streams the job's output and exits with its exit code, so
+it can stand in for ``video2video.py`` wherever that is run as a command, and
+killing the client stops the job.
+
+Every job runs in a child process forked from the warm daemon, so it starts
+with the modules already imported and an API client already set up for its
+API options, but with fresh module state, its own stdout/stderr (the client
+connection) and its own exit status. Jobs beyond ``--concurrency`` wait in
+arrival order.
+
+Protocol: the client sends one JSON line ``{"argv": [...]}``. Everything the
+daemon sends back is the job's output, followed by ``EXIT_MARKER`` and the
+exit code on a line of its own.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+from collections import deque
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Sequence
+
+DEFAULT_SOCKET = "/tmp/video2video.sock"
+EXIT_MARKER = b"\0"
+# Exit code reported to clients still queued when the daemon shuts down
+EXIT_SHUTDOWN = 75
+# Seconds each warm-up request may take; warm-up runs between accepting jobs,
+# so a host that never answers must not hold up the daemon
+WARMUP_TIMEOUT = 5.0
+
+
+def _exit_code(status: int) -> int:
+    code = os.waitstatus_to_exitcode(status)
+    return 128 - code if code < 0 else code
+
+
+def _read_request(conn: socket.socket) -> List[str]:
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    argv = json.loads(data)["argv"]
+    if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+        raise ValueError("argv must be a list of strings")
+    return argv
+
+
+class JobServer:
+    """Accept jobs on ``socket_path`` and run at most ``concurrency`` at once.
+
+    ``prepare(argv)`` runs in the daemon before a job is forked and may
+    return warm state for it; ``run_job(argv, prepared)`` runs in the forked
+    child and returns the exit code. Both may raise ``SystemExit``.
+    """
+
+    def __init__(self, socket_path: str, run_job: Callable[[List[str], Any], int],
+                 concurrency: int = 1, prepare: Optional[Callable[[List[str]], Any]] = None):
+        self.socket_path = socket_path
+        self.run_job = run_job
+        self.prepare = prepare
+        self.concurrency = max(1, concurrency)
+        self.pending: deque = deque()
+        self.running: Dict[int, socket.socket] = {}
+        self.completed = 0
+        self._cancelled = set()
+        self._stopping = False
+        self._listener = None
+
+    def listen(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(16)
+
+    def stop(self):
+        """Stop taking jobs; ``serve`` returns once the running ones are done."""
+        self._stopping = True
+
+    def serve(self, poll_interval: float = 0.5):
+        if self._listener is None:
+            self.listen()
+        try:
+            while not self._stopping or self.running:
+                self._accept(poll_interval)
+                self._reap()
+                self._start_pending()
+            for conn, _ in self.pending:
+                self._finish(conn, EXIT_SHUTDOWN)
+            self.pending.clear()
+        finally:
+            self._listener.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+
+    def _accept(self, timeout: float):
+        watched = list(self.running.values())
+        if not self._stopping:
+            watched.append(self._listener)
+        try:
+            readable, _, _ = select.select(watched, [], [], timeout)
+        except InterruptedError:
+            return
+        for sock in readable:
+            if sock is self._listener:
+                conn, _ = self._listener.accept()
+                try:
+                    conn.settimeout(5)
+                    argv = _read_request(conn)
+                    conn.settimeout(None)
+                except (OSError, ValueError, KeyError, TypeError) as error:
+                    with contextlib.suppress(OSError):
+                        conn.sendall("Invalid job request: {0}\n".format(error).encode())
+                    self._finish(conn, 2)
+                    continue
+                self.pending.append((conn, argv))
+            else:
+                # Clients send nothing after the request, so this is a hang-up
+                try:
+                    hung_up = not sock.recv(4096)
+                except OSError:
+                    hung_up = True
+                if hung_up:
+                    for pid, conn in self.running.items():
+                        if conn is sock and pid not in self._cancelled:
+                            self._cancelled.add(pid)
+                            with contextlib.suppress(ProcessLookupError):
+                                os.kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = self.running.pop(pid, None)
+            self._cancelled.discard(pid)
+            if conn is not None:
+                self.completed += 1
+                self._finish(conn, _exit_code(status))
+
+    def _start_pending(self):
+        while self.pending and len(self.running) < self.concurrency and not self._stopping:
+            conn, argv = self.pending.popleft()
+            prepared = None
+            if self.prepare is not None:
+                try:
+                    # Errors are reported by the job itself when it runs
+                    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                        prepared = self.prepare(argv)
+                except (Exception, SystemExit):
+                    prepared = None
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self._child(conn, argv, prepared)
+            self.running[pid] = conn
+
+    def _child(self, conn: socket.socket, argv: List[str], prepared):
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            self._listener.close()
+            for other in self.running.values():
+                other.close()
+            for other, _ in self.pending:
+                other.close()
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            os.close(null)
+            os.dup2(conn.fileno(), 1)
+            os.dup2(conn.fileno(), 2)
+            conn.close()
+            sys.stdout = open(1, "w", buffering=1, closefd=False)
+            sys.stderr = open(2, "w", buffering=1, closefd=False)
+            try:
+                code = self.run_job(argv, prepared)
+            except SystemExit as stop:
+                code = stop.code if isinstance(stop.code, int) else (0 if stop.code is None else 1)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code or 0)
+
+    @staticmethod
+    def _finish(conn: socket.socket, code: int):
+        with contextlib.suppress(OSError):
+            conn.sendall(EXIT_MARKER + b"%d\n" % code)
+        conn.close()
+
+
+def submit(socket_path: str, argv: Sequence[str], output: Optional[BinaryIO] = None) -> int:
+    """Run a job on the daemon at ``socket_path``, copying its output to ``output``."""
+    output = output if output is not None else sys.stdout.buffer
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps({"argv": list(argv)}).encode() + b"\n")
+        trailer = None
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            if trailer is not None:
+                trailer += chunk
+                continue
+            text, marker, rest = chunk.partition(EXIT_MARKER)
+            output.write(text)
+            output.flush()
+            if marker:
+                trailer = rest
+    if not trailer:
+        print("Lost connection to the video2video daemon", file=sys.stderr)
+        return 1
+    return int(trailer.strip())
+
+
+class Video2VideoJobs:
+    """Runs video2video jobs, sharing one API client per set of API options.
+
+    Before a job is forked the client's discovery caches are filled in the
+    daemon, so the job finds the ControlNet check, the model list and the
+    checkpoint each host has loaded already answered.
+    """
+
+    def __init__(self):
+        import video2video
+        video2video.importJobModules()
+        self.video2video = video2video
+        self.apis = {}
+
+    def prepare(self, argv: List[str]):
+        args = self.video2video.parser.parse_args(argv)
+        key = tuple(getattr(args, name) for name in self.video2video.API_OPTIONS)
+        api = self.apis.get(key)
+        if api is None:
+            api = self.video2video.createApi(args, metadata_timeout=WARMUP_TIMEOUT)
+            # check_controlnet ignores errors; only keep a client whose check
+            # got an answer, so has_controlnet is not stuck at False
+            api.get_scripts()
+            self.apis[key] = api
+        if args.model:
+            api.get_sd_models()
+            api.util_get_cached_host_models()
+        return api
+
+    def run(self, argv: List[str], api) -> int:
+        sys.argv = [self.video2video.__file__, *argv]
+        args = self.video2video.parser.parse_args(argv)
+        if api is not None:
+            # Connections pooled in the daemon are shared with every child;
+            # the job itself waits on slow hosts as it would when run directly
+            api.session.close()
+            api.metadata_timeout = None
+        self.video2video.VideoProcessor(args, api=api).main()
+        return 0
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Long-running video2video worker for Codename Mage')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the daemon')
+    serve_parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                              help='Unix socket to take jobs on (default: {0})'.format(DEFAULT_SOCKET))
+    serve_parser.add_argument('--concurrency', type=int, default=1,
+                              help='number of jobs to run at the same time (default: 1)')
+    submit_parser = commands.add_parser('submit', help='run a job on the daemon and wait for it')
+    submit_parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                               help='Unix socket of the daemon (default: {0})'.format(DEFAULT_SOCKET))
+    submit_parser.add_argument('argv', nargs=argparse.REMAINDER,
+                               help='video2video.py arguments, after --')
+    args = parser.parse_args(argv)
+
+    if args.command == 'submit':
+        jobArgs = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+        return submit(args.socket, jobArgs)
+
+    jobs = Video2VideoJobs()
+    server = JobServer(args.socket, jobs.run, concurrency=args.concurrency, prepare=jobs.prepare)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    server.listen()
+    print("Waiting for jobs on {0} ({1} at a time)".format(args.socket, server.concurrency))
+    server.serve()
+    print("Stopped after {0} jobs".format(server.completed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""Encode processed frames to the output video for video2video.
+
+``StreamingEncoder`` starts one ffmpeg process on the first frame and pipes
+raw RGB frames to its stdin as they are produced, so encoding overlaps with
+generation and no intermediate PNGs are written or read back. ``encode_output``
+holds the filter chain and output settings shared with the PNG sequence
+encode, so both modes produce the same video.
+
+Audio is taken straight from the source file and muxed in the same ffmpeg
+invocation, trimmed to the length of the video or padded with silence when
+the source runs out first, so the frames always set the length;
+``mux_audio`` adds it to an already encoded video without re-encoding the
+video stream.
+
+``encode_segments`` encodes a PNG sequence as several ffmpeg processes running
+side by side, one per chunk of frames, and joins the chunks without
+re-encoding. ffmpeg's deflicker corrects each frame using it and the
+following ``DEFLICKER_SIZE - 1`` frames, so each chunk decodes that many
+frames past its end and only encodes its own; the output matches a single
+encode. ``PROFILES`` trade encode speed for size and quality.
+"""
+
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import ffmpeg
+import numpy as np
+from PIL import Image
+
+# x264 settings per encode profile; "archival" is what every encode used before
+PROFILES = {
+    "fast": {"preset": "veryfast", "crf": 23},
+    "balanced": {"preset": "medium", "crf": 20},
+    "archival": {"preset": "slower", "crf": 20},
+}
+DEFAULT_PROFILE = "archival"
+DEFLICKER_SIZE = 10
+# Audio output options: pad the audio with silence so that -shortest always
+# ends the output with the video
+AUDIO_SETTINGS = dict(acodec='aac', af='apad', shortest=None)
+# Shorter chunks are not worth an extra ffmpeg process
+MIN_SEGMENT_FRAMES = 50
+
+
+def audio_input(source: str, offset: float = 0):
+    """The audio stream of ``source`` starting at ``offset`` seconds, if it has one."""
+    if offset:
+        return ffmpeg.input(source, ss=offset)['a?']
+    return ffmpeg.input(source)['a?']
+
+
+def profile_settings(profile: str):
+    """x264 options of encode ``profile`` (one of ``PROFILES``)."""
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown encode profile {0!r}; expected one of {1}".format(profile, sorted(PROFILES)))
+
+
+def _deflicker(stream):
+    return stream.filter('deflicker', mode='pm', size=DEFLICKER_SIZE)
+
+
+def _scale(stream):
+    return stream.filter('scale', size='hd1080', force_original_aspect_ratio='increase')
+
+
+def _output(video, outfile: str, fps, audio=None, profile: str = DEFAULT_PROFILE, **extra):
+    settings = dict(fps=fps, video_bitrate=2500, movflags='faststart', pix_fmt='yuv420p',
+                    **profile_settings(profile), **extra)
+    if audio is None:
+        return video.output(outfile, **settings).overwrite_output()
+    return ffmpeg.output(video, audio, outfile, **AUDIO_SETTINGS, **settings).overwrite_output()
+
+
+def encode_output(stream, outfile: str, fps, audio=None, profile: str = DEFAULT_PROFILE):
+    """Apply the deflicker/scale filters and H.264 output settings to ``stream``.
+
+    ``audio`` (see ``audio_input``) is muxed in as AAC, cut or padded to the
+    video's length. ``profile`` picks the x264 preset and quality (see ``PROFILES``).
+    """
+    return _output(_scale(_deflicker(stream)), outfile, fps, audio, profile)
+
+
+def frame_sequence(workdir: str, start_number: int, fps):
+    """Input stream for the ``frame-%04d.png`` files written to ``workdir``."""
+    return ffmpeg.input('{0}/frame-%04d.png'.format(workdir), start_number=start_number, framerate=fps)
+
+
+def mux_audio(video_path: str, audio, outfile: str):
+    """Copy the video stream of ``video_path`` and add ``audio`` into ``outfile``."""
+    video = ffmpeg.input(video_path)['v']
+    return ffmpeg.output(video, audio, outfile, vcodec='copy', movflags='faststart',
+                         **AUDIO_SETTINGS).overwrite_output()
+
+
+def segment_plan(start_number: int, count: int, segments: int,
+                 overlap: int = DEFLICKER_SIZE - 1) -> List[Tuple[int, int, int]]:
+    """Split frames ``start_number..start_number+count-1`` into chunks to encode separately.
+
+    Returns ``(first, length, tail)`` per chunk: the chunk encodes ``length``
+    frames from frame ``first`` and decodes ``tail`` more after them, which
+    only feed the deflicker window. Chunks are at least
+    ``MIN_SEGMENT_FRAMES`` long, so short videos use fewer of them.
+    """
+    segments = max(1, min(segments, count // MIN_SEGMENT_FRAMES))
+    size, remainder = divmod(count, segments)
+    end = start_number + count
+    plan = []
+    start = start_number
+    for index in range(segments):
+        length = size + (1 if index < remainder else 0)
+        plan.append((start, length, min(overlap, end - start - length)))
+        start += length
+    return plan
+
+
+def segment_output(workdir: str, first: int, length: int, tail: int, outfile: str, fps,
+                   profile: str = DEFAULT_PROFILE, threads: int = 0):
+    """Encode one ``segment_plan`` chunk of the ``frame-%04d.png`` files to ``outfile``."""
+    video = frame_sequence(workdir, first, fps).trim(end_frame=length + tail)
+    return _output(_scale(_deflicker(video)), outfile, fps, profile=profile, vframes=length, threads=threads)
+
+
+def concat_output(listfile: str, outfile: str, audio=None):
+    """Join the videos listed in the concat ``listfile`` without re-encoding them."""
+    video = ffmpeg.input(listfile, format='concat', safe=0)['v']
+    if audio is None:
+        return video.output(outfile, vcodec='copy', movflags='faststart').overwrite_output()
+    return ffmpeg.output(video, audio, outfile, vcodec='copy', movflags='faststart',
+                         **AUDIO_SETTINGS).overwrite_output()
+
+
+def encode_segments(workdir: str, start_number: int, count: int, outfile: str, fps, audio=None,
+                    profile: str = DEFAULT_PROFILE, segments: int = 0, cmd="ffmpeg") -> int:
+    """Encode the frame PNGs in ``workdir`` as parallel chunks joined into ``outfile``.
+
+    ``segments`` is the number of ffmpeg processes to run at once (default:
+    one per CPU). Returns how many chunks were used; raises ``ffmpeg.Error``
+    if an encode failed.
+    """
+    cpus = os.cpu_count() or 1
+    plan = segment_plan(start_number, count, segments or cpus)
+    if len(plan) == 1:
+        encode_output(frame_sequence(workdir, start_number, fps), outfile, fps, audio, profile).run(
+            cmd=cmd, capture_stdout=True, capture_stderr=True)
+        return 1
+
+    # x264 threads are shared out between the chunks encoding side by side
+    threads = max(1, cpus // len(plan))
+    paths = [os.path.join(workdir, "segment-{0:03d}.mp4".format(index)) for index in range(len(plan))]
+    listfile = os.path.join(workdir, "segments.txt")
+
+    def encode(index):
+        first, length, tail = plan[index]
+        segment_output(workdir, first, length, tail, paths[index], fps, profile, threads).run(
+            cmd=cmd, capture_stdout=True, capture_stderr=True)
+
+    try:
+        with ThreadPoolExecutor(len(plan)) as pool:
+            list(pool.map(encode, range(len(plan))))
+        with open(listfile, "w") as target:
+            for path in paths:
+                target.write("file '{0}'\n".format(os.path.basename(path)))
+        concat_output(listfile, outfile, audio).run(cmd=cmd, capture_stdout=True, capture_stderr=True)
+    finally:
+        for path in paths + [listfile]:
+            if os.path.exists(path):
+                os.remove(path)
+    return len(plan)
+
+
+class StreamingEncoder:
+    """Pipe frames into a long-lived ffmpeg process writing ``outfile``.
+
+    Frames may be numpy arrays or PIL images; all frames are encoded at the
+    size of the first one. ``audio`` is an optional ``audio_input`` stream to
+    mux in, ``profile`` the encode profile (see ``PROFILES``). ``cmd`` is the
+    ffmpeg executable (or argv prefix).
+    """
+
+    def __init__(self, outfile: str, fps, audio=None, cmd="ffmpeg", profile: str = DEFAULT_PROFILE):
+        self.outfile = outfile
+        self.fps = fps
+        self.audio = audio
+        self.profile = profile
+        self.cmd = cmd
+        self.size: Optional[Tuple[int, int]] = None
+        self.frames = 0
+        self._process = None
+        self._log = None
+
+    def _start(self, width: int, height: int):
+        source = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24',
+                              s='{0}x{1}'.format(width, height), framerate=self.fps)
+        args = encode_output(source, self.outfile, self.fps, self.audio, self.profile).compile(cmd=self.cmd)
+        # ffmpeg's progress output goes to a file so a full pipe can't stall it
+        self._log = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.DEVNULL, stderr=self._log)
+        self.size = (width, height)
+
+    def write(self, frame):
+        """Send one frame to ffmpeg, starting the process on the first call."""
+        image = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+        image = image.convert('RGB')
+        if self._process is None:
+            self._start(*image.size)
+        elif image.size != self.size:
+            image = image.resize(self.size)
+        self._process.stdin.write(image.tobytes())
+        self.frames += 1
+
+    def _stderr(self) -> bytes:
+        self._log.seek(0)
+        return self._log.read()
+
+    def close(self):
+        """Finish the video; raises ``ffmpeg.Error`` if ffmpeg failed."""
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = process.wait()
+        stderr = self._stderr()
+        self._log.close()
+        if code != 0:
+            raise ffmpeg.Error('ffmpeg', b'', stderr)
+
+    def abort(self):
+        """Stop ffmpeg without finishing the video."""
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        process.kill()
+        process.wait()
+        self._log.close()
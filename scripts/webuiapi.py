@@ -2,16 +2,23 @@
 
 The module provides a small, dependency-free interface for common API calls
 used by the scripts in this repository. It keeps network usage minimal by
-reusing a single requests session and offering synchronous and asynchronous
-helpers for the same endpoints.
+reusing a single requests session (and, for async calls, a single pooled
+aiohttp session) and offering synchronous and asynchronous helpers for the
+same endpoints.
 """
 
 import base64
+import bisect
 import io
 import json
-from dataclasses import dataclass
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Any, Dict, List, Sequence, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 from urllib.parse import urlparse, urlunparse
 
@@ -51,14 +58,63 @@ class HiResUpscaler(str, Enum):
 
 @dataclass
 class WebUIApiResult:
-    images: list
+    """Result of an API call holding the returned images as base64 strings.
+
+    Images are only decoded when accessed, and each accessor decodes just as
+    far as it needs: ``as_bytes``/``save_to`` stop at the encoded file bytes,
+    ``as_numpy`` skips keeping a PIL copy around, and ``images`` builds (and
+    caches) PIL images for callers that want them.
+    """
+
+    encoded_images: list
     parameters: dict
     info: dict
+    _bytes: dict = field(default_factory=dict, repr=False, compare=False)
+    _images: list = field(default=None, repr=False, compare=False)
+    # Called with the seconds spent decoding, when metrics are enabled.
+    on_decode: Optional[Callable[[float], None]] = field(default=None, repr=False, compare=False)
+
+    @property
+    def images(self):
+        if self._images is None:
+            start = time.perf_counter()
+            self._images = [self._open(i) for i in range(len(self.encoded_images))]
+            if self.on_decode is not None:
+                for image in self._images:
+                    image.load()
+                self.on_decode(time.perf_counter() - start)
+        return self._images
 
     @property
     def image(self):
         return self.images[0]
 
+    def as_bytes(self, index=0) -> bytes:
+        """Return the encoded image file bytes exactly as sent by the server."""
+        if index not in self._bytes:
+            self._bytes[index] = base64.b64decode(self.encoded_images[index])
+        return self._bytes[index]
+
+    def as_numpy(self, index=0):
+        import numpy as np
+
+        if self._images is not None:
+            return np.asarray(self._images[index])
+        start = time.perf_counter()
+        with self._open(index) as image:
+            array = np.asarray(image)
+        if self.on_decode is not None:
+            self.on_decode(time.perf_counter() - start)
+        return array
+
+    def save_to(self, path, index=0):
+        """Write the image to ``path`` without decoding or re-encoding it."""
+        with open(path, "wb") as output:
+            output.write(self.as_bytes(index))
+
+    def _open(self, index):
+        return Image.open(io.BytesIO(self.as_bytes(index)))
+
 
 class ControlNetUnit:
     def __init__(
@@ -103,13 +159,33 @@ class ControlNetUnit:
                 "ControlNetUnit guessmode is deprecated. Please use control_mode instead."
             )
             control_mode = guessmode
-        ol_mode = control_mode
+        self.control_mode = control_mode
         self.pixel_perfect = pixel_perfect
 
-    def to_dict(self):
+    @property
+    def uses_init_image(self) -> bool:
+        """True when ControlNet takes this unit's input from the request's init image.
+
+        sd-webui-controlnet then uses the first init image for every batch
+        item, not each item's own.
+        """
+        return self.enabled and not self.input_image
+
+    def to_dict(
+        self,
+        encoding: Union[str, "ImageEncoding", None] = None,
+        cache: "ImageEncodeCache" = None,
+    ):
+        if cache is not None:
+            resize_mode = CONTROLNET_RESIZE_MODES.get(self.resize_mode)
+
+            def encode(image, encoding):
+                return cache.raw(image, encoding, resize_mode)
+        else:
+            encode = raw_b64_img
         return {
-            "input_image": raw_b64_img(self.input_image) if self.input_image else "",
-            "mask": raw_b64_img(self.mask) if self.mask is not None else None,
+            "input_image": encode(self.input_image, encoding) if self.input_image else "",
+            "mask": encode(self.mask, encoding) if self.mask is not None else None,
             "module": self.module,
             "model": self.model,
             "weight": self.weight,
@@ -128,24 +204,669 @@ class ControlNetUnit:
         }
 
 
-def b64_img(image: Image) -> str:
-    return "data:image/png;base64," + raw_b64_img(image)
+@dataclass(frozen=True)
+class ImageEncoding:
+    """How images are serialized before being base64-encoded into a payload.
 
+    ``compress_level`` applies to PNG (0 stores raw deflate blocks, 9 is
+    smallest), ``quality`` to JPEG and lossy WebP, and ``lossless`` to WebP.
+    """
 
-def raw_b64_img(image: Image) -> str:
-    # XXX controlnet only accepts RAW base64 without headers
+    format: str = "PNG"
+    compress_level: Optional[int] = None
+    quality: Optional[int] = None
+    lossless: bool = False
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+    def save_kwargs(self) -> Dict[str, Any]:
+        kwargs: Dict[str, Any] = {"format": self.format}
+        if self.format == "PNG" and self.compress_level is not None:
+            kwargs["compress_level"] = self.compress_level
+        if self.format == "WEBP":
+            kwargs["lossless"] = self.lossless
+            # WebP "quality" is the compression effort when lossless; keep it low
+            # so lossless encoding stays fast.
+            kwargs["quality"] = self.quality if self.quality is not None else (0 if self.lossless else 90)
+            kwargs["method"] = 0
+        if self.format == "JPEG":
+            kwargs["quality"] = self.quality if self.quality is not None else 90
+        return kwargs
+
+
+IMAGE_ENCODINGS = {
+    "png": ImageEncoding("PNG"),
+    "png-fast": ImageEncoding("PNG", compress_level=1),
+    "png-raw": ImageEncoding("PNG", compress_level=0),
+    "webp-lossless": ImageEncoding("WEBP", lossless=True),
+    "jpeg": ImageEncoding("JPEG", quality=90),
+}
+
+
+def get_image_encoding(encoding: Union[str, ImageEncoding, None]) -> ImageEncoding:
+    """Resolve a preset name (``png``, ``png-fast``, ``jpeg:85``...) to an ImageEncoding."""
+    if encoding is None:
+        return IMAGE_ENCODINGS["png"]
+    if isinstance(encoding, ImageEncoding):
+        return encoding
+    name, _, quality = encoding.partition(":")
+    if name not in IMAGE_ENCODINGS:
+        raise ValueError(f"Unknown image encoding {encoding!r}, expected one of {sorted(IMAGE_ENCODINGS)}")
+    preset = IMAGE_ENCODINGS[name]
+    if quality:
+        preset = ImageEncoding(preset.format, preset.compress_level, int(quality), preset.lossless)
+    return preset
+
+
+def encode_image(image: Image, encoding: Union[str, ImageEncoding, None] = None) -> bytes:
+    encoding = get_image_encoding(encoding)
     with io.BytesIO() as output_bytes:
         metadata = None
-        for key, value in image.info.items():
-            if isinstance(key, str) and isinstance(value, str):
-                if metadata is None:
-                    metadata = PngImagePlugin.PngInfo()
-                metadata.add_text(key, value)
-        image.save(output_bytes, format="PNG", pnginfo=metadata)
+        if encoding.format == "PNG":
+            for key, value in image.info.items():
+                if isinstance(key, str) and isinstance(value, str):
+                    if metadata is None:
+                        metadata = PngImagePlugin.PngInfo()
+                    metadata.add_text(key, value)
+        if encoding.format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(output_bytes, pnginfo=metadata, **encoding.save_kwargs())
+        return output_bytes.getvalue()
+
+
+def b64_img(image: Image, encoding: Union[str, ImageEncoding, None] = None) -> str:
+    encoding = get_image_encoding(encoding)
+    return f"data:{encoding.mime_type};base64," + raw_b64_img(image, encoding)
+
+
+def raw_b64_img(image: Image, encoding: Union[str, ImageEncoding, None] = None) -> str:
+    # XXX controlnet only accepts RAW base64 without headers
+    return str(base64.b64encode(encode_image(image, encoding)), "utf-8")
+
+# WebUI img2img ``resize_mode`` values, and the ControlNet unit names for them
+RESIZE_JUST_RESIZE = 0
+RESIZE_CROP = 1
+RESIZE_FILL = 2
+CONTROLNET_RESIZE_MODES = {
+    "Just Resize": RESIZE_JUST_RESIZE,
+    "Crop and Resize": RESIZE_CROP,
+    "Inner Fit (Scale to Fit)": RESIZE_CROP,
+    "Scale to Fit (Inner Fit)": RESIZE_CROP,
+    "Resize and Fill": RESIZE_FILL,
+    "Outer Fit (Shrink to Fit)": RESIZE_FILL,
+    "Envelope (Outer Fit)": RESIZE_FILL,
+}
+
+
+def pre_resize_size(size: Tuple[int, int], width: int, height: int, resize_mode: int = RESIZE_JUST_RESIZE) -> Tuple[int, int]:
+    """Size WebUI scales an image of ``size`` to for a ``width`` x ``height`` target.
+
+    Mirrors ``modules.images.resize_image``: "just resize" scales straight to
+    the target, "crop and resize" scales until the target is covered and
+    "resize and fill" until the image fits inside it; the crop or fill
+    happens afterwards.
+    """
+    image_width, image_height = size
+    if resize_mode not in (RESIZE_CROP, RESIZE_FILL):
+        return width, height
+    ratio = width / height
+    src_ratio = image_width / image_height
+    fit_width = ratio > src_ratio if resize_mode == RESIZE_CROP else ratio < src_ratio
+    if fit_width:
+        return width, image_height * width // image_width
+    return image_width * height // image_height, height
+
+
+def pre_resize(image: Image, width: int, height: int, resize_mode: int = RESIZE_JUST_RESIZE) -> Image:
+    """Downscale ``image`` to the size WebUI would scale it to, leaving the crop/fill to WebUI.
+
+    Images that are already at most that size are returned unchanged, so
+    nothing is ever upscaled locally.
+    """
+    target = pre_resize_size(image.size, width, height, resize_mode)
+    if target[0] * target[1] >= image.width * image.height:
+        return image
+    return image.resize(target, Image.LANCZOS)
+
+
+class ImageEncodeCache:
+    """Encode each distinct image once while building a single payload.
+
+    Entries are keyed by object identity and encoding, so the same PIL image
+    passed as an init image and as the input of several ControlNet loopback
+    units is serialized only once. The cache keeps a reference to every image
+    it has seen, which keeps the identity keys valid; create a new cache per
+    payload rather than sharing one across requests.
+
+    With ``resize_to`` set to the request's ``(width, height)``, images are
+    first downscaled with ``pre_resize`` for the ``resize_mode`` they are
+    encoded with; ``pixel_bytes_before``/``pixel_bytes_after`` add up the raw
+    pixel data of the images before and after that step. ``encoded_bytes``
+    adds up the base64 image data actually placed in the payload, once per use.
+    """
+
+    def __init__(self, resize_to: Optional[Tuple[int, int]] = None):
+        self._encoded: Dict[Any, str] = {}
+        self._images: List[Image.Image] = []
+        self._resized: Dict[Any, Image.Image] = {}
+        self.resize_to = resize_to
+        self.hits = 0
+        self.seconds = 0.0
+        self.pixel_bytes_before = 0
+        self.pixel_bytes_after = 0
+        self.encoded_bytes = 0
+
+    def _pre_resize(self, image: Image, resize_mode: Optional[int]) -> Image:
+        key = (id(image), resize_mode)
+        if key not in self._resized:
+            self._images.append(image)
+            resized = pre_resize(image, *self.resize_to, resize_mode)
+            bands = len(image.getbands())
+            self.pixel_bytes_before += image.width * image.height * bands
+            self.pixel_bytes_after += resized.width * resized.height * bands
+            self._resized[key] = resized
+        return self._resized[key]
+
+    def raw(self, image: Image, encoding: Union[str, ImageEncoding, None] = None,
+            resize_mode: Optional[int] = RESIZE_JUST_RESIZE) -> str:
+        encoding = get_image_encoding(encoding)
+        if self.resize_to is not None and resize_mode is not None:
+            image = self._pre_resize(image, resize_mode)
+        key = (id(image), encoding)
+        if key in self._encoded:
+            self.hits += 1
+        else:
+            self._images.append(image)
+            start = time.perf_counter()
+            self._encoded[key] = raw_b64_img(image, encoding)
+            self.seconds += time.perf_counter() - start
+        self.encoded_bytes += len(self._encoded[key])
+        return self._encoded[key]
+
+    def data_uri(self, image: Image, encoding: Union[str, ImageEncoding, None] = None,
+                 resize_mode: Optional[int] = RESIZE_JUST_RESIZE) -> str:
+        encoding = get_image_encoding(encoding)
+        return f"data:{encoding.mime_type};base64," + self.raw(image, encoding, resize_mode)
+
+
+class MetadataCache:
+    """TTL cache for discovery endpoints with single-flight loading.
+
+    Concurrent misses for the same key (from threads or from coroutines)
+    share one in-flight request instead of each issuing their own. Keys
+    without a positive TTL are never cached. ``invalidate`` bumps a
+    generation counter so a load that was in flight when the entry was
+    invalidated does not repopulate the cache with stale data.
+    """
+
+    def __init__(self, ttls: Dict[str, float], clock: Callable[[], float] = time.monotonic):
+        self.ttls = dict(ttls)
+        self.clock = clock
+        self._entries: Dict[str, Any] = {}
+        self._generations: Dict[str, int] = {}
+        self._inflight: Dict[str, threading.Event] = {}
+        self._async_inflight: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > self.clock():
+            return True, entry[1]
+        return False, None
+
+    def _store(self, key, generation, value):
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._entries[key] = (self.clock() + self.ttls[key], value)
+
+    def get(self, key: str, loader: Callable[[], Any]):
+        if self.ttls.get(key, 0) <= 0:
+            return loader()
+        while True:
+            with self._lock:
+                hit, value = self._lookup(key)
+                if hit:
+                    return value
+                event = self._inflight.get(key)
+                leader = event is None
+                if leader:
+                    event = self._inflight[key] = threading.Event()
+                generation = self._generations.get(key, 0)
+            if not leader:
+                # Re-check once the leader finishes; if it failed we take over.
+                event.wait()
+                continue
+            try:
+                value = loader()
+                self._store(key, generation, value)
+                return value
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                event.set()
+
+    async def aget(self, key: str, loader):
+        import asyncio
+
+        if self.ttls.get(key, 0) <= 0:
+            return await loader()
+        with self._lock:
+            hit, value = self._lookup(key)
+            if hit:
+                return value
+            generation = self._generations.get(key, 0)
+        future = self._async_inflight.get(key)
+        if future is None:
+
+            async def load():
+                value = await loader()
+                self._store(key, generation, value)
+                return value
+
+            future = asyncio.ensure_future(load())
+            self._async_inflight[key] = future
+            future.add_done_callback(lambda _: self._async_inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def invalidate(self, *keys: str):
+        """Drop the given keys, or every entry when called without arguments."""
+        with self._lock:
+            for key in keys or list(self._entries):
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+
+# Seconds to cache each discovery endpoint. Live endpoints such as progress
+# and memory are deliberately absent.
+DEFAULT_CACHE_TTLS = {
+    "options": 10.0,
+    "cmd-flags": 3600.0,
+    "samplers": 300.0,
+    "sd-vae": 300.0,
+    "upscalers": 300.0,
+    "latent-upscale-modes": 300.0,
+    "loras": 300.0,
+    "sd-models": 300.0,
+    "hypernetworks": 300.0,
+    "face-restorers": 300.0,
+    "realesrgan-models": 300.0,
+    "prompt-styles": 300.0,
+    "scripts": 300.0,
+    "embeddings": 300.0,
+    # Not an endpoint: the checkpoint each host has loaded, per host
+    "host-models": 10.0,
+}
+
+
+class RequestTiming:
+    """Phase durations collected while a single API call is in progress.
+
+    Phases are ``encode`` (images to base64), ``serialize`` (payload to
+    JSON), ``wait`` (upload plus server compute, until response headers
+    arrive), ``download`` (response body), ``parse`` (response JSON) and
+    ``total``. Result decoding is reported separately as ``decode`` when the
+    images are first accessed.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.host: Optional[str] = None
+        self.phases: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def merge(self, other: "RequestTiming"):
+        """Add the phases of one attempt at the request (see ``_attempt``)."""
+        for phase, seconds in other.phases.items():
+            self.add(phase, seconds)
+        self.host = other.host
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the ``q`` quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+DEFAULT_METRIC_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+
+class RequestMetrics:
+    """Aggregates per-phase request timings into histograms.
+
+    Histograms are keyed by phase, endpoint and host. ``labels`` are static
+    labels (e.g. a job id) attached to every exported series and callback
+    record. Callbacks receive one dict per completed request (and per
+    result decode) with ``endpoint``, ``host``, ``phases``, ``started`` (the
+    ``time.perf_counter()`` value when it began, if known) and the labels.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_METRIC_BUCKETS, labels: Optional[Dict[str, Any]] = None):
+        self.buckets = tuple(buckets)
+        self.labels = dict(labels or {})
+        self._histograms: Dict[Any, Histogram] = {}
+        self._callbacks: List[Callable[[Dict[str, Any]], None]] = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback: Callable[[Dict[str, Any]], None]):
+        self._callbacks.append(callback)
+
+    def observe(self, phase: str, seconds: float, endpoint: str, host: Optional[str]):
+        key = (phase, endpoint, host or "")
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def record(self, endpoint: str, host: Optional[str], phases: Dict[str, float],
+               started: Optional[float] = None):
+        for phase, seconds in phases.items():
+            self.observe(phase, seconds, endpoint, host)
+        record = {**self.labels, "endpoint": endpoint, "host": host, "phases": dict(phases), "started": started}
+        for callback in self._callbacks:
+            callback(record)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            items = sorted(self._histograms.items())
+            series = [
+                {
+                    "phase": phase,
+                    "endpoint": endpoint,
+                    "host": host,
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "buckets": dict(zip([str(b) for b in histogram.buckets] + ["+Inf"], histogram.counts)),
+                }
+                for (phase, endpoint, host), histogram in items
+            ]
+        return {"labels": self.labels, "series": series}
+
+    def to_prometheus(self, name: str = "webuiapi_request_phase_seconds") -> str:
+        def format_labels(**labels):
+            pairs = {**self.labels, **labels}
+            return ",".join(f'{key}="{value}"' for key, value in pairs.items())
+
+        lines = [f"# HELP {name} WebUI API request time by phase.", f"# TYPE {name} histogram"]
+        with self._lock:
+            for (phase, endpoint, host), histogram in sorted(self._histograms.items()):
+                labels = {"phase": phase, "endpoint": endpoint, "host": host}
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{{{format_labels(**labels, le=bound)}}} {cumulative}")
+                lines.append(f"{name}_sum{{{format_labels(**labels)}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{format_labels(**labels)}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Atomically write a Prometheus text file (``.prom``) or a JSON snapshot."""
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as output:
+            output.write(content)
+        os.replace(tmp_path, path)
+
+
+@dataclass
+class RetryPolicy:
+    """How failed generation requests are retried and hedged.
+
+    Retries use full-jitter exponential backoff and move to a different host
+    when one is available. With ``hedge`` enabled, a request that is still
+    running after the ``hedge_quantile`` latency of recent requests to the
+    same endpoint is duplicated on another host and the first successful
+    response wins. Hedging waits for ``hedge_min_samples`` observations.
+    """
+
+    max_attempts: int = 3
+    backoff_base: float = 1.0
+    backoff_max: float = 30.0
+    retry_statuses: Sequence[int] = (500, 502, 503, 504)
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_samples: int = 20
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker.
+
+    A host's circuit opens after ``failure_threshold`` consecutive failures.
+    Requests avoid it until ``reset_timeout`` seconds have passed; after that
+    it is offered again, and one more failure re-opens it immediately.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._failures: Dict[str, int] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def is_open(self, host: str) -> bool:
+        with self._lock:
+            return host in self._opened_at
+
+    def available(self, host: str) -> bool:
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            return opened_at is None or self.clock() - opened_at >= self.reset_timeout
+
+    def record(self, host: str, ok: bool):
+        with self._lock:
+            if ok:
+                self._failures.pop(host, None)
+                self._opened_at.pop(host, None)
+                return
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if host in self._opened_at or self._failures[host] >= self.failure_threshold:
+                self._opened_at[host] = self.clock()
+
+
+def _host_key(url: str) -> str:
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+class RoundRobinBalancer:
+    """Rotate through the configured baseurls regardless of host state.
+
+    Subclasses override :meth:`acquire` and :meth:`release` to take host load
+    and health into account. ``release`` is called once for every request
+    handed out by ``acquire`` with the observed latency and outcome.
+    """
+
+    def __init__(self, baseurls: Sequence[str]):
+        self.baseurls = list(baseurls)
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._index = 0
+
+    def acquire(self, preferred: Optional[Sequence[str]] = None) -> str:
+        """Return the baseurl for the next request.
+
+        ``preferred`` narrows the choice to a subset of hosts (for example the
+        ones that already have the requested checkpoint loaded); it is ignored
+        when none of them are usable.
+        """
+        with self._lock:
+            for _ in range(len(self.baseurls)):
+                baseurl = self.baseurls[self._index]
+                self._index = (self._index + 1) % len(self.baseurls)
+                if not preferred or baseurl in preferred:
+                    return baseurl
+            return baseurl
+
+    def release(self, url: str, latency: Optional[float] = None, ok: bool = True):
+        pass
+
+    def baseurl_for(self, url: str) -> Optional[str]:
+        key = _host_key(url)
+        for baseurl in self.baseurls:
+            if _host_key(baseurl) == key:
+                return baseurl
+        return None
+
+
+@dataclass
+class HostStats:
+    outstanding: int = 0
+    latency: Optional[float] = None
+    failures: int = 0
+    ejected_until: float = 0.0
+    probing: bool = False
+
+
+class LeastLoadedBalancer(RoundRobinBalancer):
+    """Pick the host with the fewest in-flight requests and lowest latency.
+
+    Latency is tracked as an exponentially weighted moving average. A host is
+    ejected after ``max_failures`` consecutive failures and only re-admitted
+    once ``probe`` succeeds against it, at most every ``probe_interval``
+    seconds. Probes run on a background thread, so ``acquire`` never waits
+    for one (and never blocks an event loop it is called from). When every
+    host is ejected the one due for probing first is used so requests keep
+    flowing.
+    """
+
+    def __init__(
+        self,
+        baseurls: Sequence[str],
+        probe: Optional[Callable[[str], bool]] = None,
+        max_failures: int = 3,
+        probe_interval: float = 10.0,
+        latency_alpha: float = 0.3,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(baseurls)
+        self.probe = probe
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.latency_alpha = latency_alpha
+        self.clock = clock
+        self.stats = {baseurl: HostStats() for baseurl in self.baseurls}
+
+    def is_ejected(self, baseurl: str) -> bool:
+        return self.stats[baseurl].failures >= self.max_failures
+
+    def _due_for_probe(self, baseurl: str, now: float) -> bool:
+        """Mark an ejected host as being probed if its probe is due; call with the lock held."""
+        stats = self.stats[baseurl]
+        if stats.probing or now < stats.ejected_until:
+            return False
+        if self.probe is None:
+            stats.ejected_until = now + self.probe_interval
+            return False
+        stats.probing = True
+        return True
+
+    def _run_probe(self, baseurl: str):
+        try:
+            healthy = bool(self.probe(baseurl))
+        except Exception:
+            healthy = False
+        with self._lock:
+            stats = self.stats[baseurl]
+            stats.probing = False
+            if healthy:
+                stats.failures = 0
+                stats.ejected_until = 0.0
+            else:
+                stats.ejected_until = self.clock() + self.probe_interval
+
+    def acquire(self, preferred: Optional[Sequence[str]] = None) -> str:
+        with self._lock:
+            now = self.clock()
+            ejected = [b for b in self.baseurls if self.is_ejected(b)]
+            probes = [b for b in ejected if self._due_for_probe(b, now)]
+            candidates = [b for b in self.baseurls if b not in ejected]
+            if not candidates:
+                candidates = [min(self.baseurls, key=lambda b: self.stats[b].ejected_until)]
+            if preferred:
+                candidates = [b for b in candidates if b in preferred] or candidates
+
+            # Rotate the starting point so ties are spread across hosts.
+            offset = self._index % len(self.baseurls)
+            self._index += 1
+            ordered = self.baseurls[offset:] + self.baseurls[:offset]
+            baseurl = min(
+                (b for b in ordered if b in candidates),
+                key=lambda b: (self.stats[b].outstanding, self.stats[b].latency or 0.0),
+            )
+            self.stats[baseurl].outstanding += 1
+        for probe_url in probes:
+            threading.Thread(target=self._run_probe, args=(probe_url,),
+                             name="balancer-probe", daemon=True).start()
+        return baseurl
+
+    def release(self, url: str, latency: Optional[float] = None, ok: bool = True):
+        baseurl = self.baseurl_for(url)
+        if baseurl is None:
+            return
+        with self._lock:
+            stats = self.stats[baseurl]
+            stats.outstanding = max(0, stats.outstanding - 1)
+            if ok:
+                stats.failures = 0
+                if latency is not None:
+                    if stats.latency is None:
+                        stats.latency = latency
+                    else:
+                        stats.latency += self.latency_alpha * (latency - stats.latency)
+            else:
+                stats.failures += 1
+                if stats.failures == self.max_failures:
+                    stats.ejected_until = self.clock() + self.probe_interval
 
-        bytes_data = output_bytes.getvalue()
 
-    return str(base64.b64encode(bytes_data), "utf-8")
+BALANCERS = {
+    "round_robin": RoundRobinBalancer,
+    "least_loaded": LeastLoadedBalancer,
+}
 
 
 class WebUIApi:
@@ -162,6 +883,19 @@ class WebUIApi:
         use_https=False,
         username=None,
         password=None,
+        async_limit=100,
+        async_limit_per_host=16,
+        async_keepalive_timeout=30.0,
+        balancer: Union[str, RoundRobinBalancer] = "round_robin",
+        probe_timeout=2.0,
+        metadata_timeout: Optional[float] = None,
+        image_encoding: Union[str, ImageEncoding] = "png",
+        controlnet_encoding: Union[str, ImageEncoding, None] = None,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        metrics: Optional[RequestMetrics] = None,
+        pre_resize: bool = False,
     ):
         hosts_list = self._normalize_hosts(hosts) or self._normalize_hosts(host)
         scheme = "https" if use_https else "http"
@@ -172,11 +906,58 @@ class WebUIApi:
 
         self.baseurls = baseurls
         self.baseurl = baseurls[0]
-        self._baseurl_index = 0
+        self.probe_timeout = probe_timeout
+        # Timeout for GET requests (discovery endpoints, progress, host
+        # models); None waits as long as the server takes.
+        self.metadata_timeout = metadata_timeout
+        # ControlNet hints tolerate lossy encodings (e.g. "jpeg:85") far better
+        # than init images, so they can be configured separately.
+        self.image_encoding = get_image_encoding(image_encoding)
+        self.controlnet_encoding = (
+            get_image_encoding(controlnet_encoding)
+            if controlnet_encoding is not None
+            else self.image_encoding
+        )
+        if isinstance(balancer, str):
+            if balancer not in BALANCERS:
+                raise ValueError(f"Unknown balancer {balancer!r}, expected one of {sorted(BALANCERS)}")
+            balancer_class = BALANCERS[balancer]
+            if balancer_class is RoundRobinBalancer:
+                balancer = balancer_class(baseurls)
+            else:
+                balancer = balancer_class(baseurls, probe=self._probe_host)
+        self.balancer = balancer
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._latencies: Dict[str, deque] = {}
+        self.metrics = metrics
+        # Downscale init images and ControlNet inputs to the request size
+        # before encoding; the totals are raw pixel bytes across requests.
+        self.pre_resize = pre_resize
+        self.pre_resize_stats = {"requests": 0, "images": 0, "pixel_bytes_before": 0,
+                                 "pixel_bytes_after": 0, "encoded_bytes": 0}
+        self._pre_resize_lock = threading.Lock()
         self.default_sampler = sampler
         self.default_steps = steps
 
         self.session = requests.Session()
+        self.cache = MetadataCache({**DEFAULT_CACHE_TTLS, **(cache_ttls or {})})
+
+        # Checkpoint affinity: the model requests should run with, the model
+        # each host is known to have loaded, and background switches.
+        self.model = None
+        self.host_models: Dict[str, Optional[str]] = {}
+        self._model_lock = threading.Lock()
+        self._model_switches: Dict[str, Any] = {}
+        self._switch_pool = None
+
+        # The aiohttp session is created lazily on first async use because it
+        # must be bound to the running event loop.
+        self.async_limit = async_limit
+        self.async_limit_per_host = async_limit_per_host
+        self.async_keepalive_timeout = async_keepalive_timeout
+        self._async_session = None
+        self._async_loop = None
 
         if username and password:
             self.set_auth(username, password)
@@ -185,7 +966,7 @@ class WebUIApi:
 
         # Reset rotation so the first user-initiated request starts from the
         # beginning of the baseurl list.
-        self._baseurl_index = 0
+        self.balancer.reset()
 
     @staticmethod
     def _normalize_hosts(hosts: Union[str, Sequence[str], None]) -> List[str]:
@@ -195,10 +976,151 @@ class WebUIApi:
             return [hosts]
         return [h for h in hosts if h]
 
+    def close(self):
+        """Close the synchronous HTTP session."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def __aenter__(self):
+        await self._get_async_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def _get_async_session(self):
+        """Return the shared aiohttp session, creating it for the running loop.
+
+        A session left open on another loop is closed first: on that loop if
+        it is still running, here if it has been closed. A loop that is open
+        but idle cannot close it, so call ``aclose`` before switching loops.
+        """
+        import asyncio
+
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        session = self._async_session
+        if session is not None and not session.closed and self._async_loop is not loop:
+            previous = self._async_loop
+            if previous.is_closed():
+                # Its connections went with the loop; this releases the connector
+                await session.close()
+            elif previous.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), previous)
+            else:
+                raise RuntimeError("The aiohttp session belongs to another event loop; "
+                                   "call aclose() from that loop before using a new one")
+        if session is None or session.closed or self._async_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.async_limit,
+                limit_per_host=self.async_limit_per_host,
+                keepalive_timeout=self.async_keepalive_timeout,
+            )
+            self._async_session = aiohttp.ClientSession(connector=connector)
+            self._async_loop = loop
+        return self._async_session
+
+    async def aclose(self):
+        """Close the shared aiohttp session and its pooled connections."""
+        session = self._async_session
+        self._async_session = None
+        self._async_loop = None
+        if session is not None and not session.closed:
+            await session.close()
+
+    def _async_auth(self):
+        import aiohttp
+
+        if self.session.auth:
+            return aiohttp.BasicAuth(self.session.auth[0], self.session.auth[1])
+        return None
+
     def _next_baseurl(self) -> str:
-        baseurl = self.baseurls[self._baseurl_index]
-        self._baseurl_index = (self._baseurl_index + 1) % len(self.baseurls)
-        return baseurl
+        hosts = self._model_hosts() or self.baseurls
+        available = [b for b in hosts if self.circuit_breaker.available(b)]
+        return self.balancer.acquire(available or hosts)
+
+    def _model_hosts(self) -> Optional[List[str]]:
+        """Hosts that already have ``self.model`` loaded, if any."""
+        if self.model is None:
+            return None
+        with self._model_lock:
+            ready = [b for b in self.baseurls if self.host_models.get(b) == self.model]
+        return ready or None
+
+    @staticmethod
+    def _host_url(baseurl: str, endpoint: str) -> str:
+        return f"{baseurl.rstrip('/')}/{endpoint.lstrip('/')}"
+
+    def _probe_host(self, baseurl: str) -> bool:
+        """Return True when ``baseurl`` answers ``/progress`` successfully."""
+        url = f"{baseurl.rstrip('/')}/progress"
+        response = self.session.get(url, timeout=self.probe_timeout)
+        return response.status_code == 200
+
+    @staticmethod
+    def _serialize(timing, kwargs):
+        """Pre-serialize a JSON body so its cost shows up in ``timing``."""
+        if timing is not None and kwargs.get("json") is not None:
+            start = time.perf_counter()
+            kwargs["data"] = json.dumps(kwargs.pop("json"))
+            kwargs["headers"] = {"Content-Type": "application/json"}
+            timing.add("serialize", time.perf_counter() - start)
+        return kwargs
+
+    def _send(self, method: str, url: str, timing: Optional[RequestTiming] = None, **kwargs):
+        """Issue a request through the sync session and report it to the balancer."""
+        kwargs = self._serialize(timing, kwargs)
+        start = time.monotonic()
+        try:
+            response = getattr(self.session, method)(url=url, **kwargs)
+        except Exception:
+            self.balancer.release(url, ok=False)
+            raise
+        elapsed = time.monotonic() - start
+        self.balancer.release(url, latency=elapsed, ok=response.status_code < 500)
+        if timing is not None:
+            # requests reports the time until the response headers were parsed
+            wait = min(elapsed, response.elapsed.total_seconds())
+            timing.add("wait", wait)
+            timing.add("download", elapsed - wait)
+            timing.host = self.balancer.baseurl_for(url)
+        return response
+
+    def _get(self, url):
+        if self.metadata_timeout is not None:
+            return self._send("get", url, timeout=self.metadata_timeout)
+        return self._send("get", url)
+
+    def _post(self, url, json=None, timing: Optional[RequestTiming] = None):
+        return self._send("post", url, timing=timing, json=json)
+
+    def _start_timing(self, url_or_endpoint: str) -> Optional[RequestTiming]:
+        if self.metrics is None:
+            return None
+        endpoint = urlparse(url_or_endpoint).path
+        for baseurl in self.baseurls:
+            prefix = urlparse(baseurl).path.rstrip("/") + "/"
+            if endpoint.startswith(prefix):
+                endpoint = endpoint[len(prefix):]
+                break
+        return RequestTiming(endpoint.strip("/"))
+
+    def _finish_timing(self, timing: Optional[RequestTiming], result):
+        if timing is None:
+            return result
+        timing.add("total", time.perf_counter() - timing.started)
+        self.metrics.record(timing.endpoint, timing.host, timing.phases, started=timing.started)
+        endpoint, host, metrics = timing.endpoint, timing.host, self.metrics
+        result.on_decode = lambda seconds: metrics.record(
+            endpoint, host, {"decode": seconds}, started=time.perf_counter() - seconds)
+        return result
 
     def _build_url(self, endpoint: str, include_api_prefix: bool = True) -> str:
         normalized_endpoint = endpoint.lstrip("/")
@@ -226,44 +1148,37 @@ class WebUIApi:
         self.session.auth = (username, password)
         self.check_controlnet()
 
-    def _to_api_result(self, response):
+    def _to_api_result(self, response, timing: Optional[RequestTiming] = None):
         if response.status_code != 200:
             raise RuntimeError(response.status_code, response.text)
 
+        start = time.perf_counter()
         r = response.json()
-        images = []
-        if "images" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(i))) for i in r["images"]]
-        elif "image" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r["image"])))]
+        if timing is not None:
+            timing.add("parse", time.perf_counter() - start)
+        return self._result_from_json(r)
 
-        info = ""
-        if "info" in r.keys():
-            try:
-                info = json.loads(r["info"])
-            except:
-                info = r["info"]
-        elif "html_info" in r.keys():
-            info = r["html_info"]
-        elif "caption" in r.keys():
-            info = r["caption"]
-
-        parameters = ""
-        if "parameters" in r.keys():
-            parameters = r["parameters"]
-
-        return WebUIApiResult(images, parameters, info)
-
-    async def _to_api_result_async(self, response):
+    async def _to_api_result_async(self, response, timing: Optional[RequestTiming] = None):
         if response.status != 200:
             raise RuntimeError(response.status, await response.text())
 
-        r = await response.json()
+        if timing is None:
+            return self._result_from_json(await response.json())
+        start = time.perf_counter()
+        body = await response.read()
+        parsed = time.perf_counter()
+        r = json.loads(body)
+        timing.add("download", parsed - start)
+        timing.add("parse", time.perf_counter() - parsed)
+        return self._result_from_json(r)
+
+    @staticmethod
+    def _result_from_json(r):
         images = []
         if "images" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(i))) for i in r["images"]]
+            images = list(r["images"])
         elif "image" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r["image"])))]
+            images = [r["image"]]
 
         info = ""
         if "info" in r.keys():
@@ -337,6 +1252,10 @@ class WebUIApi:
             steps = self.default_steps
         if script_args is None:
             script_args = []
+        alwayson_scripts = dict(alwayson_scripts)
+        # With hires fix the final size differs from width x height
+        encode_cache = self._encode_cache(None if enable_hr else (width, height))
+        timing = self._start_timing("txt2img")
         payload = {
             "enable_hr": enable_hr,
             "hr_scale": hr_scale,
@@ -382,39 +1301,279 @@ class WebUIApi:
         }
 
         if use_deprecated_controlnet and controlnet_units and len(controlnet_units) > 0:
-            payload["controlnet_units"] = [x.to_dict() for x in controlnet_units]
+            payload["controlnet_units"] = [x.to_dict(self.controlnet_encoding, encode_cache) for x in controlnet_units]
             return self.custom_post(
                 "controlnet/txt2img", payload=payload, use_async=use_async
             )
 
         if controlnet_units and len(controlnet_units) > 0:
             payload["alwayson_scripts"]["ControlNet"] = {
-                "args": [x.to_dict() for x in controlnet_units]
+                "args": [x.to_dict(self.controlnet_encoding, encode_cache) for x in controlnet_units]
             }
         elif self.has_controlnet:
             # workaround : if not passed, webui will use previous args!
             payload["alwayson_scripts"]["ControlNet"] = {"args": []}
 
-        return self.post_and_get_api_result(
-            self._api_url("txt2img"), payload, use_async
-        )
-
-    def post_and_get_api_result(self, url, json, use_async):
+        url = self._api_url("txt2img")
+        self._record_pre_resize(encode_cache, 0)
+        if timing is not None:
+            timing.add("encode", encode_cache.seconds)
+        return self.post_and_get_api_result(url, payload, use_async, timing=timing)
+
+    def _encode_cache(self, size: Optional[Tuple[int, int]]) -> ImageEncodeCache:
+        return ImageEncodeCache(resize_to=size if self.pre_resize else None)
+
+    def _record_pre_resize(self, encode_cache: ImageEncodeCache, images: int):
+        if encode_cache.resize_to is None:
+            return
+        with self._pre_resize_lock:
+            self.pre_resize_stats["requests"] += 1
+            self.pre_resize_stats["images"] += images
+            self.pre_resize_stats["pixel_bytes_before"] += encode_cache.pixel_bytes_before
+            self.pre_resize_stats["pixel_bytes_after"] += encode_cache.pixel_bytes_after
+            self.pre_resize_stats["encoded_bytes"] += encode_cache.encoded_bytes
+
+    def post_and_get_api_result(self, url, json, use_async, timing: Optional[RequestTiming] = None):
+        if timing is None:
+            timing = self._start_timing(url)
         if use_async:
             import asyncio
 
-            return asyncio.ensure_future(self.async_post(url=url, json=json))
+            return asyncio.ensure_future(self.async_post(url=url, json=json, timing=timing))
         else:
-            response = self.session.post(url=url, json=json)
-            return self._to_api_result(response)
+            result = self._call_with_retry(
+                url, lambda u, t: self._to_api_result(self._post(u, json=json, timing=t), t), timing
+            )
+            return self._finish_timing(timing, result)
+
+    def _rebase_url(self, url: str, baseurl: str) -> str:
+        target = urlparse(baseurl)
+        return urlunparse(urlparse(url)._replace(scheme=target.scheme, netloc=target.netloc))
+
+    def _pick_baseurl(self, exclude=(), allow_repeat=True) -> Optional[str]:
+        """Acquire a host for a retry or hedge, avoiding ``exclude`` and open circuits."""
+        hosts = self._model_hosts() or self.baseurls
+        untried = [b for b in hosts if b not in exclude]
+        if not untried:
+            if not allow_repeat:
+                return None
+            untried = hosts
+        candidates = [b for b in untried if self.circuit_breaker.available(b)] or untried
+        return self.balancer.acquire(candidates)
+
+    def _is_retryable(self, error: Exception) -> bool:
+        import asyncio
+
+        if isinstance(error, RuntimeError) and error.args:
+            return error.args[0] in self.retry_policy.retry_statuses
+        if isinstance(error, (requests.ConnectionError, requests.Timeout, asyncio.TimeoutError)):
+            return True
+        try:
+            import aiohttp
+        except ImportError:
+            return False
+        return isinstance(error, aiohttp.ClientConnectionError)
+
+    def _record_attempt(self, url, start, error=None):
+        baseurl = self.balancer.baseurl_for(url) or url
+        if error is None:
+            self.circuit_breaker.record(baseurl, True)
+            samples = self._latencies.setdefault(urlparse(url).path, deque(maxlen=200))
+            samples.append(time.monotonic() - start)
+        elif self._is_retryable(error):
+            self.circuit_breaker.record(baseurl, False)
+
+    def _hedge_delay(self, url) -> Optional[float]:
+        policy = self.retry_policy
+        samples = self._latencies.get(urlparse(url).path)
+        if not policy.hedge or len(self.baseurls) < 2 or not samples or len(samples) < policy.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(policy.hedge_quantile * len(ordered)))]
 
-    async def async_post(self, url, json):
-        import aiohttp
+    @staticmethod
+    def _attempt_timing(timing: Optional[RequestTiming]) -> Optional[RequestTiming]:
+        return RequestTiming(timing.endpoint) if timing is not None else None
+
+    def _attempt(self, url, attempt_fn, timing: Optional[RequestTiming] = None):
+        """Run ``attempt_fn(url, timing)`` once; return its result and ``timing``.
+
+        Every attempt, including a hedge racing the primary, gets its own
+        ``timing`` so only the attempt that produced the result is recorded.
+        """
+        start = time.monotonic()
+        try:
+            result = attempt_fn(url, timing)
+        except Exception as error:
+            self._record_attempt(url, start, error)
+            raise
+        self._record_attempt(url, start)
+        return result, timing
+
+    def _start_attempt(self, url, attempt_fn, timing):
+        """Run ``_attempt`` on a thread of its own and return its future.
+
+        Hedged attempts are not queued behind other callers' requests in a
+        shared pool: the hedge delay counts from when the primary is sent.
+        """
+        from concurrent.futures import Future
 
-        async with aiohttp.ClientSession() as session:
-            auth = aiohttp.BasicAuth(self.session.auth[0], self.session.auth[1]) if self.session.auth else None
-            async with session.post(url, json=json, auth=auth) as response:
-                return await self._to_api_result_async(response)
+        future = Future()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._attempt(url, attempt_fn, timing))
+            except BaseException as error:
+                future.set_exception(error)
+
+        threading.Thread(target=run, name="hedged-attempt", daemon=True).start()
+        return future
+
+    def _hedged_attempt(self, url, attempt_fn, tried, timing=None):
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        delay = self._hedge_delay(url)
+        if delay is None:
+            return self._attempt(url, attempt_fn, self._attempt_timing(timing))
+        pending = {self._start_attempt(url, attempt_fn, self._attempt_timing(timing))}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            hedge_baseurl = self._pick_baseurl(exclude=tried, allow_repeat=False)
+            if hedge_baseurl is not None:
+                tried.append(hedge_baseurl)
+                hedge_url = self._rebase_url(url, hedge_baseurl)
+                pending.add(self._start_attempt(hedge_url, attempt_fn, self._attempt_timing(timing)))
+        error = None
+        while done or pending:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        raise error
+
+    def _call_with_retry(self, url, attempt_fn, timing: Optional[RequestTiming] = None):
+        """Run ``attempt_fn(url, timing)``, retrying transient failures on other hosts.
+
+        The phases of the attempt whose result is returned are added to ``timing``.
+        """
+        policy = self.retry_policy
+        tried = []
+        for attempt in range(1, policy.max_attempts + 1):
+            if attempt > 1:
+                time.sleep(policy.backoff(attempt - 1))
+                url = self._rebase_url(url, self._pick_baseurl(exclude=tried))
+            tried.append(self.balancer.baseurl_for(url))
+            try:
+                result, attempt_timing = self._hedged_attempt(url, attempt_fn, tried, timing)
+            except Exception as error:
+                if attempt >= policy.max_attempts or not self._is_retryable(error):
+                    raise
+                print(f"Request to {url} failed ({error!r}), retrying ({attempt}/{policy.max_attempts})")
+                continue
+            if timing is not None:
+                timing.merge(attempt_timing)
+            return result
+
+    async def _attempt_async(self, url, attempt_fn, timing: Optional[RequestTiming] = None):
+        start = time.monotonic()
+        try:
+            result = await attempt_fn(url, timing)
+        except Exception as error:
+            self._record_attempt(url, start, error)
+            raise
+        self._record_attempt(url, start)
+        return result, timing
+
+    async def _hedged_attempt_async(self, url, attempt_fn, tried, timing=None):
+        import asyncio
+
+        delay = self._hedge_delay(url)
+        if delay is None:
+            return await self._attempt_async(url, attempt_fn, self._attempt_timing(timing))
+        pending = {asyncio.ensure_future(self._attempt_async(url, attempt_fn, self._attempt_timing(timing)))}
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            hedge_baseurl = self._pick_baseurl(exclude=tried, allow_repeat=False)
+            if hedge_baseurl is not None:
+                tried.append(hedge_baseurl)
+                hedge_url = self._rebase_url(url, hedge_baseurl)
+                pending.add(asyncio.ensure_future(
+                    self._attempt_async(hedge_url, attempt_fn, self._attempt_timing(timing))))
+        error = None
+        try:
+            while done or pending:
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for future in pending:
+                future.cancel()
+        raise error
+
+    async def _call_with_retry_async(self, url, attempt_fn, timing: Optional[RequestTiming] = None):
+        import asyncio
+
+        policy = self.retry_policy
+        tried = []
+        for attempt in range(1, policy.max_attempts + 1):
+            if attempt > 1:
+                await asyncio.sleep(policy.backoff(attempt - 1))
+                url = self._rebase_url(url, self._pick_baseurl(exclude=tried))
+            tried.append(self.balancer.baseurl_for(url))
+            try:
+                result, attempt_timing = await self._hedged_attempt_async(url, attempt_fn, tried, timing)
+            except Exception as error:
+                if attempt >= policy.max_attempts or not self._is_retryable(error):
+                    raise
+                print(f"Request to {url} failed ({error!r}), retrying ({attempt}/{policy.max_attempts})")
+                continue
+            if timing is not None:
+                timing.merge(attempt_timing)
+            return result
+
+    async def _async_send(self, method, url, handler, timing: Optional[RequestTiming] = None, **kwargs):
+        session = await self._get_async_session()
+        kwargs = self._serialize(timing, kwargs)
+        start = time.monotonic()
+        ok = False
+        try:
+            async with session.request(
+                method, url, auth=self._async_auth(), **kwargs
+            ) as response:
+                ok = response.status < 500
+                if timing is not None:
+                    timing.add("wait", time.monotonic() - start)
+                    timing.host = self.balancer.baseurl_for(url)
+                return await handler(response)
+        finally:
+            self.balancer.release(url, latency=time.monotonic() - start, ok=ok)
+
+    async def async_post(self, url, json, timing: Optional[RequestTiming] = None):
+        if timing is None:
+            timing = self._start_timing(url)
+
+        async def attempt(u, attempt_timing):
+            async def handler(response):
+                return await self._to_api_result_async(response, attempt_timing)
+
+            return await self._async_send("POST", u, handler, timing=attempt_timing, json=json)
+
+        result = await self._call_with_retry_async(url, attempt, timing)
+        return self._finish_timing(timing, result)
+
+    async def async_get(self, url):
+        async def read_json(response):
+            return await response.json()
+
+        return await self._async_send("GET", url, read_json)
 
     def     img2img(
         self,
@@ -474,9 +1633,18 @@ class WebUIApi:
             steps = self.default_steps
         if script_args is None:
             script_args = []
+        if len(images) > 1 and any(unit is not None and unit.uses_init_image for unit in controlnet_units or []):
+            raise ValueError(
+                "ControlNet units without an input image would guide every batch item "
+                "with the first init image; send one image per request"
+            )
+        # Copy so ControlNet args never leak into the shared default dict.
+        alwayson_scripts = dict(alwayson_scripts)
+        encode_cache = self._encode_cache((width, height))
+        timing = self._start_timing("img2img")
 
         payload = {
-            "init_images": [b64_img(x) for x in images],
+            "init_images": [encode_cache.data_uri(x, self.image_encoding, resize_mode) for x in images],
             "resize_mode": resize_mode,
             "denoising_strength": denoising_strength,
             "mask_blur": mask_blur,
@@ -523,25 +1691,27 @@ class WebUIApi:
 
 
         if mask_image is not None:
-            payload["mask"] = b64_img(mask_image)
+            payload["mask"] = encode_cache.data_uri(mask_image, self.image_encoding, resize_mode)
 
         if use_deprecated_controlnet and controlnet_units and len(controlnet_units) > 0:
-            payload["controlnet_units"] = [x.to_dict() for x in controlnet_units]
+            payload["controlnet_units"] = [x.to_dict(self.controlnet_encoding, encode_cache) for x in controlnet_units]
             return self.custom_post(
                 "controlnet/img2img", payload=payload, use_async=use_async
             )
 
         if controlnet_units and len(controlnet_units) > 0:
             payload["alwayson_scripts"]["ControlNet"] = {
-                "args": [x.to_dict() for x in controlnet_units]
+                "args": [x.to_dict(self.controlnet_encoding, encode_cache) for x in controlnet_units]
             }
         elif self.has_controlnet:
             payload["alwayson_scripts"]["ControlNet"] = {"args": []}
 
 
-        return self.post_and_get_api_result(
-            self._api_url("img2img"), payload, use_async
-        )
+        url = self._api_url("img2img")
+        self._record_pre_resize(encode_cache, len(images))
+        if timing is not None:
+            timing.add("encode", encode_cache.seconds)
+        return self.post_and_get_api_result(url, payload, use_async, timing=timing)
 
     def extra_single_image(
         self,
@@ -575,7 +1745,7 @@ class WebUIApi:
             "upscaler_2": upscaler_2,
             "extras_upscaler_2_visibility": extras_upscaler_2_visibility,
             "upscale_first": upscale_first,
-            "image": b64_img(image),
+            "image": b64_img(image, self.image_encoding),
         }
 
         return self.post_and_get_api_result(
@@ -606,7 +1776,7 @@ class WebUIApi:
                 raise RuntimeError("len(images) != len(name_list)")
         else:
             name_list = [f"image{i + 1:05}" for i in range(len(images))]
-        images = [b64_img(x) for x in images]
+        images = [b64_img(x, self.image_encoding) for x in images]
 
         image_list = []
         for name, image in zip(name_list, images):
@@ -639,107 +1809,141 @@ class WebUIApi:
             "image": b64_img(image),
         }
 
-        response = self.session.post(url=self._api_url("png-info"), json=payload)
+        response = self._post(self._api_url("png-info"), json=payload)
         return self._to_api_result(response)
 
     # XXX always returns empty info (2022/12/26)
     def interrogate(self, image):
         payload = {
-            "image": b64_img(image),
+            "image": b64_img(image, self.image_encoding),
         }
 
-        response = self.session.post(url=self._api_url("interrogate"), json=payload)
+        response = self._post(self._api_url("interrogate"), json=payload)
         return self._to_api_result(response)
 
     def interrupt(self):
-        response = self.session.post(url=self._api_url("interrupt"))
+        response = self._post(self._api_url("interrupt"))
         return response.json()
 
     def skip(self):
-        response = self.session.post(url=self._api_url("skip"))
+        response = self._post(self._api_url("skip"))
         return response.json()
 
+    def _cached_get(self, endpoint):
+        return self.cache.get(endpoint, lambda: self._get(self._api_url(endpoint)).json())
+
+    async def _cached_get_async(self, endpoint):
+        return await self.cache.aget(endpoint, lambda: self.async_get(self._api_url(endpoint)))
+
+    def invalidate_cache(self, *endpoints):
+        """Forget cached discovery results, e.g. after changing the WebUI out of band."""
+        self.cache.invalidate(*endpoints)
+
     def get_options(self):
-        response = self.session.get(url=self._api_url("options"))
-        return response.json()
+        return self._cached_get("options")
 
     def set_options(self, options):
-        response = self.session.post(url=self._api_url("options"), json=options)
+        response = self._post(self._api_url("options"), json=options)
+        self.cache.invalidate("options")
         return response.json()
 
 
     def get_progress(self):
-        response = self.session.get(url=self._api_url("progress"))
+        response = self._get(self._api_url("progress"))
         return response.json()
 
     def get_cmd_flags(self):
-        response = self.session.get(url=self._api_url("cmd-flags"))
-        return response.json()
+        return self._cached_get("cmd-flags")
 
     def get_samplers(self):
-        response = self.session.get(url=self._api_url("samplers"))
-        return response.json()
+        return self._cached_get("samplers")
 
     def get_sd_vae(self):
-        response = self.session.get(url=self._api_url("sd-vae"))
-        return response.json()
+        return self._cached_get("sd-vae")
 
     def get_upscalers(self):
-        response = self.session.get(url=self._api_url("upscalers"))
-        return response.json()
+        return self._cached_get("upscalers")
 
     def get_latent_upscale_modes(self):
-        response = self.session.get(url=self._api_url("latent-upscale-modes"))
-        return response.json()
+        return self._cached_get("latent-upscale-modes")
 
     def get_loras(self):
-        response = self.session.get(url=self._api_url("loras"))
-        return response.json()
+        return self._cached_get("loras")
 
     def get_sd_models(self):
-        response = self.session.get(url=self._api_url("sd-models"))
-        return response.json()
+        return self._cached_get("sd-models")
 
     def get_hypernetworks(self):
-        response = self.session.get(url=self._api_url("hypernetworks"))
-        return response.json()
+        return self._cached_get("hypernetworks")
 
     def get_face_restorers(self):
-        response = self.session.get(url=self._api_url("face-restorers"))
-        return response.json()
+        return self._cached_get("face-restorers")
 
     def get_realesrgan_models(self):
-        response = self.session.get(url=self._api_url("realesrgan-models"))
-        return response.json()
+        return self._cached_get("realesrgan-models")
 
     def get_prompt_styles(self):
-        response = self.session.get(url=self._api_url("prompt-styles"))
-        return response.json()
+        return self._cached_get("prompt-styles")
 
     def get_artist_categories(self):  # deprecated ?
-        response = self.session.get(url=self._api_url("artist-categories"))
+        response = self._get(self._api_url("artist-categories"))
         return response.json()
 
     def get_artists(self):  # deprecated ?
-        response = self.session.get(url=self._api_url("artists"))
+        response = self._get(self._api_url("artists"))
         return response.json()
 
     def refresh_checkpoints(self):
-        response = self.session.post(url=self._api_url("refresh-checkpoints"))
+        response = self._post(self._api_url("refresh-checkpoints"))
+        self.cache.invalidate("sd-models", "options")
         return response.json()
 
     def get_scripts(self):
-        response = self.session.get(url=self._api_url("scripts"))
-        return response.json()
+        return self._cached_get("scripts")
 
     def get_embeddings(self):
-        response = self.session.get(url=self._api_url("embeddings"))
-        return response.json()
+        return self._cached_get("embeddings")
 
     def get_memory(self):
-        response = self.session.get(url=self._api_url("memory"))
+        response = self._get(self._api_url("memory"))
         return response.json()
 
+    async def get_options_async(self):
+        return await self._cached_get_async("options")
+
+    async def get_progress_async(self):
+        return await self.async_get(self._api_url("progress"))
+
+    async def get_cmd_flags_async(self):
+        return await self._cached_get_async("cmd-flags")
+
+    async def get_samplers_async(self):
+        return await self._cached_get_async("samplers")
+
+    async def get_sd_vae_async(self):
+        return await self._cached_get_async("sd-vae")
+
+    async def get_upscalers_async(self):
+        return await self._cached_get_async("upscalers")
+
+    async def get_loras_async(self):
+        return await self._cached_get_async("loras")
+
+    async def get_sd_models_async(self):
+        return await self._cached_get_async("sd-models")
+
+    async def get_scripts_async(self):
+        return await self._cached_get_async("scripts")
+
+    async def get_embeddings_async(self):
+        return await self._cached_get_async("embeddings")
+
+    async def get_memory_async(self):
+        return await self.async_get(self._api_url("memory"))
+
+    async def custom_get_async(self, endpoint, baseurl=False):
+        return await self.async_get(self.get_endpoint(endpoint, baseurl))
+
     def get_endpoint(self, endpoint, baseurl):
         if baseurl:
             return self._api_url(endpoint)
@@ -747,18 +1951,12 @@ class WebUIApi:
 
     def custom_get(self, endpoint, baseurl=False):
         url = self.get_endpoint(endpoint, baseurl)
-        response = self.session.get(url=url)
+        response = self._get(url)
         return response.json()
 
     def custom_post(self, endpoint, payload={}, baseurl=False, use_async=False):
         url = self.get_endpoint(endpoint, baseurl)
-        if use_async:
-            import asyncio
-
-            return asyncio.ensure_future(self.async_post(url=url, json=payload))
-        else:
-            response = self.session.post(url=url, json=payload)
-            return self._to_api_result(response)
+        return self.post_and_get_api_result(url, payload, use_async)
 
     def controlnet_version(self):
         r = self.custom_get("controlnet/version")
@@ -775,7 +1973,7 @@ class WebUIApi:
     def controlnet_detect(
         self, images, module="none", processor_res=512, threshold_a=64, threshold_b=64
     ):
-        input_images = [b64_img(x) for x in images]
+        input_images = [b64_img(x, self.controlnet_encoding) for x in images]
         payload = {
             "controlnet_module": module,
             "controlnet_input_images": input_images,
@@ -789,10 +1987,10 @@ class WebUIApi:
     def util_get_model_names(self):
         return sorted([x["title"] for x in self.get_sd_models()])
 
-    def util_set_model(self, name, find_closest=True):
-        if find_closest:
-            name = name.lower()
+    def util_set_model(self, name, find_closest=True, wait=False):
         models = self.util_get_model_names()
+        if find_closest and name not in models:
+            name = name.lower()
         found_model = None
         if name in models:
             found_model = name
@@ -812,13 +2010,91 @@ class WebUIApi:
             found_model = max_model
         if found_model:
             print(f"loading {found_model}")
-            options = {}
-            options["sd_model_checkpoint"] = found_model
-            self.set_options(options)
+            self.util_switch_model(found_model, wait=wait)
             print(f"model changed to {found_model}")
         else:
             print("model not found")
 
+    def util_get_host_models(self) -> Dict[str, Optional[str]]:
+        """Ask every host which checkpoint it has loaded, in parallel."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        kwargs = {} if self.metadata_timeout is None else {"timeout": self.metadata_timeout}
+
+        def fetch(baseurl):
+            try:
+                response = self.session.get(url=self._host_url(baseurl, "options"), **kwargs)
+                return response.json().get("sd_model_checkpoint")
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(self.baseurls)) as pool:
+            loaded = dict(zip(self.baseurls, pool.map(fetch, self.baseurls)))
+        with self._model_lock:
+            self.host_models.update(loaded)
+        return loaded
+
+    def util_get_cached_host_models(self) -> Dict[str, Optional[str]]:
+        """``util_get_host_models``, asking the hosts at most once per "host-models" TTL.
+
+        Switches made through this client are tracked in ``host_models`` as
+        they finish, so a cached answer stays accurate for them.
+        """
+        self.cache.get("host-models", self.util_get_host_models)
+        with self._model_lock:
+            return dict(self.host_models)
+
+    def _switch_host_model(self, baseurl, model):
+        response = self.session.post(
+            url=self._host_url(baseurl, "options"), json={"sd_model_checkpoint": model}
+        )
+        if response.status_code != 200:
+            raise RuntimeError(response.status_code, response.text)
+        with self._model_lock:
+            self.host_models[baseurl] = model
+        self.cache.invalidate("options")
+        return baseurl
+
+    def util_switch_model(self, model, wait=False):
+        """Route requests to hosts with ``model`` loaded and switch the others.
+
+        Hosts already running ``model`` are used immediately. The remaining
+        hosts switch checkpoints in parallel in the background and join the
+        rotation as they finish. If no host has the model yet this waits for
+        the first switch to complete; ``wait=True`` waits for all of them.
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+        from concurrent.futures import wait as wait_futures
+
+        self.model = model
+        loaded = self.util_get_cached_host_models()
+        pending = [b for b in self.baseurls if loaded.get(b) != model]
+        if self._switch_pool is None:
+            self._switch_pool = ThreadPoolExecutor(max_workers=len(self.baseurls))
+        futures = []
+        for baseurl in pending:
+            switching_to, future = self._model_switches.get(baseurl, (None, None))
+            if future is None or future.done() or switching_to != model:
+                future = self._switch_pool.submit(self._switch_host_model, baseurl, model)
+                self._model_switches[baseurl] = (model, future)
+            futures.append(future)
+
+        if wait:
+            wait_futures(futures)
+        elif futures and len(pending) == len(self.baseurls):
+            remaining = set(futures)
+            while remaining and self._model_hosts() is None:
+                _, remaining = wait_futures(remaining, return_when=FIRST_COMPLETED)
+        if self._model_hosts() is None and futures:
+            errors = [f.exception() for f in futures if f.done() and f.exception()]
+            raise RuntimeError(f"Unable to load {model} on any host", errors)
+
+    def util_wait_for_model(self):
+        """Block until background checkpoint switches have finished."""
+        from concurrent.futures import wait as wait_futures
+
+        wait_futures([future for _, future in self._model_switches.values()])
+
     def util_get_current_model(self):
         return self.get_options()["sd_model_checkpoint"]
 